@@ -1,158 +1,15 @@
 import os, os.path
 import subprocess
 import tempfile
-import zipfile
-import botocore.utils, botocore.exceptions
+import botocore.config, botocore.exceptions
 import boto3
 import logging, logging.handlers
 import cupocore
-import shutil
 
 __author__ = 'Callum McLean <calmcl1@aol.com>'
 __version__ = '0.1.0'
 
 
-# TODO-refactor: Move old archive detection into own method, and add unique path detection, so not only triggered when
-#  adding new archives.
-# TODO-ratelimit: #1 Add network rate limiting
-# TODO-backupscount: #2 Add a way of specifying the amount of redundant backups that should be kept
-# TODO-backupsage: #3 Specify the minimum amount of time that a backup should be kept for if there are more than
-# <min amount> of backups remaining.
-
-
-# Only the *files* in a given directory are archived, not the subdirectories.
-# The contents of the subdirectories live in archives of their own (except for any directories that *they* contain)
-# This means that only the changed files in a given directory need to be checked - and that if a file in a
-# sub-sub-subdirectory is changed, the whole parent directory doesn't need to be re-uploaded.
-# The name of each archive is equal to the name of the directory.
-
-def archive_directory(top_dir, subdir, tmpdir):
-    """
-    .. function:: archive_directory(top_dir, subdir, tmpdir)
-
-    Given a sub-directory name under the root directory to be archived, archive the contents of the sub-directory
-    to a temporary directory. Then return the full path to the temporary directory.
-    :param top_dir: The root path that will be archived and uploaded to Glacier.
-    :param subdir: The path to the subdirectory that is being archived here, relative to `top_dir`
-    :param tmpdir: The path to the temporary directory to store archives in until they are uploaded to Glacier
-    :return: If the subdirectory contains files, then the full path to the temporary archives; otherwise, None
-    """
-    # We're only archiving the *files* in this directory, not the subdirectories.
-
-    files = []
-    full_backup_path = os.path.join(top_dir, subdir)
-    dir_contents = os.listdir(full_backup_path)
-
-    # Only add files to 'files' list, not subdirs
-    for c in dir_contents:
-        fpath = os.path.join(full_backup_path, c)
-        if os.path.isfile(fpath) and not fpath.endswith(".ini"):
-            # logger.info("Adding to archive list: {0}".format(c))
-            files.append(fpath)
-
-    if not files:
-        # No point creating empty archives!
-        return None
-
-    try:
-        os.makedirs(os.path.join(tmpdir, subdir))
-    except Exception:
-        pass
-
-    files.sort()
-
-    devnull = open(os.devnull, "wb")
-
-    archive_list = []
-    cur_arch_suffix = 1
-
-    try:
-        while files:
-            archive_file_path = "{0}.{1:08d}.zip".format(os.path.join(tmpdir, subdir), cur_arch_suffix)
-            logger.info("Archiving %s to %s" % (subdir, archive_file_path))
-
-            #with tarfile.open(archive_file_path, "w:gz") as arch_tar:
-            arch_zip = zipfile.ZipFile(open(archive_file_path, "wb"), "w", allowZip64=True)
-            for i in xrange(0, int(args.max_files)):
-                try:
-                    f = files.pop()
-                    logger.info(
-                        "Adding {0} to archive {1} ({2}/{3})".format(f, archive_file_path, i + 1, args.max_files))
-                    arch_zip.write(f, os.path.basename(f))
-                except IndexError, e:
-                    # Run out of files, exit loop
-                    logger.info("Completed adding files to archive")
-                    arch_zip.close()
-                    break
-
-            archive_list.append(archive_file_path)
-            cur_arch_suffix += 1
-
-        return archive_list
-
-    except Exception, e:
-        logger.error("Failed to create archive: {0}".format(e.message))
-        logger.debug("Error args: {0}".format(e.args))
-        return None
-
-
-def delete_aws_archive(archive_id, aws_vault):
-    logger.info("Deleting archive with id {0} from vault {1}".format(
-        archive_id, aws_vault))
-
-    try:
-        boto_client.delete_archive(vaultName=aws_vault,
-                                   archiveId=archive_id)
-
-        logger.info("Successfully deleted archive from AWS")
-        return 1
-
-    except botocore.exceptions.ConnectionClosedError:
-        logger.error("AWS archive removal failed - connection to AWS server was unexpectedly closed")
-        return None
-
-    except botocore.exceptions.EndpointConnectionError:
-        logger.error("AWS archive removal failed - unable to connect to AWS server")
-        return None
-
-    except botocore.exceptions.ClientError, e:
-        logger.error("AWS archive removal failed - {0}".format(e.response["Error"]["Message"]))
-        return None
-
-    except botocore.exceptions.BotoCoreError, e:
-        logger.error("AWS archive removal failed - {0}".format(e.message))
-        return None
-
-    except Exception, e:
-        logger.error("AWS archive removal failed - {0}".format(e.message))
-
-
-def delete_redundant_archives(db, aws_vault_name):
-    redundant_archives = cupocore.mongoops.get_archives_to_delete(db)
-    for arch in redundant_archives:
-        deleted_aws = delete_aws_archive(arch["_id"], aws_vault_name)
-        if deleted_aws:
-            cupocore.mongoops.delete_archive_document(db, arch["_id"])
-            logger.info("Deleted archive with ID {0} from local database".format(arch["_id"]))
-        else:
-            logger.info("AWS deletion failed; not removing database entry")
-
-
-def compare_files(length_a, hash_a, length_b, hash_b):
-    return (length_a == length_b) & (hash_a == hash_b)
-
-
-def list_dirs(top_dir):
-    # Find all of the subdirectories in a given directory.
-    logger.info("Finding subdirectories of {0}".format(top_dir))
-    dirs = []
-    for dirname, subdirs, files in os.walk(top_dir):
-        for s in subdirs:
-            dirs.append(os.path.relpath(os.path.join(dirname, s), top_dir))
-            logger.info("Found subdirectory {0}".format(os.path.join(dirname, s), top_dir))
-    return dirs
-
-
 def add_new_vault(db, aws_account_id, vault_name):
     logger.info("Creating new vault: {0}".format(vault_name))
     devnull = open(os.devnull, "w")
@@ -219,36 +76,24 @@ def init_logging():
     return logger
 
 
-def print_file_list(db, vault_name):
-    paths = cupocore.mongoops.get_list_of_paths_in_vault(db, vault_name)
+def print_file_list(db, vault):
+    paths = cupocore.mongoops.get_list_of_paths_in_vault(db, vault)
 
-    print "Vault: {0}".format(vault_name)
-    print "\tARN: {0}".format(cupocore.mongoops.get_vault_by_name(db, vault_name)["arn"])
+    print "Vault: {0}".format(vault.name)
+    print "\tARN: {0}".format(vault.arn)
     print "\tFiles available:"
 
     for p in paths:
         print "\t\t{0}".format(p)
 
 
-def init_job_retrieval(db, vault_name, archive_id, download_location):
-    # TODO-retrieval #8 Make job retrieval work
-    raise NotImplementedError
-
-    job_params = {
-        "Format": "JSON",
-        "Type": "archive-retrieval",
-        "ArchiveID": archive_id
-    }
-    init_job_ret = boto_client.initiate_job(accountId=args.account_id,
-                                            vaultName=args.vault_name,
-                                            jobParameters=job_params)
-
-    if init_job_ret:
-        cupocore.mongoops.create_retrieval_entry(db,
-                                                 cupocore.mongoops.get_vault_by_name(db, vault_name)["arn"],
-                                                 init_job_ret["jobId"],
-                                                 init_job_ret["location"],
-                                                 download_location)
+def report_collection_scans(db, vault):
+    collection_scans = cupocore.mongoops.find_collection_scans(db, vault)
+    if collection_scans:
+        for query_name in collection_scans:
+            logger.warning("Query {0} is scanning its whole collection".format(query_name))
+    else:
+        logger.info("All frequent queries are using indexes")
 
 
 if __name__ == "__main__":
@@ -281,8 +126,17 @@ if __name__ == "__main__":
 
     db_client, db = cupocore.mongoops.connect(args.database)
 
+    # Every upload, download or delete thread needs a connection of its own, with a couple to spare for everything else
+    upload_threads = getattr(args, "upload_threads", None) or cupocore.uploadmanager.DEFAULT_UPLOAD_THREADS
+    download_threads = getattr(args, "download_threads", None) or cupocore.RetrievalManager.DEFAULT_DOWNLOAD_THREADS
+    parallel_archives = getattr(args, "parallel_archives", None) or cupocore.RetrievalManager.DEFAULT_ARCHIVE_THREADS
+    delete_threads = getattr(args, "delete_threads", None) or cupocore.prune.DEFAULT_DELETE_THREADS
     boto_session = boto3.Session(profile_name=args.aws_profile)
-    boto_client = boto_session.client('glacier')
+    boto_client = boto_session.client('glacier',
+                                      config=botocore.config.Config(
+                                          max_pool_connections=max(upload_threads,
+                                                                   download_threads * parallel_archives,
+                                                                   delete_threads) + 2))
 
     # If we're only adding a new vault...
 
@@ -293,119 +147,186 @@ if __name__ == "__main__":
             logger.error("New vault name not supplied. Cannot create vault.")
         exit()
 
+    # Everything else works on a vault that's already registered in the database. Its ARN won't change, so look it
+    # up once here.
+
+    vault = None
+    if getattr(args, "vault_name", None):
+        vault = cupocore.mongoops.get_vault(db, args.vault_name)
+        if not vault:
+            logger.error("Vault {0} is not registered in the database. Use 'new-vault' to add it.".format(
+                args.vault_name))
+            exit(1)
+
+    # If we're only checking that the database's queries are indexed...
+
+    if args.subparser_name == "check-indexes":
+        report_collection_scans(db, vault)
+        exit()
+
+    if not vault:
+        logger.error(
+            "Vault name has not been supplied. Use '--vault_name' or specify the 'vault_name' option in a config file.")
+        exit(1)
+
     if args.temp_dir:
         tempfile.tempdir = args.temp_dir
 
     # If we're retrieving existing backups...
-    elif args.subparser_name == "retrieve":
+    if args.subparser_name == "retrieve":
         if args.list_uploaded_archives:
-            print_file_list(db, args.vault_name)
+            print_file_list(db, vault)
             exit()
+
+        if not args.download_location:
+            logger.error("Download location has not been supplied. Use '--download_location'.")
+            exit(1)
+
+        retrieval_mgr = cupocore.RetrievalManager.RetrievalManager(db, boto_client, vault,
+                                                                   download_threads=download_threads,
+                                                                   archive_threads=parallel_archives,
+                                                                   extract=args.extract,
+                                                                   tier=args.tier)
+        if args.file:
+            archive_entry = cupocore.mongoops.get_archive_containing_file(db, vault, args.file)
+            if not archive_entry:
+                logger.error("No archive in vault {0} holds {1}".format(vault.name, args.file))
+                exit(1)
+            if archive_entry.get("format") == cupocore.archiver.RAW_FORMAT:
+                # A large file that was uploaded as it is - the archive is the file
+                retrieval_mgr.initiate_retrieval(archive_entry["_id"], args.download_location)
+            else:
+                # Named by its path from the archive's directory, which is its parent's for a pack of small
+                # directories
+                member_name = cupocore.archiver.relative_member_name(os.path.normpath(args.file),
+                                                                     os.path.dirname(archive_entry["path"]))
+                retrieval_mgr.initiate_file_retrieval(archive_entry, member_name, args.download_location)
         else:
-            archive_list = cupocore.mongoops.get_archive_by_path(db, args.vault_name, args.top_path, True)
+            archive_list = cupocore.mongoops.get_archive_by_path(db, vault, args.top_path, True)
+            for arch in archive_list:
+                retrieval_mgr.initiate_retrieval(arch["_id"], args.download_location)
 
-            if len(archive_list):
-                for arch in archive_list:
-                    init_job_retrieval(db, args.vault_name, arch["_id"], args.download_location)
-            logger.critical("This hasn't been implemented yet D: - TODO: INITIATE JOB RETRIEVAL")
+        retrieval_mgr.wait_for_finish()
+        db_client.close()
+        exit()
 
     # Top of directory to backup
     root_dir = args.backup_directory
     if not os.path.exists(root_dir):
         raise ValueError("%s does not exist" % root_dir)
 
-    aws_vault_name = args.vault_name
+    pruner = None
+    if not args.no_prune:
+        pruner = cupocore.prune.ArchivePruner(db, boto_client, vault,
+                                              keep_versions=getattr(args, "keep_versions", None),
+                                              min_age_days=getattr(args, "min_age_days", None),
+                                              delete_threads=delete_threads)
 
     if not args.no_backup:
 
-        # Temporary directory to create archives in
-        temp_dir = tempfile.mkdtemp()
-        logger.info("Created temporary directory at {0}".format(temp_dir))
-
         logger.info("Backing up {0} to {1} using AWS Account ID {2}".format(
-            root_dir, aws_vault_name, args.account_id))
+            root_dir, vault.name, args.account_id))
 
-        subdirs_to_backup = list_dirs(root_dir)  # List of subtrees, relative to root_dir
+        # Every directory and file in the tree, from a single walk of it
+        snapshot = cupocore.treescan.scan_tree(root_dir, getattr(args, "scan_threads", None))
+        subdirs_to_backup = snapshot.subdirs()  # List of subtrees, relative to root_dir
         subdirs_to_backup.append(
             "")  # TODO-archiveroot: #4 Dammit I will get this working - get the root directory contents to be zipped
 
-        upload_mgr = cupocore.uploadmanager.UploadManager(db, boto_client, aws_vault_name)
-
-        for subdir_to_backup in subdirs_to_backup:
-            # Archive each folder in the list to it's own (series of) zip file(s)
-            tmp_archive_fullpath_list = archive_directory(root_dir, subdir_to_backup, temp_dir)
-
-            if not tmp_archive_fullpath_list:
-                # Directory was empty - not being archived
-                continue
-            for tmp_archive_fullpath in tmp_archive_fullpath_list:
-
-                backup_subdir_abs_filename = os.path.join(root_dir, subdir_to_backup,
-                                                          os.path.basename(tmp_archive_fullpath))
-                backup_subdir_rel_filename = os.path.join(subdir_to_backup, os.path.basename(tmp_archive_fullpath))
-                # Calculate the treehash of the local archive
-                with open(tmp_archive_fullpath, 'rb') as arch_f:
-                    # archive_hash = calculate_tree_hash(arch_f)
-                    archive_hash = botocore.utils.calculate_tree_hash(arch_f)
-
-                # Find most recent version of this file in Glacier
-                most_recent_version = cupocore.mongoops.get_most_recent_version_of_archive(db, aws_vault_name,
-                                                                                           backup_subdir_rel_filename)
-
-                if most_recent_version:
-                    logger.info("Archive for this path exists in local database")
-                    hash_remote = most_recent_version['treehash']
-                    size_remote = most_recent_version['size']
-
-                else:
-                    logger.info("No archive found for this path in local database")
-                    hash_remote = size_remote = None
-
-                # Compare it against the local copy of the Glacier version of the archive
-                size_arch = os.path.getsize(tmp_archive_fullpath)
-
-                # If the hashes are the same - don't upload the archive; it already exists
-                if not compare_files(size_arch, archive_hash, size_remote, hash_remote):
-                    logger.info("Uploading {0} to vault {1}".format(tmp_archive_fullpath, aws_vault_name))
-                    if not args.dummy_upload:
-                        print "tmp_archive_fullpath: {0}\n \
-                        os.path.dirname: {1}".format(tmp_archive_fullpath, backup_subdir_rel_filename)
-                        upload_mgr.initialize_upload(tmp_archive_fullpath, backup_subdir_rel_filename,
-                                                     archive_hash, size_arch)
-                    else:
-                        # This is a dummy upload, for testing purposes. Create a fake
-                        # AWS URI and location, but don't touch the archive.
-                        logger.info("Dummy upload - not actually uploading archive!")
-
-                else:
-                    logger.info("Skipped uploading {0} - archive has not changed".format(
-                        backup_subdir_rel_filename))
-
-                # Find archives older than three months, with three more recent versions
-                # available
-                # This could only be the case when we've uploaded a new version of an archive, thereby
-                # making an old version irrelevant - so we only need to look for archives with this path.
-                if not args.no_prune:
-                    old_archives = cupocore.mongoops.get_old_archives(db, backup_subdir_rel_filename, aws_vault_name)
-                    for arch in old_archives:
-                        logger.info("Marking archive with ID {0} as redundant".format(arch["_id"]))
-                        cupocore.mongoops.mark_archive_for_deletion(db, arch["_id"])
-                else:
-                    logger.info("Not marking old versions")
-        # Wait for uploads to complete
-        upload_mgr.wait_for_finish()
-
-        # Delete the temporary directory.
+        rate_schedule = cupocore.ratelimit.RateSchedule(args.max_upload_rate,
+                                                        getattr(args, "upload_rate_schedule", None))
+        rate_limiter = cupocore.ratelimit.UploadRateLimiter(rate_schedule) if rate_schedule.is_limited() else None
+
+        upload_mgr = cupocore.uploadmanager.UploadManager(db, boto_client, vault,
+                                                          single_upload_threshold=cupocore.cmdparser.parse_size(
+                                                              args.single_upload_threshold),
+                                                          upload_threads=upload_threads,
+                                                          adaptive_concurrency=args.adaptive_upload_threads,
+                                                          rate_limiter=rate_limiter)
+
+        # Archives wait to be uploaded in a directory that survives a restart, so that uploads interrupted last time
+        # can carry on from the parts that AWS already has
+        if getattr(args, "work_dir", None):
+            work_dir_root = args.work_dir
+        elif args.temp_dir:
+            work_dir_root = os.path.join(args.temp_dir, "cupo")
+        else:
+            work_dir_root = cupocore.workdir.DEFAULT_WORK_DIR
+        work_dir = cupocore.workdir.WorkDir(work_dir_root, vault.name)
+
+        # Only the backup holding the work directory may resume the uploads of the archives in it, or clean it up
+        is_work_dir_locked = work_dir.lock()
+        if not is_work_dir_locked:
+            logger.info("Another backup is using {0} - not resuming its uploads or cleaning it up".format(
+                work_dir.path))
+        elif not args.dummy_upload:
+            upload_mgr.resume_pending_uploads(abort_unknown=getattr(args, "abort_unknown_uploads", False))
+
+        # Pick up the journal of the last run that didn't finish, and carry on in its directory so that its archives
+        # can be used again. A dummy run uploads nothing, so it keeps no journal - it would never finish, and would
+        # then be picked up by --resume.
+        run_journal = None
+        if args.resume and not args.dummy_upload:
+            run_journal = cupocore.journal.RunJournal.resume(db, vault, root_dir)
+            if not run_journal:
+                logger.info("No interrupted backup of {0} to resume - starting a new one".format(root_dir))
+            elif os.path.isdir(run_journal.run["run_dir"]):
+                work_dir.resume_run(run_journal.run["run_dir"])
+
+        if is_work_dir_locked:
+            work_dir.clean_up([upload["tmp_archive_location"]
+                               for upload in cupocore.mongoops.get_pending_uploads(db, vault)])
+
+        # Directory to create this run's archives in
+        temp_dir = work_dir.run_dir or work_dir.start_run()
+
+        if args.dummy_upload:
+            logger.info("Dummy upload - not keeping a journal of this run")
+        elif not run_journal:
+            run_journal = cupocore.journal.RunJournal.start(db, vault, root_dir, temp_dir)
+        elif run_journal.run["run_dir"] != temp_dir:
+            run_journal.set_run_dir(temp_dir)
+
+        max_archive_size = (cupocore.cmdparser.parse_size(getattr(args, "max_archive_size", None)) or
+                            cupocore.packing.DEFAULT_ARCHIVE_SIZE)
+        direct_upload_threshold = (cupocore.cmdparser.parse_size(getattr(args, "direct_upload_threshold", None)) or
+                                   cupocore.packing.DEFAULT_DIRECT_UPLOAD_THRESHOLD)
+        backup_pipeline = cupocore.pipeline.BackupPipeline(db, upload_mgr, vault, root_dir, temp_dir,
+                                                           args.max_files,
+                                                           temp_space_limit=cupocore.cmdparser.parse_size(
+                                                               args.temp_space_limit),
+                                                           dummy_upload=args.dummy_upload,
+                                                           pruner=pruner,
+                                                           archive_workers=args.archive_workers,
+                                                           run_journal=run_journal,
+                                                           snapshot=snapshot,
+                                                           compression_policy=getattr(args, "compression", None),
+                                                           max_archive_size=max_archive_size,
+                                                           direct_upload_threshold=direct_upload_threshold)
+        # A run that didn't back up everything is left unfinished, so that --resume can pick it up
+        if backup_pipeline.run(subdirs_to_backup):
+            if run_journal:
+                run_journal.finish()
+        elif run_journal:
+            logger.warning("Backup of {0} did not complete - use '--resume' to carry on with it".format(root_dir))
+
+        # Delete the run's directory, unless some of its uploads are still to be resumed
         logger.info("Removing temporary working folder")
-        shutil.rmtree(temp_dir)
+        work_dir.finish_run()
+        work_dir.unlock()
 
     else:
         logger.info("Skipping file backup - '--no-backup' supplied.")
 
     if not args.no_prune:
-        # Find and delete old archives
+        if args.no_backup:
+            # Nothing was uploaded for the pipeline to mark the old versions of, but the retention limits may have
+            # changed since the last run
+            pruner.mark_redundant_archives()
+
+        # Delete the old archives
         logger.info("Deleting redundant archives")
-        delete_redundant_archives(db, aws_vault_name)
+        pruner.delete_marked_archives()
     else:
         logger.info("Skipping archive pruning - '--no-prune' supplied.")
 
@@ -1,119 +1,493 @@
+import hashlib
 import logging
 import os
 import threading
-from math import ceil
+import time
+import Queue
+import archiver
 import mongoops
-import tempfile
+import treehash
+import zipstream
+
+DEFAULT_DOWNLOAD_THREADS = 4
+DEFAULT_ARCHIVE_THREADS = 2
+
+# How long each retrieval tier usually takes before a job completes, and how often to check on a job after that
+# (both in seconds)
+RETRIEVAL_TIERS = {"Expedited": (60, 60),
+                   "Standard": (3 * 3600, 900),
+                   "Bulk": (5 * 3600, 1800)}
+DEFAULT_TIER = "Standard"
+
+# The output of a completed job stays available for 24 hours
+JOB_OUTPUT_EXPIRY_SECONDS = 24 * 3600
 
 
 class RetrievalManager():
-    def __init__(self, db, client, vault_name):
+    def __init__(self, db, client, vault, download_threads=None, archive_threads=None, extract=False, tier=None):
         self.client = client
         self.db = db
         self.logger = logging.getLogger("cupobackup{0}.RetrievalManager".format(os.getpid()))
-        self.vault_name = vault_name
+        self.vault = vault
+        self.vault_name = vault.name
+        # Bytes per ranged request. A power of two MiB, so that AWS sends the tree hash of each range.
+        self.download_chunk_size = 16777216
+        self.download_threads = download_threads or DEFAULT_DOWNLOAD_THREADS
+        self.max_range_attempts = 5
+        # If set, archives are unzipped into their destination as they download, instead of being saved
+        self.extract = extract
+
+        self.tier = tier or DEFAULT_TIER
 
         self.check_for_jobs = threading.Event()
         self.check_for_jobs.set()
+        self._wake = threading.Event()
         self.retrieval_thread = threading.Thread(target=self.thread_worker)
 
-    def initiate_retrieval(self, archive_id, download_location):
+        # Jobs that are ready to download, and the threads that download them - several archives at once
+        self.ready_jobs = Queue.Queue()
+        self.archive_threads = archive_threads or DEFAULT_ARCHIVE_THREADS
+        self.job_threads = []
+        self._handed_off = set()  # IDs of the jobs that have been passed to the job threads
+
+    def initiate_file_retrieval(self, archive_entry, file_name, download_location):
+        """
+        Retrieve a single file from an archive, by retrieving only the part of the archive that holds it - so the
+        retrieval costs and takes as long as the file, not the whole archive.
+        :param file_name: The file's name in the archive - its path from the directory that the archive is catalogued
+        under
+        """
+        member = None
+        for archive_member in archive_entry.get("members", []):
+            if archive_member["name"] == file_name:
+                member = archive_member
+        if not member:
+            raise ValueError("{0} is not in archive {1}".format(file_name, archive_entry["path"]))
+
+        # Retrieval ranges have to start and end on a megabyte boundary
+        first_byte = member["offset"] // treehash.TREE_HASH_CHUNK_SIZE * treehash.TREE_HASH_CHUNK_SIZE
+        last_byte = min(-(-(member["offset"] + member["size"]) // treehash.TREE_HASH_CHUNK_SIZE) *
+                        treehash.TREE_HASH_CHUNK_SIZE, archive_entry["size"]) - 1
+
+        self.logger.info("Retrieving bytes {0} to {1} of {2}, holding {3}".format(first_byte, last_byte,
+                                                                                  archive_entry["path"], file_name))
+        return self.initiate_retrieval(archive_entry["_id"], download_location, (first_byte, last_byte), member)
+
+    def initiate_retrieval(self, archive_id, download_location, retrieval_range=None, member=None):
+        """
+        :param retrieval_range: If given, a (first_byte, last_byte) tuple of the part of the archive to retrieve
+        :param member: The archive member that `retrieval_range` holds, which is extracted once it's downloaded
+        """
         job_params = {
-            "Format": "JSON",
             "Type": "archive-retrieval",
-            "ArchiveID": archive_id
+            "ArchiveId": archive_id,
+            "Tier": self.tier
         }
+        if retrieval_range:
+            job_params["RetrievalByteRange"] = "{0}-{1}".format(*retrieval_range)
 
         init_job_ret = self.client.initiate_job(vaultName=self.vault_name,
                                                 jobParameters=job_params)
 
         if init_job_ret:
             mongoops.create_retrieval_entry(self.db,
-                                            mongoops.get_vault_by_name(self.db, self.vault_name)["arn"],
+                                            self.vault.arn,
                                             archive_id,
                                             init_job_ret["jobId"],
                                             init_job_ret["location"],
-                                            download_location)
+                                            download_location,
+                                            self.tier,
+                                            retrieval_range,
+                                            member)
 
         if not self.check_for_jobs.isSet(): self.check_for_jobs.set()
-        self.retrieval_thread.start()
+        self._wake.set()
+        if not self.retrieval_thread.is_alive():
+            self.retrieval_thread = threading.Thread(target=self.thread_worker)
+            self.retrieval_thread.start()
+
+        while len(self.job_threads) < self.archive_threads:
+            t = threading.Thread(target=self._job_worker)
+            self.job_threads.append(t)
+            t.start()
         return True
 
-    def check_job_status(self, job_id):
-        response = self.client.describe_job(vaultName=self.vault_name,
-                                            jobId=job_id)
+    def thread_worker(self):
+        """
+        Keep track of every outstanding retrieval job in the vault, and hand each one to the job threads as soon as it
+        completes. All of the jobs are checked on at once, with list_jobs, and in between checks the poller sleeps
+        until the next job could be ready - going by how long its retrieval tier usually takes.
+        """
+        while self.check_for_jobs.isSet():
+            entries = [entry for entry in mongoops.get_retrieval_entries(self.db, self.vault)
+                       if entry["_id"] not in self._handed_off]
+            if not entries:
+                self.logger.info("No jobs left to check - stopping trying to retrieve")
+                self.check_for_jobs.clear()
+                break
 
-        if response["Completed"] is False | response["StatusCode"] == "InProgress":
-            # Still waiting for AWS to make the data available for download
-            self.logger.info("Archive unavailable for download - AWS job in progress")
-            self.logger.debug("AWS job description response:\n{0}".format(response))
-            return False
+            wait = min(_next_check_time(entry) for entry in entries) - time.time()
+            if wait > 0:
+                self.logger.info("Waiting {0:.0f} minutes before checking on {1} jobs".format(wait / 60,
+                                                                                             len(entries)))
+                # Cut short if another job is started in the meantime
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
 
-        elif response["Completed"] is True & response["StatusCode"] == "Succeeded":
-            # Job complete, data available for download
-            self.logger.info("Job complete, archive available for download")
-            return True
+            try:
+                job_statuses = self._list_job_statuses()
+            except Exception, e:
+                self.logger.error("Failed to list jobs - '{0}'".format(e))
+                self._wake.wait(60)
+                self._wake.clear()
+                continue
 
-    def thread_worker(self):
-        while self.check_for_jobs.isSet():
-            self.logger.info("Getting new job to check")
-            entry = mongoops.get_oldest_retrieval_entry(self.db, self.vault_name)
+            mongoops.set_retrieval_entries_polled(self.db, [entry["_id"] for entry in entries])
+            for entry in entries:
+                self._handle_job_status(entry, job_statuses.get(entry["_id"]))
 
-            if not entry:
-                self.logger.info("No jobs available! Stopping trying to retrieve")
-                self.check_for_jobs.clear()
+    def _list_job_statuses(self):
+        """
+        :return: A dict of job ID -> status code, for every job that AWS knows about in the vault
+        """
+        job_statuses = {}
+        paginator = self.client.get_paginator("list_jobs")
+        for page in paginator.paginate(vaultName=self.vault_name):
+            for job in page.get("JobList", []):
+                job_statuses[job["JobId"]] = job["StatusCode"]
+        return job_statuses
+
+    def _handle_job_status(self, entry, status):
+        if status == "Succeeded":
+            self.logger.info("Job {0} is ready - commencing download".format(entry["_id"]))
+            self._handed_off.add(entry["_id"])
+            self.ready_jobs.put(entry)
 
-            else:
+        elif status == "Failed":
+            self.logger.error("Retrieval job {0} failed at AWS - it will need to be started again".format(
+                entry["_id"]))
+            mongoops.delete_retrieval_entry(self.db, entry["_id"])
 
-                self.logger.info("Checking if job {0} is ready".format(entry["_id"]))
+        elif status is None and time.time() - _initiated_time(entry) > JOB_OUTPUT_EXPIRY_SECONDS:
+            # AWS forgets about jobs a day after they complete
+            self.logger.error("Retrieval job {0} has expired - it will need to be started again".format(entry["_id"]))
+            mongoops.delete_retrieval_entry(self.db, entry["_id"])
 
-                status = self.check_job_status(entry["_id"])
-                if not status:
-                    logging.info("Job {0} is not ready. Waiting 1 minute".format(entry["_id"]))
+        else:
+            self.logger.debug("Job {0} is not ready yet".format(entry["_id"]))
+
+    def _job_worker(self):
+        while True:
+            job_entry = self.ready_jobs.get()
+            if job_entry is None:
+                return
+
+            # A job that fails keeps its entry, so that it's tried again next time
+            try:
+                if job_entry.get("member"):
+                    self.restore_member(job_entry)
+                elif self.extract:
+                    self.restore_archive(job_entry)
                 else:
-                    logging.info("Job {0} is ready - commencing download".format(entry["_id"]))
-                    self.download_archive(entry)
+                    self.download_archive(job_entry)
+            except Exception, e:
+                self.logger.error("Failed to retrieve job {0} - '{1}'".format(job_entry["_id"], e))
 
     def download_archive(self, job_entry):
+        """
+        Download the archive of a completed retrieval job to its destination, as several ranged requests at once.
+        Each range is written straight to its place in the output file, and checked against the tree hash that AWS
+        sends with it - a range that fails is retried on its own. Once every range has arrived, the whole archive is
+        checked against the tree hash that it was uploaded with.
+        :return: True if the archive was downloaded intact
+        """
+        archive_entry = mongoops.get_archive_by_id(self.db, job_entry["archive_id"])
+        archive_size = archive_entry["size"]
+        output_path = os.path.join(job_entry["job_retrieval_destination"], archive_entry["path"])
+
+        try:
+            os.makedirs(os.path.dirname(output_path))
+        except OSError:
+            pass
+
+        # Give the output file its full size up front, so that each range can be written at its own offset
+        with open(output_path, "wb") as output_f:
+            output_f.truncate(archive_size)
+
+        range_queue = Queue.Queue()
+        for first_byte in xrange(0, archive_size, self.download_chunk_size):
+            range_queue.put((first_byte, min(first_byte + self.download_chunk_size, archive_size) - 1))
+
+        range_digests = {}  # First byte of each range -> the digests of its 1 MiB chunks
+        failed_ranges = []
+        download_threads = [threading.Thread(target=self._download_worker,
+                                             args=(job_entry["_id"], output_path, range_queue, range_digests,
+                                                   failed_ranges))
+                            for i in xrange(min(self.download_threads, range_queue.qsize()))]
+        for t in download_threads:
+            t.start()
+        for t in download_threads:
+            t.join()
+
+        if failed_ranges:
+            self.logger.error("Failed to download {0} ranges of {1} - the job will be tried again".format(
+                len(failed_ranges), archive_entry["path"]))
+            return False
+
+        chunk_digests = []
+        for first_byte in sorted(range_digests):
+            chunk_digests.extend(range_digests[first_byte])
+        if treehash.TreeHash(chunk_digests).hexdigest() != archive_entry["treehash"]:
+            self.logger.error("Downloaded archive {0} does not match its tree hash".format(output_path))
+            return False
+
+        # We should delete the retrieval job, now that we have the data
+        mongoops.delete_retrieval_entry(self.db, job_entry["_id"])
+        self.logger.info("Downloaded {0} to {1}".format(archive_entry["path"], output_path))
+        return True
+
+    def _download_worker(self, job_id, output_path, range_queue, range_digests, failed_ranges):
+        with open(output_path, "r+b") as output_f:
+            while True:
+                try:
+                    first_byte, last_byte = range_queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                def write_chunk(offset, chunk):
+                    output_f.seek(offset)
+                    output_f.write(chunk)
+
+                chunk_digests = self._download_range_with_retries(job_id, first_byte, last_byte, write_chunk)
+                if chunk_digests is None:
+                    failed_ranges.append((first_byte, last_byte))
+                else:
+                    range_digests[first_byte] = chunk_digests
+
+    def restore_archive(self, job_entry):
+        """
+        Download the archive of a completed retrieval job and unzip it into its destination at the same time, so the
+        archive itself is never stored. The ranges are downloaded several at a time, a few ahead of the one being
+        unzipped, and each is checked against its tree hash before any of it is unzipped.
+        :return: True if the whole archive was restored
+        """
         archive_entry = mongoops.get_archive_by_id(self.db, job_entry["archive_id"])
-        tmp_dir = tempfile.mkdtemp()
+        if archive_entry.get("format") == archiver.RAW_FORMAT:
+            # A large file that was uploaded as it is, with nothing to unzip - it's downloaded to its own path
+            return self.download_archive(job_entry)
 
-        # Break the job up into chunks to make life easier
-        chunk_files = []
-        chunk_size = 16777216
+        dest_dir = os.path.join(job_entry["job_retrieval_destination"], os.path.dirname(archive_entry["path"]))
+        # The files of any directories that a newer archive holds are left to that archive
+        skip_dirs = [archiver.relative_member_name(d, os.path.dirname(archive_entry["path"])).encode("utf-8")
+                     for d in archive_entry.get("superseded_dirs", [])]
+        extractor = zipstream.ZipStreamExtractor(dest_dir, skip_dirs=skip_dirs)
 
-        last_byte_downloaded = -1
+        chunk_digests = []
+        ranges = [(first_byte, min(first_byte + self.download_chunk_size, archive_entry["size"]) - 1)
+                  for first_byte in xrange(0, archive_entry["size"], self.download_chunk_size)]
+        try:
+            for data, range_digests in self._download_ranges_in_order(job_entry["_id"], ranges):
+                extractor.feed(data)
+                chunk_digests.extend(range_digests)
+            extractor.close()
+        except IOError, e:
+            self.logger.error("Failed to restore {0} - '{1}'. The job will be tried again".format(
+                archive_entry["path"], e))
+            return False
 
-        while last_byte_downloaded < archive_entry["size"]:
-            byte_first = last_byte_downloaded + 1
-            if (chunk_size + last_byte_downloaded) >= archive_entry["size"] - 1:
-                byte_last = archive_entry["size"] - 1
-            else:
-                byte_last = chunk_size + last_byte_downloaded
+        if treehash.TreeHash(chunk_digests).hexdigest() != archive_entry["treehash"]:
+            self.logger.error("Restored archive {0} does not match its tree hash".format(archive_entry["path"]))
+            return False
+
+        mongoops.delete_retrieval_entry(self.db, job_entry["_id"])
+        self.logger.info("Restored {0} files from {1} to {2}".format(len(extractor.extracted), archive_entry["path"],
+                                                                     dest_dir))
+        return True
+
+    def restore_member(self, job_entry):
+        """
+        Download the output of a job that retrieved a single archive member, and extract the member from it.
+        :return: True if the member was restored
+        """
+        archive_entry = mongoops.get_archive_by_id(self.db, job_entry["archive_id"])
+        dest_dir = os.path.join(job_entry["job_retrieval_destination"], os.path.dirname(archive_entry["path"]))
+        extractor = zipstream.ZipStreamExtractor(dest_dir, max_members=1)
 
-            response = self.client.get_job_output(vaultName=self.vault_name,
-                                                  jobId=job_entry["_id"],
-                                                  range="bytes {0}-{1}/*".format(byte_first, byte_last))
+        first_byte, last_byte = job_entry["retrieval_range"]
+        output_size = last_byte - first_byte + 1
+        ranges = [(i, min(i + self.download_chunk_size, output_size) - 1)
+                  for i in xrange(0, output_size, self.download_chunk_size)]
+        # The retrieved range starts on a megabyte boundary - the member's local header may be a little way in
+        skip = job_entry["member"]["offset"] - first_byte
 
-            if response["status"] == 200 or response["status"] == 206:
-                tmp_chunk_fd, tmp_chunk_path = tempfile.mkstemp(dir=tmp_dir)
-                f = os.fdopen(tmp_chunk_fd, "wb")
-                f.write(response["body"].read())
+        downloaded_ranges = self._download_ranges_in_order(job_entry["_id"], ranges)
+        try:
+            for data, range_digests in downloaded_ranges:
+                if skip:
+                    skipped = min(skip, len(data))
+                    data = data[skipped:]
+                    skip -= skipped
+                extractor.feed(data)
+                if extractor.done:
+                    break
+            extractor.close()
+            if not extractor.extracted:
+                raise IOError("The retrieved range didn't hold {0}".format(job_entry["member"]["name"]))
+        except IOError, e:
+            self.logger.error("Failed to restore {0} - '{1}'. The job will be tried again".format(
+                job_entry["member"]["name"], e))
+            return False
+        finally:
+            downloaded_ranges.close()
+
+        mongoops.delete_retrieval_entry(self.db, job_entry["_id"])
+        self.logger.info("Restored {0}".format(extractor.extracted[0]))
+        return True
+
+    def _download_ranges_in_order(self, job_id, ranges):
+        """
+        Download `ranges` of a job's output on several threads at once, yielding the data and chunk digests of each
+        range in order. Only a few ranges are held in memory at a time.
+        :raise IOError: if a range could not be downloaded
+        """
+        window = self.download_threads * 2
+        fetched = {}  # Index of each downloaded range -> (data, digests), or None if it failed
+        state = {"next": 0, "stopped": False}
+        cond = threading.Condition()
+        range_queue = Queue.Queue()
+        for i in xrange(len(ranges)):
+            range_queue.put(i)
+
+        def fetch_worker():
+            while True:
                 try:
-                    response["body"].close()
-                except:
-                    # May not need to be closed
-                    pass
-                f.close()
-                chunk_files.append(tmp_chunk_path)
-            else:
-                self.logger.error(
-                    "Getting job output for job {0} returned non-successful HTTP code: {1}".format(job_entry["_id"],
-                                                                                                   response["status"]))
-
-                # We should delete the retrieval job, now that we have the data
-                mongoops.delete_retrieval_entry(self.db, job_entry["_id"])
-                # Now that we have all of the files, join them together
-                # TODO: add file joining and de-archive mechanism
-
-        os.rmdir(tmp_dir)
+                    i = range_queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                with cond:
+                    while i >= state["next"] + window and not state["stopped"]:
+                        cond.wait()
+                    if state["stopped"]:
+                        return
+
+                pieces = {}
+                first_byte, last_byte = ranges[i]
+                chunk_digests = self._download_range_with_retries(
+                    job_id, first_byte, last_byte, lambda offset, chunk: pieces.__setitem__(offset, chunk))
+                with cond:
+                    fetched[i] = None if chunk_digests is None else \
+                        ("".join(pieces[offset] for offset in sorted(pieces)), chunk_digests)
+                    cond.notify_all()
+
+        fetch_threads = [threading.Thread(target=fetch_worker)
+                         for i in xrange(min(self.download_threads, len(ranges)))]
+        for t in fetch_threads:
+            t.start()
+
+        try:
+            for i in xrange(len(ranges)):
+                with cond:
+                    while i not in fetched:
+                        cond.wait()
+                    result = fetched.pop(i)
+                    state["next"] = i + 1
+                    cond.notify_all()
+
+                if result is None:
+                    raise IOError("Failed to download bytes {0} to {1}".format(*ranges[i]))
+                yield result
+        finally:
+            with cond:
+                state["stopped"] = True
+                cond.notify_all()
+            for t in fetch_threads:
+                t.join()
+
+    def _download_range_with_retries(self, job_id, first_byte, last_byte, write_chunk):
+        """
+        :return: The digests of the range's 1 MiB chunks, or None if it couldn't be downloaded
+        """
+        for attempt in xrange(1, self.max_range_attempts + 1):
+            try:
+                return self._download_range(job_id, first_byte, last_byte, write_chunk)
+            except Exception, e:
+                self.logger.warning("Failed to download bytes {0} to {1} of job {2} ({3}/{4}) - '{5}'".format(
+                    first_byte, last_byte, job_id, attempt, self.max_range_attempts, e))
+        return None
+
+    def _download_range(self, job_id, first_byte, last_byte, write_chunk):
+        """
+        Download one range of a job's output, passing each 1 MiB chunk of it to `write_chunk(offset, chunk)` as it
+        arrives.
+        :return: The digests of the range's 1 MiB chunks
+        """
+        response = self.client.get_job_output(vaultName=self.vault_name,
+                                              jobId=job_id,
+                                              range="bytes={0}-{1}".format(first_byte, last_byte))
+        if response["status"] not in (200, 206):
+            raise IOError("Getting job output returned non-successful HTTP code: {0}".format(response["status"]))
+
+        chunk_digests = []
+        received = 0
+        body = response["body"]
+        try:
+            chunk = _read_fully(body, treehash.TREE_HASH_CHUNK_SIZE)
+            while chunk:
+                write_chunk(first_byte + received, chunk)
+                chunk_digests.append(hashlib.sha256(chunk).digest())
+                received += len(chunk)
+                chunk = _read_fully(body, treehash.TREE_HASH_CHUNK_SIZE)
+        finally:
+            body.close()
+
+        if received != last_byte - first_byte + 1:
+            raise IOError("Range ended after {0} of {1} bytes".format(received, last_byte - first_byte + 1))
+
+        # AWS sends the tree hash of the range along with it, as long as the range is tree hash aligned
+        checksum = response.get("checksum")
+        if checksum and checksum != treehash.TreeHash(chunk_digests).hexdigest():
+            raise IOError("Range does not match its tree hash")
+
+        return chunk_digests
+
+    def wait_for_finish(self):
+        if self.retrieval_thread.is_alive():
+            self.retrieval_thread.join()
+
+        # No more jobs are coming - let the job threads finish what they have
+        for t in self.job_threads:
+            self.ready_jobs.put(None)
+        for t in self.job_threads:
+            t.join()
+        self.job_threads = []
+
+
+def _initiated_time(entry):
+    # Entries from before the initiation time was recorded were created when the job was started
+    return entry.get("job_initiated_time", entry["job_last_polled_time"])
+
+
+def _next_check_time(entry):
+    """
+    When a retrieval job is next worth checking on: not before its tier could have finished it, and then at the
+    tier's polling interval.
+    """
+    expected_seconds, poll_interval = RETRIEVAL_TIERS.get(entry.get("tier"), RETRIEVAL_TIERS[DEFAULT_TIER])
+    return max(_initiated_time(entry) + expected_seconds, entry["job_last_polled_time"] + poll_interval)
+
+
+def _read_fully(stream, size):
+    """
+    Read `size` bytes from a stream, unless it ends first - a single read may return fewer.
+    """
+    pieces = []
+    remaining = size
+    while remaining:
+        piece = stream.read(remaining)
+        if not piece:
+            break
+        pieces.append(piece)
+        remaining -= len(piece)
+    return "".join(pieces)
@@ -2,3 +2,14 @@ import mongoops
 import cmdparser
 import RetrievalManager
 import uploadmanager
+import treehash
+import archiver
+import pipeline
+import catalog
+import ratelimit
+import workdir
+import journal
+import prune
+import treescan
+import compression
+import packing
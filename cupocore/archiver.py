@@ -0,0 +1,388 @@
+import hashlib
+import logging
+import os, os.path
+import zipfile
+import compression
+import treehash
+import treescan
+
+logger = logging.getLogger("cupobackup{0}.archiver".format(os.getpid()))
+
+# The format of an archive that is a single large file, uploaded as it is rather than copied into a zip archive
+RAW_FORMAT = "raw"
+
+
+# Only the *files* in a given directory are archived, not the subdirectories.
+# The contents of the subdirectories live in archives of their own (except for any directories that *they* contain)
+# This means that only the changed files in a given directory need to be checked - and that if a file in a
+# sub-sub-subdirectory is changed, the whole parent directory doesn't need to be re-uploaded.
+# The name of each archive is equal to the name of the directory.
+
+def build_directory_manifest(top_dir, subdir):
+    """
+    .. function:: build_directory_manifest(top_dir, subdir)
+
+    Build a manifest of the files that would be archived for a sub-directory. If the manifest matches the one that was
+    stored when the directory was last uploaded, then nothing in the directory has changed and it need not be zipped.
+    When the whole tree is being backed up, the manifests of all of its directories come from one
+    treescan.TreeSnapshot instead.
+    :param top_dir: The root path that will be archived and uploaded to Glacier.
+    :param subdir: The path to the subdirectory, relative to `top_dir`
+    :return: A sorted list of [name, size, mtime, inode] entries - one for each file in the subdirectory
+    """
+    return treescan.scan_directory(top_dir, subdir)
+
+
+def read_member_index(archive_path):
+    """
+    .. function:: read_member_index(archive_path)
+
+    Build the index of an archive's members from its central directory, for archives whose index wasn't kept when they
+    were written.
+    :return: A list of dicts holding the "name", "offset" and "size" (local header included) and "file_size" of each
+    member
+    """
+    with zipfile.ZipFile(archive_path, "r") as arch_zip:
+        infolist = sorted(arch_zip.infolist(), key=lambda zinfo: zinfo.header_offset)
+        member_ends = [zinfo.header_offset for zinfo in infolist[1:]] + [arch_zip.start_dir]
+
+    return [{"name": zinfo.filename,
+             "offset": zinfo.header_offset,
+             "size": member_end - zinfo.header_offset,
+             "file_size": zinfo.file_size}
+            for zinfo, member_end in zip(infolist, member_ends)]
+
+
+def verify_archives(archive_list):
+    """
+    .. function:: verify_archives(archive_list)
+
+    Check that the archives made by an interrupted run are still intact, by hashing them again.
+    :param archive_list: A list of dicts holding the "path", "size" and "treehash" of each archive, and the "format"
+    and "rel_path" of raw files
+    :return: The list of archives in the same form as archive_directory() returns, or None if any of them is missing
+    or doesn't match
+    """
+    verified_archives = []
+    for archive in archive_list:
+        if not os.path.isfile(archive["path"]) or os.path.getsize(archive["path"]) != archive["size"]:
+            return None
+
+        source_mtime = os.path.getmtime(archive["path"])
+        with open(archive["path"], "rb") as archive_f:
+            tree_hash = treehash.TreeHash.from_file(archive_f)
+        if tree_hash.hexdigest() != archive["treehash"]:
+            logger.warning("Archive {0} has changed since it was made".format(archive["path"]))
+            return None
+
+        logger.info("Reusing archive {0}".format(archive["path"]))
+        if archive.get("format") == RAW_FORMAT:
+            verified_archives.append(dict(archive, hashes=tree_hash, members=None, source_mtime=source_mtime))
+        else:
+            verified_archives.append({"path": archive["path"],
+                                      "size": archive["size"],
+                                      "treehash": archive["treehash"],
+                                      "hashes": tree_hash,
+                                      "members": read_member_index(archive["path"])})
+
+    return verified_archives
+
+
+def archive_directory(top_dir, subdir, tmpdir, max_files=None, reuse_archives=None, manifest=None,
+                      compression_policy=compression.DEFAULT_POLICY, max_archive_size=None, raw_files=None,
+                      unchanged_raw_files=None):
+    """
+    .. function:: archive_directory(top_dir, subdir, tmpdir, max_files=None, reuse_archives=None, manifest=None,
+                                    compression_policy=compression.DEFAULT_POLICY, max_archive_size=None,
+                                    raw_files=None, unchanged_raw_files=None)
+
+    Given a sub-directory name under the root directory to be archived, archive the contents of the sub-directory
+    to a temporary directory. The Glacier tree hash of each archive is worked out as it is written, so the archives
+    never need to be read back to be hashed.
+    :param top_dir: The root path that will be archived and uploaded to Glacier.
+    :param subdir: The path to the subdirectory that is being archived here, relative to `top_dir`
+    :param tmpdir: The path to the temporary directory to store archives in until they are uploaded to Glacier
+    :param max_files: If given, the maximum amount of files in a single archive
+    :param reuse_archives: The archives of this subdirectory from an interrupted run, if there are any. If they are
+    still intact they are returned instead of archiving the subdirectory again.
+    :param manifest: The subdirectory's manifest, if it has already been scanned - the files in it are archived
+    without listing the subdirectory again
+    :param compression_policy: How to choose whether each file is compressed - one of compression.POLICIES
+    :param max_archive_size: If given, the most file data in bytes that goes into a single archive
+    :param raw_files: The names of the large files in `manifest` that are uploaded as they are, rather than zipped.
+    Each is hashed in place, and returned as an archive of its own.
+    :param unchanged_raw_files: The names of the large files in `manifest` that are uploaded as they are, but haven't
+    changed since they last were - they're neither zipped nor hashed
+    :return: If the subdirectory contains files, then a list of dicts - one for each archive - holding the full
+    "path" to the temporary archive, its "size", its "treehash", the TreeHash of its chunks ("hashes") and an index
+    of its "members". Raw files are listed with their own "path", and their "format", "rel_path" (relative to
+    `top_dir`) and "source_mtime" too. If there's nothing to archive, None.
+    """
+    if reuse_archives:
+        verified_archives = verify_archives(reuse_archives)
+        if verified_archives:
+            return verified_archives
+
+    # We're only archiving the *files* in this directory, not the subdirectories.
+    if manifest is None:
+        manifest = build_directory_manifest(top_dir, subdir)
+
+    raw_files = set(raw_files or [])
+    not_zipped = raw_files.union(unchanged_raw_files or [])
+    full_backup_path = os.path.join(top_dir, subdir)
+    files = [(os.path.join(full_backup_path, entry[0]), entry[0], entry[1]) for entry in manifest
+             if entry[0] not in not_zipped]
+
+    # The raw files are hashed first, so that nothing is zipped if one of them can't be read
+    raw_archives = hash_raw_files(top_dir, [os.path.join(subdir, name) for name in sorted(raw_files)])
+    if raw_archives is None:
+        return None
+
+    archive_list = write_archives(os.path.join(tmpdir, subdir), files, max_files, max_archive_size,
+                                  compression_policy) if files else []
+    if archive_list is None:
+        return None
+    return (archive_list + raw_archives) or None
+
+
+def archive_directories(top_dir, base_dir, archive_name, dir_manifests, tmpdir, max_files=None, reuse_archives=None,
+                        compression_policy=compression.DEFAULT_POLICY, max_archive_size=None, raw_files=None,
+                        unchanged_raw_files=None):
+    """
+    .. function:: archive_directories(top_dir, base_dir, archive_name, dir_manifests, tmpdir, max_files=None,
+                                      reuse_archives=None, compression_policy=compression.DEFAULT_POLICY,
+                                      max_archive_size=None, raw_files=None, unchanged_raw_files=None)
+
+    Archive the files of several small directories together, so that they don't each need an archive (and a Glacier
+    request) of their own. Each file is stored under its path relative to `base_dir`, so the directories can be told
+    apart again when the archive is restored.
+    :param base_dir: The directory that the archives are catalogued under, relative to `top_dir` - a common parent of
+    all of the directories
+    :param archive_name: The name of the archives, without the number and extension
+    :param dir_manifests: A list of (subdir, manifest) pairs - one for each of the directories
+    :param raw_files: The paths (relative to `top_dir`) of the large files that are uploaded as they are
+    :param unchanged_raw_files: The paths of the large files that haven't changed since they were last uploaded
+    :return: As archive_directory()
+    """
+    if reuse_archives:
+        verified_archives = verify_archives(reuse_archives)
+        if verified_archives:
+            return verified_archives
+
+    raw_files = set(raw_files or [])
+    raw_archives = hash_raw_files(top_dir, sorted(raw_files))
+    if raw_archives is None:
+        return None
+
+    not_zipped = raw_files.union(unchanged_raw_files or [])
+    files = []
+    for subdir, manifest in dir_manifests:
+        full_backup_path = os.path.join(top_dir, subdir)
+        for entry in manifest:
+            if os.path.join(subdir, entry[0]) not in not_zipped:
+                files.append((os.path.join(full_backup_path, entry[0]),
+                              relative_member_name(os.path.join(subdir, entry[0]), base_dir),
+                              entry[1]))
+
+    archive_list = write_archives(os.path.join(tmpdir, base_dir, archive_name), files, max_files, max_archive_size,
+                                  compression_policy) if files else []
+    if archive_list is None:
+        return None
+    return (archive_list + raw_archives) or None
+
+
+def hash_raw_files(top_dir, rel_paths):
+    """
+    .. function:: hash_raw_files(top_dir, rel_paths)
+
+    Hash each of a list of large files that will be uploaded as they are.
+    :return: A list of the files as archives, as hash_raw_file() returns them, or None if any of them couldn't be read
+    """
+    raw_archives = []
+    for rel_path in rel_paths:
+        raw_archive = hash_raw_file(top_dir, rel_path)
+        if raw_archive is None:
+            return None
+        raw_archives.append(raw_archive)
+    return raw_archives
+
+
+def hash_raw_file(top_dir, rel_path):
+    """
+    .. function:: hash_raw_file(top_dir, rel_path)
+
+    Work out the tree hash of a large file that will be uploaded as it is, straight from where it lives - so it's read
+    once here and once more to upload it, but never copied.
+    :param rel_path: The path to the file, relative to `top_dir`
+    :return: The file as an archive, in the same form as archive_directory() returns, or None if it couldn't be read -
+    for instance, because it was removed after the tree was scanned
+    """
+    full_path = os.path.join(top_dir, rel_path)
+    logger.info("Hashing {0} to upload it as it is".format(full_path))
+    try:
+        with open(full_path, "rb") as raw_f:
+            # The mtime of the content that's hashed, so that a resumed upload can tell if the file has changed since
+            source_mtime = os.fstat(raw_f.fileno()).st_mtime
+            tree_hash = treehash.TreeHash.from_file(raw_f)
+            size = raw_f.tell()
+    except (IOError, OSError), e:
+        logger.error("Failed to hash {0} - '{1}'".format(full_path, e))
+        return None
+
+    return {"path": full_path,
+            "size": size,
+            "treehash": tree_hash.hexdigest(),
+            "hashes": tree_hash,
+            "members": None,
+            "format": RAW_FORMAT,
+            "rel_path": rel_path,
+            "source_mtime": source_mtime}
+
+
+def relative_member_name(rel_path, base_dir):
+    """
+    :return: The name that a file (at `rel_path`, relative to the top directory) is stored under in an archive that is
+    catalogued under `base_dir`
+    """
+    if not base_dir:
+        return rel_path
+    return os.path.relpath(rel_path, base_dir)
+
+
+def member_dirs(archive_rel_path, members):
+    """
+    :return: The directories (relative to the top directory) whose files are in an archive, if it holds the files of
+    more than the one directory that it's catalogued under; otherwise, None
+    """
+    base_dir = os.path.dirname(archive_rel_path)
+    dirs = set()
+    for member in members:
+        member_dir = os.path.dirname(member["name"])
+        dirs.add(os.path.normpath(os.path.join(base_dir, member_dir)) if member_dir else base_dir)
+
+    if dirs == set([base_dir]):
+        return None
+    return sorted(dirs)
+
+
+def _name_key(member_name):
+    # The first 8 hex digits of the SHA-1 of a member's name
+    if isinstance(member_name, unicode):
+        member_name = member_name.encode("utf-8")
+    return hashlib.sha1(member_name).hexdigest()[:8]
+
+
+def _starts_archive(f, target_files, target_size):
+    # Whether a file starts a new archive depends only on its own name and size, with odds that give archives of
+    # about the target size on average. The bigger the file, the likelier it is to start one.
+    odds = 1.0 / target_files if target_files else 0.0
+    if target_size:
+        odds = max(odds, float(f[2]) / target_size)
+    return int(_name_key(f[1]), 16) < odds * 0x100000000
+
+
+def split_into_archives(files, max_files=None, max_archive_size=None):
+    """
+    .. function:: split_into_archives(files, max_files=None, max_archive_size=None)
+
+    Share files out between archives, in the order of their names. Each archive starts at a file picked by a hash of
+    its name, so adding, removing or changing a file only moves the boundaries around it - the archives before and
+    after it keep the same files, and aren't uploaded again. The boundaries fall about half of `max_files` files or
+    `max_archive_size` bytes apart; an archive that would still go over either limit is split again, filling each
+    piece in turn, which only changes that archive.
+    :param files: A list of (full path, member name, size) tuples
+    :return: A list of lists of those tuples - one list for each archive
+    """
+    max_files = int(max_files) if max_files else None
+    target_files = max_files / 2.0 if max_files else None
+    target_size = max_archive_size / 2.0 if max_archive_size else None
+
+    chunks = []
+    for f in sorted(files, key=lambda f: f[1]):
+        if not chunks or _starts_archive(f, target_files, target_size):
+            chunks.append([])
+        chunks[-1].append(f)
+
+    archives = []
+    for chunk in chunks:
+        cur_files = []
+        cur_size = 0
+        for f in chunk:
+            if cur_files and ((max_files and len(cur_files) >= max_files) or
+                              (max_archive_size and cur_size + f[2] > max_archive_size)):
+                archives.append(cur_files)
+                cur_files = []
+                cur_size = 0
+            cur_files.append(f)
+            cur_size += f[2]
+        archives.append(cur_files)
+    return archives
+
+
+def write_archives(archive_prefix, files, max_files=None, max_archive_size=None,
+                   compression_policy=compression.DEFAULT_POLICY):
+    """
+    .. function:: write_archives(archive_prefix, files, max_files=None, max_archive_size=None,
+                                 compression_policy=compression.DEFAULT_POLICY)
+
+    Write a series of zip archives holding `files`. Each is named <archive_prefix>.<key>.zip, where the key is a hash
+    of the name of its first member, so that an archive whose files haven't changed keeps its name.
+    :param files: A list of (full path, member name, size) tuples
+    :return: As archive_directory()
+    """
+    if not files:
+        # No point creating empty archives!
+        return None
+
+    try:
+        os.makedirs(os.path.dirname(archive_prefix))
+    except Exception:
+        pass
+
+    archive_list = []
+
+    try:
+        archive_keys = set()
+        for arch_files in split_into_archives(files, max_files, max_archive_size):
+            archive_key = _name_key(arch_files[0][1])
+            while archive_key in archive_keys:
+                archive_key = _name_key(archive_key)
+            archive_keys.add(archive_key)
+            archive_file_path = "{0}.{1}.zip".format(archive_prefix, archive_key)
+            logger.info("Archiving {0} files to {1}".format(len(arch_files), archive_file_path))
+
+            hash_writer = treehash.TreeHashWriter(open(archive_file_path, "wb"))
+            arch_zip = zipfile.ZipFile(hash_writer, "w", allowZip64=True)
+            members = []
+            for i, (f, member_name, f_size) in enumerate(arch_files):
+                logger.info(
+                    "Adding {0} to archive {1} ({2}/{3})".format(f, archive_file_path, i + 1, len(arch_files)))
+                # zipfile rewrites the member's header once its data is written - keep it unhashed until then
+                hash_writer.hold()
+                arch_zip.write(f, member_name, compression.choose_compress_type(f, compression_policy))
+                hash_writer.release()
+
+                # Where the member sits in the archive, local header and all - so that it can be retrieved on its own
+                zinfo = arch_zip.infolist()[-1]
+                members.append({"name": zinfo.filename,
+                                "offset": zinfo.header_offset,
+                                "size": hash_writer.tell() - zinfo.header_offset,
+                                "file_size": zinfo.file_size})
+
+            logger.info("Completed adding files to archive")
+            arch_zip.close()
+            hash_writer.close()
+
+            tree_hash = hash_writer.tree_hash()
+            archive_list.append({"path": archive_file_path,
+                                 "size": hash_writer.size,
+                                 "treehash": tree_hash.hexdigest(),
+                                 "hashes": tree_hash,
+                                 "members": members})
+
+        return archive_list
+
+    except Exception, e:
+        logger.error("Failed to create archive: {0}".format(e.message))
+        logger.debug("Error args: {0}".format(e.args))
+        return None
@@ -0,0 +1,58 @@
+import logging
+import os
+import threading
+import mongoops
+
+
+class ArchiveCatalog():
+    """
+    The most recent version of every archive in a vault, keyed by path. Loaded from the tracking database with a single
+    aggregation at the start of a run, and kept up to date as uploads complete, so that checking whether an archive
+    has changed never needs a database query.
+    """
+
+    def __init__(self, db, vault):
+        self.db = db
+        self.vault = vault
+        self.logger = logging.getLogger("cupobackup{0}.ArchiveCatalog".format(os.getpid()))
+
+        self._lock = threading.Lock()
+        self._latest = {}
+
+    def load(self):
+        latest = {}
+        for version in mongoops.get_latest_archive_versions(self.db, self.vault):
+            latest[_catalog_key(version["_id"])] = {"_id": version["archive_id"],
+                                                   "path": version["_id"],
+                                                   "treehash": version["treehash"],
+                                                   "size": version["size"],
+                                                   "uploaded_time": version["uploaded_time"],
+                                                   "format": version.get("format"),
+                                                   "source_mtime": version.get("source_mtime")}
+
+        with self._lock:
+            self._latest = latest
+        self.logger.info("Loaded the latest versions of {0} archives".format(len(latest)))
+
+    def get_most_recent_version(self, path):
+        with self._lock:
+            return self._latest.get(_catalog_key(path))
+
+    def update(self, archive_entry):
+        """
+        Record a newly uploaded archive as the latest version of its path. Can be used as an UploadManager completion
+        callback.
+        """
+        with self._lock:
+            self._latest[_catalog_key(archive_entry["path"])] = archive_entry
+
+
+def _catalog_key(path):
+    # pymongo hands paths back as unicode, but the scan finds them as UTF-8 byte strings - so that non-ASCII paths
+    # match, every path is looked up as unicode
+    if isinstance(path, str):
+        try:
+            return path.decode("utf-8")
+        except UnicodeDecodeError:
+            return path
+    return path
@@ -41,9 +41,30 @@ def __parse_cmd_args(options_namespace):
                                    help='If passed, the backup operation will not take place, going straight to the \
                                    maintenance operations',
                                    action='store_true')
+    arg_parser_backup.add_argument('--resume',
+                                   help='If passed, carry on with the last backup of this directory that did not \
+                                   finish, skipping the directories it had finished and reusing its archives.',
+                                   action='store_true')
+    arg_parser_backup.add_argument('--abort-unknown-uploads',
+                                   help='If passed, abort the multipart uploads left open in the vault that the \
+                                   database has no record of. Only use this if nothing else uploads to the vault.',
+                                   action='store_true')
     arg_parser_backup.add_argument('--no-prune',
                                    help='If passed, the process of finding and removing old archives will not take place.',
                                    action='store_true')
+    arg_parser_backup.add_argument("--keep-versions",
+                                   help="If passed, the number of old versions of each archive that are kept once \
+                                   they are older than --min-age-days. Defaults to 3.",
+                                   type=int)
+    arg_parser_backup.add_argument("--min-age-days",
+                                   help="If passed, the age in days that an old version of an archive must reach \
+                                   before it can be deleted. Glacier charges for 90 days of storage, however soon an \
+                                   archive is deleted. Defaults to 93.",
+                                   type=int)
+    arg_parser_backup.add_argument("--delete-threads",
+                                   help="If passed, the number of redundant archives that will be deleted from \
+                                   Glacier at once. Defaults to 8.",
+                                   type=int)
     arg_parser_backup.add_argument('--dummy-upload',
                                    help='If passed, the archives will not be uploaded, but a dummy AWS URI and archive \
                                    ID will be generated. Use for testing only.',
@@ -52,10 +73,54 @@ def __parse_cmd_args(options_namespace):
                                    help="If passed, the specified directory will be used to store temporary upload and \
                                         download chunks. Use when the drive with the default tempdir has little \
                                         available space")
+    arg_parser_backup.add_argument("--work-dir",
+                                   help="If passed, the directory that archives are kept in until they have been \
+                                   uploaded. It must survive a restart, so that interrupted uploads can be resumed. \
+                                   Defaults to ~/.cupo/work, or a 'cupo' directory inside --temp-dir.")
+    arg_parser_backup.add_argument("--max-archive-size",
+                                   help="If passed, the size (e.g. '500M', '4G') that archives are filled up to. \
+                                   Bigger directories are split over several archives, and directories of less than a \
+                                   quarter of this are packed together with their neighbours. Defaults to 2G.")
+    arg_parser_backup.add_argument("--direct-upload-threshold",
+                                   help="If passed, files of at least this size (e.g. '500M') are uploaded as they \
+                                   are, straight from the backup directory, rather than copied into a zip archive \
+                                   first. Defaults to 1G.")
     arg_parser_backup.add_argument("-x", "--max-files",
                                    help="If passed, the maximum amount of files that should exist in a single archive\
                                     before a subsequent archive is created to continue backing up the directory.\
                                      Use with directories with large numbers of files")
+    arg_parser_backup.add_argument("--single-upload-threshold",
+                                   help="If passed, archives smaller than this (e.g. '100M') are uploaded in a single \
+                                   request instead of as a multipart upload. Defaults to 100M.")
+    arg_parser_backup.add_argument("--upload-threads",
+                                   help="If passed, the number of parts that will be uploaded at once. Defaults to 5.",
+                                   type=int)
+    arg_parser_backup.add_argument("--adaptive-upload-threads",
+                                   help="If passed, the number of parts uploaded at once is tuned to the link, up to \
+                                   --upload-threads, backing off when AWS throttles requests.",
+                                   action='store_true')
+    arg_parser_backup.add_argument("--max-upload-rate",
+                                   help="If passed, the most bytes per second (e.g. '512K', '2M') that will be \
+                                   uploaded, across all of the upload threads. 'stable' holds the rate just under \
+                                   what the link can manage. Different rates for different times of day can be set \
+                                   with 'upload_rate_schedule' in the config file.")
+    arg_parser_backup.add_argument("--scan-threads",
+                                   help="If passed, the number of directories that will be read at once while \
+                                   scanning the tree. Raising it helps on network mounts such as NFS. Defaults to 1.",
+                                   type=int)
+    arg_parser_backup.add_argument("--compression",
+                                   help="How files are compressed in the archives. 'auto' stores media that is \
+                                   compressed already, deflates text and uncompressed audio, and tries a sample of \
+                                   anything else to see whether it's worth compressing. Defaults to auto.",
+                                   choices=["auto", "store", "deflate"])
+    arg_parser_backup.add_argument("--archive-workers",
+                                   help="If passed, the number of processes that will create archives at once. \
+                                   Defaults to 1.",
+                                   type=int)
+    arg_parser_backup.add_argument("--temp-space-limit",
+                                   help="If passed, the most data (e.g. '500M', '20G') that will be held in the \
+                                   temporary directory at once. Archiving waits for uploads to free up space when \
+                                   the limit is reached.")
 
     arg_parser_retrieve = subparsers.add_parser('retrieve',
                                                 help="Retrieve a directory tree from the specified vault and download \
@@ -65,12 +130,32 @@ def __parse_cmd_args(options_namespace):
     arg_parser_retrieve.add_argument("-r", '--top_path',
                                      help="The relative directory of the top directory to download. Use --list for a \
                                      list of directories available.")
+    arg_parser_retrieve.add_argument("-f", '--file',
+                                     help="The relative path of a single file to retrieve. Only the part of its \
+                                     archive that holds the file is retrieved.")
     arg_parser_retrieve.add_argument('--download_location',
                                      help="The local directory to download the file tree to.")
     arg_parser_retrieve.add_argument("--temp-dir",
                                      help="If passed, the specified directory will be used to store temporary upload and \
                                             download chunks. Use when the drive with the default tempdir has little \
                                             available space")
+    arg_parser_retrieve.add_argument("--download-threads",
+                                     help="If passed, the number of ranges of an archive that will be downloaded at \
+                                     once. Defaults to 4.",
+                                     type=int)
+    arg_parser_retrieve.add_argument("--tier",
+                                     help="The retrieval tier to use. Expedited retrievals are ready in minutes, \
+                                     Standard ones in hours and Bulk ones in up to half a day, for less. Defaults to \
+                                     Standard.",
+                                     choices=["Expedited", "Standard", "Bulk"])
+    arg_parser_retrieve.add_argument("--parallel-archives",
+                                     help="If passed, the number of archives that will be downloaded at once. \
+                                     Defaults to 2.",
+                                     type=int)
+    arg_parser_retrieve.add_argument("--extract",
+                                     help="If passed, the archives are unzipped into the download location as they \
+                                     download, rather than being saved as zip files.",
+                                     action='store_true')
     arg_parser_retrieve.add_argument('--list',
                                      help="Print a list of the directories available for download.",
                                      action='store_true',
@@ -82,6 +167,12 @@ def __parse_cmd_args(options_namespace):
     arg_parser_new_vault.add_argument('new_vault_name',
                                       help='The name of the new vault to create.')
 
+    arg_parser_check_indexes = subparsers.add_parser('check-indexes',
+                                                     help="Report any of the tracking database's frequent queries \
+                                                     that are not using an index.")
+    arg_parser_check_indexes.add_argument("-n", '--vault_name',
+                                          help='The name of the vault to check the queries against.')
+
     arg_parser_new_config = subparsers.add_parser('sample-config',
                                                   help="Create a sample configuration file that can be passed to Cupo \
                                                   by --config-file.")
@@ -123,6 +214,21 @@ def parse_args():
     return cmd_opts
 
 
+def parse_size(size):
+    """
+    Convert a size such as 1048576, "1048576", "512K", "20M" or "2G" into a number of bytes.
+    :return: The size in bytes, or 0 if no size was given
+    """
+    if not size:
+        return 0
+
+    size = str(size).strip().upper()
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
 def create_config_file(file_location):
     config_opts = {"database": "",
                    "vault_name": "",
@@ -132,7 +238,21 @@ def create_config_file(file_location):
                    "logging_dir": "",
                    "backup_directory": "",
                    "temp_dir":"",
-                   "max_files": 999
+                   "work_dir": "",
+                   "max_files": "",
+                   "max_archive_size": "2G",
+                   "direct_upload_threshold": "1G",
+                   "temp_space_limit": "",
+                   "archive_workers": 1,
+                   "scan_threads": 1,
+                   "compression": "auto",
+                   "single_upload_threshold": "100M",
+                   "upload_threads": 5,
+                   "adaptive_upload_threads": False,
+                   "max_upload_rate": "",
+                   "upload_rate_schedule": [],
+                   "keep_versions": 3,
+                   "min_age_days": 93
                    }
 
     with open(file_location, "w") as f:
@@ -0,0 +1,79 @@
+import logging
+import os, os.path
+import zipfile
+import zlib
+
+# Compression policies
+AUTO = "auto"  # Decide file by file
+STORE = "store"  # Never compress
+DEFLATE = "deflate"  # Always compress
+POLICIES = (AUTO, STORE, DEFLATE)
+DEFAULT_POLICY = AUTO
+
+# Formats that are compressed already - deflating them again costs CPU and saves nothing
+STORED_EXTENSIONS = frozenset([
+    ".mp3", ".aac", ".m4a", ".mp4", ".m4v", ".ogg", ".oga", ".opus", ".flac", ".wma", ".wmv", ".mov", ".mkv", ".avi",
+    ".mpg", ".mpeg", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar",
+    ".zst", ".lz4",
+])
+
+# Formats that are known to compress well
+DEFLATED_EXTENSIONS = frozenset([
+    ".txt", ".log", ".csv", ".xml", ".json", ".html", ".htm", ".m3u", ".m3u8", ".pls", ".xspf", ".cue", ".wav",
+    ".bwf", ".aif", ".aiff",
+])
+
+# How much of a file of any other type is compressed to see whether the rest of it is worth compressing
+PROBE_SAMPLE_SIZE = 65536
+# Files that don't shrink to below this fraction of their size in the probe are stored
+PROBE_RATIO_THRESHOLD = 0.9
+
+logger = logging.getLogger("cupobackup{0}.compression".format(os.getpid()))
+
+
+def choose_compress_type(path, policy=DEFAULT_POLICY):
+    """
+    Choose how a file should be stored in an archive. Under the AUTO policy, the file's extension decides if it's one
+    that is known to compress well (or not at all); otherwise a sample of the file is compressed to find out.
+    Python 2's zipfile can only store or deflate, so those are the only choices.
+    :return: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    """
+    if policy == STORE:
+        return zipfile.ZIP_STORED
+    if policy == DEFLATE:
+        return zipfile.ZIP_DEFLATED
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    if extension in DEFLATED_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+
+    if is_compressible(path):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+def is_compressible(path):
+    """
+    Compress samples from the start and the middle of a file with the fastest zlib level, and see how much they shrink.
+    """
+    sample_size = PROBE_SAMPLE_SIZE // 2
+    try:
+        with open(path, "rb") as f:
+            sample = f.read(sample_size)
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            if file_size > sample_size * 2:
+                f.seek(file_size // 2)
+                sample += f.read(sample_size)
+    except IOError, e:
+        logger.debug("Could not probe {0} - '{1}'".format(path, e))
+        return False
+
+    if not sample:
+        return False
+
+    ratio = float(len(zlib.compress(sample, 1))) / len(sample)
+    logger.debug("Probe of {0} compressed to {1:.0%}".format(path, ratio))
+    return ratio < PROBE_RATIO_THRESHOLD
@@ -0,0 +1,70 @@
+import logging
+import os
+import threading
+import mongoops
+
+# How far a run has got with each directory
+SCANNED = "scanned"
+ARCHIVED = "archived"
+UPLOADED = "uploaded"
+PRUNED = "pruned"
+UNCHANGED = "unchanged"  # The directory hadn't changed since its last upload, so there was nothing to do
+
+
+class RunJournal():
+    """
+    A record in the tracking database of each directory's progress through a backup run, so that a run that was
+    interrupted can be picked up where it stopped, instead of scanning, zipping and hashing everything again.
+    """
+
+    def __init__(self, db, vault, run):
+        """
+        :param run: The run's document from the 'runs' collection
+        """
+        self.db = db
+        self.vault = vault
+        self.run = run
+        self.run_id = run["_id"]
+        self.logger = logging.getLogger("cupobackup{0}.RunJournal".format(os.getpid()))
+
+        self._lock = threading.Lock()
+        self.entries = {}
+        for entry in mongoops.get_journal_entries(db, self.run_id):
+            self.entries[entry["path"]] = entry
+
+    @classmethod
+    def start(cls, db, vault, root_dir, run_dir):
+        """
+        Begin the journal of a new run. Any earlier runs of `root_dir` that didn't finish are abandoned.
+        """
+        mongoops.abandon_unfinished_runs(db, vault, root_dir)
+        run_id = mongoops.create_run(db, vault, root_dir, run_dir)
+        return cls(db, vault, {"_id": run_id, "root_dir": root_dir, "run_dir": run_dir})
+
+    @classmethod
+    def resume(cls, db, vault, root_dir):
+        """
+        :return: The journal of the last run of `root_dir` that didn't finish, or None if there isn't one
+        """
+        run = mongoops.get_unfinished_run(db, vault, root_dir)
+        if not run:
+            return None
+        return cls(db, vault, run)
+
+    def get(self, path):
+        with self._lock:
+            return self.entries.get(path)
+
+    def record(self, path, state, **fields):
+        mongoops.save_journal_entry(self.db, self.run_id, path, state, fields)
+        with self._lock:
+            entry = self.entries.setdefault(path, {"path": path})
+            entry.update(fields)
+            entry["state"] = state
+
+    def set_run_dir(self, run_dir):
+        mongoops.set_run_dir(self.db, self.run_id, run_dir)
+        self.run["run_dir"] = run_dir
+
+    def finish(self):
+        mongoops.finish_run(self.db, self.run_id)
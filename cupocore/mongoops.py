@@ -1,6 +1,8 @@
 import pymongo, pymongo.errors
+import bson.binary
 import time, datetime
-import logging, os
+import logging, os, os.path
+import re
 
 logger = logging.getLogger("cupobackup{0}.mongoOps".format(os.getpid()))
 
@@ -15,7 +17,24 @@ logger = logging.getLogger("cupobackup{0}.mongoOps".format(os.getpid()))
 #     "size": 123456789,
 #     "uploaded_time": 147258369,
 #     "aws_URI": "aws://AWS-ARCHIVE-URI-GOES-HERE-ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
-#     "to_delete": False
+#     "to_delete": False,
+#     "members": [{"name": "filename.mp3", "offset": 0, "size": 123456, "file_size": 123420}, ...]
+#                Where each file is in the archive - "offset" and "size" include its local header. Each "name" is
+#                relative to the directory that the archive's path is in.
+#     "dirs": ["/path/to/archived/subdir", ...]
+#                Only for a pack of small directories, which is catalogued under their parent - the directories whose
+#                files it holds
+#     "format": "raw"
+#                Only for a large file that was uploaded as it is, rather than in a zip archive. Its path is the file's
+#                own path.
+#     "source_mtime": 1472583690.5
+#                Only for a raw file - its mtime when it was uploaded
+#     "superseded_dirs": ["/path/to/archived/subdir", ...]
+#                The directories whose files a newer archive at another path now holds - for instance, after a pack of
+#                small directories has been split up differently. Their members aren't restored from this archive.
+#     "retired": 1
+#                Set once all of the archive's directories are superseded - it's no longer the latest version of
+#                its path
 # })
 #
 #
@@ -30,8 +49,169 @@ logger = logging.getLogger("cupobackup{0}.mongoOps".format(os.getpid()))
 #     "_id":                          "AWS-JOB-ID-abcdefghijklmnopqrstuvwxyz"
 #     "job_type":                     "retrieval"
 #     "job_retrieval_destination":    "/path/to/download" Only if job_type is 'retrieval'
+#     "tier":                         "Standard"          Only if job_type is 'retrieval'
+#     "retrieval_range":              [0, 1048575]        Only if retrieving part of an archive
+#     "member":                       {"name": ...}       The archive member being retrieved, as in db.archives
+#     "job_initiated_time":           0123456789
 #     "job_last_polled_time":         0123456789
 # })
+#
+#
+# db.manifests.insert_one({
+#     "vault_arn": "aws://AWS-VAULT-ARN-123456789",
+#     "path": "/path/to/archived/subdir",
+#     "files": [[Binary("filename.mp3"), 123456789, 1472583690.5, 987654], ...],  [name, size, mtime, inode]
+#              Each name is stored as binary, exactly as the file system gave it
+#     "updated_time": 147258369
+# })
+#
+#
+# db.runs.insert_one({
+#     "vault_arn": "aws://AWS-VAULT-ARN-123456789",
+#     "root_dir": "/path/to/top_dir",
+#     "run_dir": "/path/to/work_dir/vault name/run-abc123",
+#     "started_time": 147258369,
+#     "finished_time": None,     Set once the run has ended
+#     "state": "running"         'running', 'finished' or 'abandoned'
+# })
+#
+#
+# db.journal.insert_one({
+#     "run_id": ObjectId("..."),
+#     "path": "/path/to/archived/subdir",     Or the path of a pack of small directories: "/path/to/parent/first.pack"
+#     "state": "archived",       'scanned', 'archived', 'uploaded', 'pruned' or 'unchanged'
+#     "manifest": [[Binary("/path/to/archived/subdir"), [...]], ...],  The files of each directory, as in db.manifests
+#     "archives": [{"path": "/path/to/tmp/archive.3f2a9c1e.zip", "size": 123456789, "treehash": "..."}, ...],
+#     "updated_time": 147258369
+# })
+
+
+# The indexes that the tracking database's queries rely on, by collection. All of them are named with a "cupo_" prefix,
+# so that ensure_indexes() knows which indexes it owns and can replace them when their definition changes.
+INDEXES = {
+    "archives": [
+        # get_most_recent_version_of_archive, get_redundant_archive_ids, get_list_of_paths_in_vault,
+        # get_latest_archive_versions
+        ("cupo_vault_path_time", [("vault_arn", pymongo.ASCENDING), ("path", pymongo.ASCENDING),
+                                  ("to_delete", pymongo.ASCENDING), ("uploaded_time", pymongo.DESCENDING)]),
+        # get_latest_archive_versions, get_archive_containing_file - for packs of small directories
+        ("cupo_vault_dirs", [("vault_arn", pymongo.ASCENDING), ("dirs", pymongo.ASCENDING)]),
+        # get_archives_to_delete
+        ("cupo_vault_to_delete", [("vault_arn", pymongo.ASCENDING), ("to_delete", pymongo.ASCENDING)]),
+    ],
+    "vaults": [
+        # get_vault_by_name
+        ("cupo_name", [("name", pymongo.ASCENDING)]),
+        # get_vault_by_arn
+        ("cupo_arn", [("arn", pymongo.ASCENDING)]),
+    ],
+    "jobs": [
+        ("cupo_vault_type_polled", [("vault_arn", pymongo.ASCENDING), ("job_type", pymongo.ASCENDING),
+                                    ("job_last_polled_time", pymongo.ASCENDING)]),
+    ],
+    "mparts": [
+        # get_mpart_entries, delete_upload_mpart_entries
+        ("cupo_vault_upload_byte", [("vault_arn", pymongo.ASCENDING), ("uploadId", pymongo.ASCENDING),
+                                    ("first_byte", pymongo.ASCENDING)]),
+    ],
+    "manifests": [
+        # get_directory_manifest, save_directory_manifest
+        ("cupo_vault_path", [("vault_arn", pymongo.ASCENDING), ("path", pymongo.ASCENDING)]),
+    ],
+    "runs": [
+        # get_unfinished_run, abandon_unfinished_runs
+        ("cupo_vault_state_started", [("vault_arn", pymongo.ASCENDING), ("state", pymongo.ASCENDING),
+                                      ("started_time", pymongo.DESCENDING)]),
+    ],
+    "journal": [
+        # get_journal_entries, save_journal_entry
+        ("cupo_run_path", [("run_id", pymongo.ASCENDING), ("path", pymongo.ASCENDING)]),
+    ],
+}
+
+
+def ensure_indexes(db):
+    """
+    Create any of the indexes in INDEXES that are missing from the database, rebuild any whose definition has
+    changed, and drop any old "cupo_" indexes that are no longer used. Safe to run against new and existing databases.
+    """
+    for collection_name, indexes in INDEXES.iteritems():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        wanted_names = set()
+
+        for index_name, keys in indexes:
+            wanted_names.add(index_name)
+            if index_name in existing:
+                if [tuple(k) for k in existing[index_name]["key"]] == keys:
+                    continue
+                logger.info("Rebuilding index {0} on {1}".format(index_name, collection_name))
+                collection.drop_index(index_name)
+            else:
+                logger.info("Creating index {0} on {1}".format(index_name, collection_name))
+
+            collection.create_index(keys, name=index_name, background=True)
+
+        for index_name in existing:
+            if index_name.startswith("cupo_") and index_name not in wanted_names:
+                logger.info("Dropping unused index {0} on {1}".format(index_name, collection_name))
+                collection.drop_index(index_name)
+
+
+def _explain_hot_queries(db, vault_arn):
+    # Cursors shaped like each of the frequent queries. The values don't need to match anything - only the shape of
+    # the query matters to the query planner.
+    return [
+        ("get_most_recent_version_of_archive",
+         db["archives"].find({"path": "", "to_delete": 0, "vault_arn": vault_arn},
+                             sort=[('uploaded_time', pymongo.DESCENDING)]).limit(1)),
+        ("get_redundant_archive_ids",
+         db["archives"].find({"vault_arn": vault_arn, "to_delete": 0, "uploaded_time": {"$lt": 0}},
+                             sort=[("path", pymongo.ASCENDING), ("uploaded_time", pymongo.DESCENDING)])),
+        ("get_latest_archive_versions",
+         db["archives"].find({"vault_arn": vault_arn, "to_delete": 0,
+                              "$or": [{"path": {"$regex": _subtree_regex("x")}},
+                                      {"dirs": {"$regex": _subtree_regex("x")}}]})),
+        ("get_list_of_paths_in_vault",
+         db["archives"].find({"vault_arn": vault_arn}, projection={"path": True, "_id": False},
+                             sort=[("vault_arn", pymongo.ASCENDING), ("path", pymongo.ASCENDING)])),
+        ("get_archives_to_delete",
+         db["archives"].find({"vault_arn": vault_arn, "to_delete": 1}, projection={"_id": True})),
+        ("get_vault_by_name",
+         db["vaults"].find({"name": ""}).limit(1)),
+        ("get_directory_manifest",
+         db["manifests"].find({"vault_arn": vault_arn, "path": ""}).limit(1)),
+        ("get_retrieval_entries",
+         db["jobs"].find({"vault_arn": vault_arn, "job_type": "retrieval"},
+                         sort=[('job_last_polled_time', pymongo.ASCENDING)])),
+    ]
+
+
+def _plan_has_collection_scan(plan):
+    if plan.get("stage") == "COLLSCAN":
+        return True
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = children + [plan["inputStage"]]
+    for child in children:
+        if _plan_has_collection_scan(child):
+            return True
+    return False
+
+
+def find_collection_scans(db, vault=None):
+    """
+    Ask the query planner how each of the frequent queries would be run.
+    :param vault: The Vault to shape the queries for, if any
+    :return: A list of the names of the queries that would scan their whole collection rather than use an index
+    """
+    collection_scans = []
+    for query_name, cursor in _explain_hot_queries(db, vault.arn if vault else ""):
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        if _plan_has_collection_scan(winning_plan):
+            collection_scans.append(query_name)
+
+    return collection_scans
 
 
 def create_backup_database(database_name, db_client, drop_existing=True):
@@ -53,6 +233,9 @@ def create_backup_database(database_name, db_client, drop_existing=True):
         db.create_collection('vaults')
         db.create_collection('jobs')
         db.create_collection('mparts')
+        db.create_collection('manifests')
+        db.create_collection('runs')
+        db.create_collection('journal')
 
         return db
 
@@ -89,7 +272,8 @@ def create_vault_entry(db, vault_arn, vault_name):
 
 
 def create_archive_entry(db, archived_dir_path, vault_arn, aws_archive_id,
-                         archive_treehash, archive_size, aws_uri):
+                         archive_treehash, archive_size, aws_uri, archive_members=None, archive_dirs=None,
+                         archive_format=None, source_mtime=None):
     # Find an entry in the archives list that matches the path and vault arn
     # that we are uploading to..
     doc_arch = {}
@@ -101,46 +285,105 @@ def create_archive_entry(db, archived_dir_path, vault_arn, aws_archive_id,
     doc_arch["uploaded_time"] = time.time()
     doc_arch["aws_URI"] = aws_uri
     doc_arch["to_delete"] = 0
+    if archive_members is not None:
+        doc_arch["members"] = archive_members
+    if archive_dirs is not None:
+        doc_arch["dirs"] = archive_dirs
+    if archive_format is not None:
+        doc_arch["format"] = archive_format
+        doc_arch["source_mtime"] = source_mtime
 
     # Add the entry.
     return db['archives'].insert(doc_arch)
 
 
-def create_mpart_part_entry(db, vault_arn, uploadId, first_byte, last_byte, tmp_archive_location, arch_size,
-                            arch_checksum, subdir_rel_path):
+def _build_mpart_part_entry(vault_arn, uploadId, first_byte, last_byte, tmp_archive_location, arch_size,
+                            arch_checksum, subdir_rel_path, part_checksum=None, part_size=None, archive_format=None,
+                            source_mtime=None):
     doc_mpart = {}
     doc_mpart["uploadId"] = uploadId
+    doc_mpart["vault_arn"] = vault_arn
     doc_mpart["is_active"] = False
+    doc_mpart["lease_expires"] = 0
     doc_mpart["first_byte"] = first_byte
     doc_mpart["last_byte"] = last_byte
     doc_mpart["tmp_archive_location"] = tmp_archive_location
     doc_mpart["full_size"] = arch_size
     doc_mpart["full_hash"] = arch_checksum
     doc_mpart["subdir_rel_path"] = subdir_rel_path
+    doc_mpart["checksum"] = part_checksum  # The part's own tree hash, if it's known in advance
+    doc_mpart["part_size"] = part_size  # The part size that the multipart upload was initiated with
+    doc_mpart["archive_format"] = archive_format  # "raw" if a file is being uploaded as it is, rather than a zip
+    doc_mpart["source_mtime"] = source_mtime  # The mtime of a raw file when it was hashed
 
+    return doc_mpart
 
-    return db["mparts"].insert(doc_mpart)
 
+def create_mpart_part_entries(db, vault, uploadId, part_ranges, tmp_archive_location, arch_size, arch_checksum,
+                              subdir_rel_path, part_checksums=None, part_size=None, archive_format=None,
+                              source_mtime=None):
+    """
+    Register every part of a multipart upload in one round trip.
+    :param part_ranges: A list of (first_byte, last_byte) tuples, one for each part
+    :param part_checksums: If known, a list of the tree hash of each part
+    :param part_size: The part size that the multipart upload was initiated with
+    :param archive_format: "raw" if a file is being uploaded as it is, rather than a zip archive
+    :param source_mtime: The mtime of a raw file when it was hashed
+    :return: The list of part documents, with their "_id"s filled in
+    """
+    if not part_checksums:
+        part_checksums = [None] * len(part_ranges)
 
-# TODO: Make this correct
-def get_oldest_inactive_mpart_entry(db, vault_name):
-    vault = get_vault_by_name(db, vault_name)
-    return db["mparts"].find_one(
-        {"is_active": False},
-        sort=[('first_byte', pymongo.ASCENDING)])
+    docs_mpart = [_build_mpart_part_entry(vault.arn, uploadId, first_byte, last_byte, tmp_archive_location, arch_size,
+                                          arch_checksum, subdir_rel_path, part_checksum, part_size, archive_format,
+                                          source_mtime)
+                  for (first_byte, last_byte), part_checksum in zip(part_ranges, part_checksums)]
 
+    if docs_mpart:
+        db["mparts"].insert_many(docs_mpart)
+    return docs_mpart
 
-def set_mpart_active(db, mpart_id):
-    db["mparts"].find_one_and_update({"_id": mpart_id},
-                                     {"$set":
-                                          {"is_active": True}
-                                      })
+
+def _claimable_mpart_filter():
+    # A part can be claimed if nobody is uploading it, or if whoever was has let their lease run out
+    return {"$or": [{"is_active": False},
+                    {"lease_expires": {"$lt": time.time()}}]}
+
+
+def claim_mpart(db, mpart_id, lease_seconds):
+    """
+    Atomically mark a part as being uploaded, for `lease_seconds`.
+    :return: The part's document, or None if somebody else holds it
+    """
+    query = _claimable_mpart_filter()
+    query["_id"] = mpart_id
+    return db["mparts"].find_one_and_update(query,
+                                            {"$set":
+                                                 {"is_active": True,
+                                                  "lease_expires": time.time() + lease_seconds}
+                                             },
+                                            return_document=pymongo.ReturnDocument.AFTER)
+
+
+def renew_mpart_leases(db, mpart_ids, lease_seconds):
+    """
+    Extend the leases of parts that are still being uploaded, for another `lease_seconds` from now.
+    """
+    if not mpart_ids:
+        return 0
+    return db["mparts"].update_many({"_id": {"$in": list(mpart_ids)}, "is_active": True},
+                                    {"$set": {"lease_expires": time.time() + lease_seconds}}).modified_count
+
+
+def get_mpart_entry(db, mpart_id):
+    return db["mparts"].find_one({"_id": mpart_id})
 
 
 def set_mpart_inactive(db, mpart_id):
     db["mparts"].find_one_and_update({"_id": mpart_id},
                                      {"$set":
-                                          {"is_active": False}
+                                          {"is_active": False,
+                                           "lease_expires": 0}
                                       })
 
 
@@ -148,17 +391,47 @@ def delete_mpart_entry(db, mpart_id):
     return db["mparts"].delete_one({"_id": mpart_id})
 
 
-def is_existing_mparts_remaining(db, vault_name, uploadId):
-    vault = get_vault_by_name(db, vault_name)
-    p = db["mparts"].find_one(
-        {"uploadId": uploadId})
-    if not p:
-        return False
-    else:
-        return True
+def delete_mpart_entries(db, mpart_ids):
+    if not mpart_ids:
+        return 0
+    return db["mparts"].delete_many({"_id": {"$in": list(mpart_ids)}}).deleted_count
+
+
+def delete_upload_mpart_entries(db, vault, uploadId):
+    return db["mparts"].delete_many({"vault_arn": vault.arn, "uploadId": uploadId}).deleted_count
 
 
-def create_retrieval_entry(db, vault_arn, archive_id, aws_job_id, aws_job_location, download_path):
+def get_mpart_entries(db, vault, uploadId):
+    return list(db["mparts"].find({"vault_arn": vault.arn, "uploadId": uploadId},
+                                  sort=[('first_byte', pymongo.ASCENDING)]))
+
+
+def get_pending_uploads(db, vault):
+    """
+    Find the multipart uploads in a vault that still have parts waiting to be uploaded - for instance, because an
+    earlier run was interrupted.
+    :return: A list of documents, one for each upload, with the uploadId as their "_id", and the
+    "tmp_archive_location", "full_size", "full_hash", "subdir_rel_path", "part_size", "archive_format" and
+    "source_mtime" of the upload.
+    "leased_parts" counts the parts that somebody is uploading right now.
+    """
+    is_leased = {"$and": ["$is_active", {"$gt": ["$lease_expires", time.time()]}]}
+    pipeline = [{"$match": {"vault_arn": vault.arn}},
+                {"$group": {"_id": "$uploadId",
+                            "tmp_archive_location": {"$first": "$tmp_archive_location"},
+                            "full_size": {"$first": "$full_size"},
+                            "full_hash": {"$first": "$full_hash"},
+                            "subdir_rel_path": {"$first": "$subdir_rel_path"},
+                            "part_size": {"$first": "$part_size"},
+                            "archive_format": {"$first": "$archive_format"},
+                            "source_mtime": {"$first": "$source_mtime"},
+                            "leased_parts": {"$sum": {"$cond": [is_leased, 1, 0]}}}}]
+
+    return list(db["mparts"].aggregate(pipeline))
+
+
+def create_retrieval_entry(db, vault_arn, archive_id, aws_job_id, aws_job_location, download_path, tier="Standard",
+                           retrieval_range=None, member=None):
     doc_entry = {}
     doc_entry["_id"] = aws_job_id
     doc_entry["location"] = aws_job_location
@@ -166,7 +439,12 @@ def create_retrieval_entry(db, vault_arn, archive_id, aws_job_id, aws_job_locati
     doc_entry["job_type"] = "retrieval"
     doc_entry["job_retrieval_destination"] = download_path
     doc_entry["archive_id"] = archive_id
-    doc_entry["job_last_polled_time"] = time.time()
+    doc_entry["tier"] = tier
+    doc_entry["job_initiated_time"] = time.time()
+    doc_entry["job_last_polled_time"] = doc_entry["job_initiated_time"]
+    if retrieval_range:
+        doc_entry["retrieval_range"] = list(retrieval_range)
+        doc_entry["member"] = member
 
     return db['jobs'].insert_one(doc_entry)
 
@@ -175,63 +453,265 @@ def delete_retrieval_entry(db, entry_id):
     return db["jobs"].delete_one({"_id": entry_id})
 
 
-def get_oldest_retrieval_entry(db, vault_name):
-    vault = get_vault_by_name(db, vault_name)
-    return db["archives"].find_one(
-        {"job_type": "retrieval"},
-        sort=[('uploaded_time', pymongo.ASCENDING)])
+def get_retrieval_entries(db, vault):
+    """
+    :return: Every outstanding retrieval job in the vault, least recently polled first
+    """
+    return list(db["jobs"].find({"vault_arn": vault.arn, "job_type": "retrieval"},
+                                sort=[('job_last_polled_time', pymongo.ASCENDING)]))
 
 
-def get_list_of_paths_in_vault(db, vault_name):
-    vault = get_vault_by_name(db, vault_name)
-    archives = db["archives"].distinct("path", {"vault_arn": vault["arn"]})
+def set_retrieval_entries_polled(db, entry_ids):
+    if not entry_ids:
+        return 0
+    return db["jobs"].update_many({"_id": {"$in": list(entry_ids)}},
+                                  {"$set": {"job_last_polled_time": time.time()}}).modified_count
 
-    return archives
+
+def get_list_of_paths_in_vault(db, vault):
+    """
+    Iterate over the distinct archive paths in a vault, in order. The paths are read from the path index with a
+    cursor, so they're never all held in memory at once.
+    """
+    cursor = db["archives"].find({"vault_arn": vault.arn},
+                                 projection={"path": True, "_id": False},
+                                 sort=[("vault_arn", pymongo.ASCENDING), ("path", pymongo.ASCENDING)])
+
+    last_path = None
+    for arch in cursor:
+        if arch["path"] != last_path:
+            last_path = arch["path"]
+            yield last_path
 
 
-def get_most_recent_version_of_archive(db, vault_name, path):
-    vault_arn = get_vault_by_name(db, vault_name)["arn"]
+def get_most_recent_version_of_archive(db, vault, path):
     return db["archives"].find_one(
-        {"path": path, "to_delete": 0, "vault_arn": vault_arn},
+        {"path": path, "to_delete": 0, "vault_arn": vault.arn},
         sort=[('uploaded_time', pymongo.DESCENDING)])
 
 
-def get_old_archives(db, archived_dir_path, vault_name):
-    vault_arn = get_vault_by_name(db, vault_name)["arn"]
+def get_latest_archive_versions(db, vault, under_path=None):
+    """
+    Find the most recent version of every archive in a vault, in one aggregation.
+    :param under_path: If given, only find the archives of this directory and the directories below it - including
+    packs that hold any of those directories
+    :return: A cursor of documents holding the archive's path (as "_id"), "archive_id", "treehash", "size",
+    "uploaded_time", and the "format" and "source_mtime" of raw files. Paths whose latest archive has been retired
+    are left out.
+    """
+    match = {"vault_arn": vault.arn, "to_delete": 0}
+    if under_path and under_path.rstrip("/"):
+        match["$or"] = [{"path": {"$regex": _subtree_regex(under_path)}},
+                        {"dirs": {"$regex": _subtree_regex(under_path)}}]
+
+    return db["archives"].aggregate([
+        {"$match": match},
+        {"$sort": {"path": pymongo.ASCENDING, "uploaded_time": pymongo.DESCENDING}},
+        {"$group": {"_id": "$path",
+                    "archive_id": {"$first": "$_id"},
+                    "treehash": {"$first": "$treehash"},
+                    "size": {"$first": "$size"},
+                    "uploaded_time": {"$first": "$uploaded_time"},
+                    "format": {"$first": "$format"},
+                    "source_mtime": {"$first": "$source_mtime"},
+                    "retired": {"$first": "$retired"}}},
+        {"$match": {"retired": {"$ne": 1}}}
+    ], allowDiskUse=True)
+
+
+def supersede_archives(db, vault, dirs, current_paths):
+    """
+    Record that the files of `dirs` are now held by the archives at `current_paths`, so that no other archive is
+    restored for those directories. An archive is retired once every directory that it holds has been superseded.
+    :param dirs: The directories that have just been backed up, relative to the top_dir
+    :param current_paths: The paths of the archives that now hold their files
+    :return: The number of archives updated
+    """
+    # Directories come back from the database as unicode
+    dirs = set(d.decode("utf-8") if isinstance(d, str) else d for d in dirs)
+    if not dirs:
+        return 0
+
+    # A pack lists the directories that it holds; any other archive holds the files of the directory it's in
+    holds_dirs = [{"dirs": {"$in": list(dirs)}}]
+    holds_dirs.extend({"dirs": {"$exists": False},
+                       "path": {"$regex": "^{0}[^/]+$".format(re.escape(os.path.join(d, "")))}}
+                      for d in dirs)
+    cursor = db["archives"].find({"vault_arn": vault.arn, "to_delete": 0, "retired": {"$ne": 1},
+                                  "path": {"$nin": list(current_paths)}, "$or": holds_dirs},
+                                 projection={"path": True, "dirs": True, "superseded_dirs": True})
+
+    updates = []
+    for arch in cursor:
+        archive_dirs = set(arch.get("dirs") or [os.path.dirname(arch["path"])])
+        superseded_dirs = set(arch.get("superseded_dirs", [])) | (archive_dirs & dirs)
+        update = {"superseded_dirs": sorted(superseded_dirs)}
+        if superseded_dirs >= archive_dirs:
+            update["retired"] = 1
+        updates.append(pymongo.UpdateOne({"_id": arch["_id"]}, {"$set": update}))
+
+    if not updates:
+        return 0
+    return db["archives"].bulk_write(updates, ordered=False).modified_count
+
+
+def _subtree_regex(path):
+    # Matches `path` itself and every path below it. It's anchored at the start, so it's still answered from the path
+    # index rather than by testing every path in the vault.
+    return "^" + re.escape(path.rstrip("/")) + "(/|$)"
 
-    deadline_dt = datetime.datetime.utcnow() - datetime.timedelta(days=93)
+
+def get_redundant_archive_ids(db, vault, keep_versions, min_age_days):
+    """
+    Find every archive in a vault that is no longer needed, in one aggregation over the whole vault. An archive is
+    redundant once it's more than `min_age_days` old, and there are `keep_versions` more recent versions of its path
+    that are also that old. A retired archive - one whose directories are all held by newer archives at other paths -
+    never gets any more versions of its own path, so it's redundant as soon as it's more than `min_age_days` old.
+    :return: A generator of the IDs of the redundant archives
+    """
+    deadline_dt = datetime.datetime.utcnow() - datetime.timedelta(days=min_age_days)
     deadline_ts = time.mktime(deadline_dt.timetuple())
-    cursor = db["archives"].find({"to_delete": 0,
-                                  "path": archived_dir_path,
-                                  "vault_arn": vault_arn,
-                                  "uploaded_time":
-                                      {"$lt": deadline_ts}
-                                  },
-                                 sort=[("uploaded_time", pymongo.DESCENDING)],
-                                 skip=3)
-
-    old_archives = []
-    for arch in cursor: old_archives.append(arch)
-    return old_archives
-
-
-def mark_archive_for_deletion(db, archive_id):
-    db["archives"].find_one_and_update({"_id": archive_id},
-                                       {"$set":
-                                            {"to_delete": 1}
-                                        })
-
-
-def get_archives_to_delete(db):
-    cursor = db["archives"].find({"to_delete": 1})
-    redundant_archives = []
-    for arch in cursor:
-        redundant_archives.append(arch)
 
-    return redundant_archives
+    cursor = db["archives"].aggregate([
+        {"$match": {"vault_arn": vault.arn, "to_delete": 0, "uploaded_time": {"$lt": deadline_ts}}},
+        {"$sort": {"path": pymongo.ASCENDING, "uploaded_time": pymongo.DESCENDING}},
+        {"$group": {"_id": "$path",
+                    "archive_ids": {"$push": "$_id"}}},
+        # Only the paths with more old versions than are kept
+        {"$match": {"archive_ids.{0}".format(keep_versions): {"$exists": True}}},
+        {"$project": {"redundant_ids": {"$slice": ["$archive_ids", keep_versions, {"$size": "$archive_ids"}]}}}
+    ], allowDiskUse=True)
+
+    for path_versions in cursor:
+        for archive_id in path_versions["redundant_ids"]:
+            yield archive_id
+
+    for arch in db["archives"].find({"vault_arn": vault.arn, "to_delete": 0, "retired": 1,
+                                     "uploaded_time": {"$lt": deadline_ts}},
+                                    projection={"_id": True}):
+        yield arch["_id"]
+
+
+def mark_archives_for_deletion(db, archive_ids):
+    if not archive_ids:
+        return 0
+
+    return db["archives"].update_many({"_id": {"$in": list(archive_ids)}},
+                                      {"$set":
+                                           {"to_delete": 1}
+                                       }).modified_count
+
+
+def get_archives_to_delete(db, vault):
+    """
+    :return: A cursor of the archives in a vault that have been marked for deletion
+    """
+    return db["archives"].find({"vault_arn": vault.arn, "to_delete": 1}, projection={"_id": True})
+
+
+def _encode_manifest(manifest):
+    # File names are stored as binary, so that they come back as the same byte strings that scanning the directory
+    # gives - whatever their encoding
+    return [[bson.binary.Binary(entry[0])] + list(entry[1:]) for entry in manifest]
+
+
+def _decode_manifest(manifest):
+    return [[_decode_name(entry[0])] + list(entry[1:]) for entry in manifest]
+
+
+def _decode_name(name):
+    # Manifests saved before names were stored as binary hold them as UTF-8 strings
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return str(name)
 
 
-def get_archive_by_path(db, vault_name, path, retrieve_subpath_archs=False):
+def get_directory_manifest(db, vault, path):
+    """
+    :return: The stored manifest document of a directory, with its "files" in the form that save_directory_manifest
+    was given them, or None
+    """
+    doc_manifest = db["manifests"].find_one({"vault_arn": vault.arn, "path": path})
+    if doc_manifest:
+        doc_manifest["files"] = _decode_manifest(doc_manifest["files"])
+    return doc_manifest
+
+
+def save_directory_manifest(db, vault, path, manifest):
+    """
+    Store the file manifest of an archived directory, replacing any manifest from a previous upload.
+    :param path: The path of the directory, relative to the top_dir that was backed up.
+    :param manifest: A list of [name, size, mtime, inode] entries, one for each file in the directory
+    """
+    return db["manifests"].update_one({"vault_arn": vault.arn, "path": path},
+                                      {"$set":
+                                           {"files": _encode_manifest(manifest),
+                                            "updated_time": time.time()}
+                                       },
+                                      upsert=True)
+
+
+def create_run(db, vault, root_dir, run_dir):
+    doc_run = {}
+    doc_run["vault_arn"] = vault.arn
+    doc_run["root_dir"] = root_dir
+    doc_run["run_dir"] = run_dir
+    doc_run["started_time"] = time.time()
+    doc_run["finished_time"] = None
+    doc_run["state"] = "running"
+
+    return db["runs"].insert_one(doc_run).inserted_id
+
+
+def get_unfinished_run(db, vault, root_dir):
+    """
+    :return: The most recently started run of `root_dir` to the vault that never finished, or None
+    """
+    return db["runs"].find_one({"vault_arn": vault.arn, "state": "running", "root_dir": root_dir},
+                               sort=[("started_time", pymongo.DESCENDING)])
+
+
+def set_run_dir(db, run_id, run_dir):
+    db["runs"].update_one({"_id": run_id}, {"$set": {"run_dir": run_dir}})
+
+
+def finish_run(db, run_id, state="finished"):
+    db["runs"].update_one({"_id": run_id}, {"$set": {"state": state, "finished_time": time.time()}})
+
+
+def abandon_unfinished_runs(db, vault, root_dir):
+    """
+    Give up on every unfinished run of `root_dir` to the vault, so that none of them will be resumed.
+    """
+    return db["runs"].update_many({"vault_arn": vault.arn, "state": "running", "root_dir": root_dir},
+                                  {"$set": {"state": "abandoned", "finished_time": time.time()}}).modified_count
+
+
+def get_journal_entries(db, run_id):
+    for entry in db["journal"].find({"run_id": run_id}):
+        if "manifest" in entry:
+            entry["manifest"] = [[_decode_name(subdir), _decode_manifest(manifest)]
+                                 for subdir, manifest in entry["manifest"]]
+        yield entry
+
+
+def save_journal_entry(db, run_id, path, state, fields=None):
+    """
+    Record how far a run has got with a directory.
+    :param fields: Any other fields to store with the entry, such as its "manifest" or "archives"
+    """
+    update = dict(fields or {})
+    if "manifest" in update:
+        update["manifest"] = [[bson.binary.Binary(subdir), _encode_manifest(manifest)]
+                              for subdir, manifest in update["manifest"]]
+    update["state"] = state
+    update["updated_time"] = time.time()
+    return db["journal"].update_one({"run_id": run_id, "path": path},
+                                    {"$set": update},
+                                    upsert=True)
+
+
+def get_archive_by_path(db, vault, path, retrieve_subpath_archs=False):
     """
     Will attempt to find the most recent version of an archive representing a given path.
     If retrieve_subpath_archs is True, then will also retrieve latest versions of archives representing
@@ -243,34 +723,54 @@ def get_archive_by_path(db, vault_name, path, retrieve_subpath_archs=False):
     """
 
     if not retrieve_subpath_archs:
-        get_most_recent_version_of_archive(db, vault_name, path)
-
-    else:
-        # When trying to find subdirectories, the daft assumption that we make is that the 'path' of the archive will
-        # start with `path` and be longer than `path`. It'll work for now, but seems inelegant...
-
-        path_list = get_list_of_paths_in_vault(db, vault_name)
+        return get_most_recent_version_of_archive(db, vault, path)
 
-        subdir_list = []
-        while len(path_list):
-            cur_path = path_list.pop()
-            if cur_path.startswith(path) and len(cur_path) >= len(path):
-                subdir_list.append(cur_path)
+    return [{"_id": version["archive_id"],
+             "path": version["_id"],
+             "treehash": version["treehash"],
+             "size": version["size"],
+             "uploaded_time": version["uploaded_time"]}
+            for version in get_latest_archive_versions(db, vault, path)]
 
-        arch_list = []
-        for subdir in subdir_list:
-            arch = get_most_recent_version_of_archive(db, vault_name, subdir)
-            if arch: arch_list.append(arch)
 
-        return arch_list
+def get_archive_containing_file(db, vault, file_path):
+    """
+    Find the most recent archive that holds a given file.
+    :param file_path: The path of the file, relative to the top_dir that was backed up.
+    :return: The archive's document, or None
+    """
+    dir_path, file_name = os.path.split(file_path)
+    # A directory's archives are stored directly under its path, as <dir>/<name>.<key>.zip. A pack of small directories
+    # is stored under their parent, and names its members by their path from there. A large file that was uploaded
+    # raw is an archive of its own.
+    path_pattern = "^{0}[^/]+$".format(re.escape(os.path.join(dir_path, "")))
+    return db["archives"].find_one({"vault_arn": vault.arn,
+                                    "to_delete": 0,
+                                    "superseded_dirs": {"$ne": dir_path},
+                                    "$or": [{"path": {"$regex": path_pattern},
+                                             "members.name": file_name},
+                                            {"dirs": dir_path,
+                                             "members.name": os.path.join(os.path.basename(dir_path), file_name)},
+                                            {"path": file_path,
+                                             "format": "raw"}]},
+                                   sort=[("uploaded_time", pymongo.DESCENDING)])
 
 
 def get_archive_by_id(db, archive_id):
     return db["archives"].find_one({"_id": archive_id})
 
 
-def delete_archive_document(db, archive_id):
-    db["archives"].find_one_and_delete({"_id": archive_id})
+def delete_archive_documents(db, archive_ids):
+    """
+    Delete many archive documents with one unordered bulk write.
+    :return: The number of documents deleted
+    """
+    if not archive_ids:
+        return 0
+
+    result = db["archives"].bulk_write([pymongo.DeleteOne({"_id": archive_id}) for archive_id in archive_ids],
+                                       ordered=False)
+    return result.deleted_count
 
 
 def get_vault_by_name(db, vault_name):
@@ -281,6 +781,31 @@ def get_vault_by_arn(db, vault_arn):
     return db['vaults'].find_one({"arn": vault_arn})
 
 
+class Vault():
+    """
+    A handle on a vault that's registered in the tracking database. A vault's ARN never changes, so it's looked up
+    once with get_vault() and then the handle is passed to the managers and query functions that need it.
+    """
+
+    def __init__(self, name, arn, vault_id=None):
+        self.name = name
+        self.arn = arn
+        self.vault_id = vault_id
+
+    def __repr__(self):
+        return "Vault({0!r}, {1!r})".format(self.name, self.arn)
+
+
+def get_vault(db, vault_name):
+    """
+    :return: A Vault handle for the vault called `vault_name`, or None if no such vault is registered
+    """
+    vault_entry = get_vault_by_name(db, vault_name)
+    if not vault_entry:
+        return None
+    return Vault(vault_entry["name"], vault_entry["arn"], vault_entry["_id"])
+
+
 def connect(database_name, host="localhost", port=27017):
     mongodb_uri = "{host}:{port}".format(host=host, port=port)
     client = pymongo.MongoClient(mongodb_uri)
@@ -290,6 +815,9 @@ def connect(database_name, host="localhost", port=27017):
     else:
         db = create_backup_database(database_name, client)
 
+    if db is not None:
+        ensure_indexes(db)
+
     return client, db
 
 
@@ -0,0 +1,96 @@
+import hashlib
+import os.path
+
+DEFAULT_ARCHIVE_SIZE = 2 * 1024 ** 3
+
+# Directories holding less than this fraction of the archive size are packed in with their neighbours
+SMALL_DIRECTORY_FRACTION = 4
+
+PACK_SUFFIX = ".pack"
+
+# The name of the pack that holds the first of a parent's small directories, before any directory that starts a pack
+FIRST_PACK_NAME = "_" + PACK_SUFFIX
+
+# Files at least this big are uploaded as they are, rather than copied into a zip archive first
+DEFAULT_DIRECT_UPLOAD_THRESHOLD = 1024 ** 3
+
+
+def plan_archive_units(subdirs, snapshot=None, archive_size=None, direct_upload_threshold=None):
+    """
+    Decide which directories are archived together. Each directory is archived on its own, unless it holds only a
+    small fraction of `archive_size` - small directories that share a parent are packed together into archives of up
+    to `archive_size`, so that a directory of cue sheets doesn't cost a Glacier archive (and request) of its own.
+
+    Packs are filled with sibling directories in the order of their names. Each pack starts at a directory picked by a
+    hash of its name, and is named after it, so adding or removing a directory only changes the pack that it's in -
+    the other packs keep their directories and their names. A pack that would go over `archive_size` is split again.
+
+    :param snapshot: The treescan.TreeSnapshot that the directories were found in. Without one, the size of the
+    directories isn't known, and nothing is packed.
+    :param direct_upload_threshold: Files at least this big are uploaded on their own, so they don't count towards the
+    size of their directory
+    :return: A list of dicts, one for each archive unit, holding:
+        "key": The unit's name in the run's journal - the directory's path, for a directory on its own
+        "base_dir": The directory that the unit's archives are catalogued under
+        "name": The name of a pack's archives, or None for a directory on its own
+        "dirs": The directories in the unit
+    """
+    if not snapshot or not archive_size:
+        return [single_unit(d) for d in subdirs]
+
+    small_size = archive_size // SMALL_DIRECTORY_FRACTION
+
+    units = []
+    small_dirs = {}
+    for subdir in subdirs:
+        manifest = snapshot.manifest(subdir)
+        dir_size = sum(entry[1] for entry in manifest if not is_direct_upload(entry[1], direct_upload_threshold))
+        if subdir and manifest and dir_size < small_size:
+            small_dirs.setdefault(os.path.dirname(subdir), []).append((subdir, dir_size))
+        else:
+            units.append(single_unit(subdir))
+
+    for parent, siblings in small_dirs.iteritems():
+        pack = []
+        pack_size = 0
+        pack_name = FIRST_PACK_NAME
+        for subdir, dir_size in sorted(siblings):
+            if _starts_pack(subdir, dir_size, archive_size):
+                if pack:
+                    units.append(_pack_unit(parent, pack, pack_name))
+                pack = []
+                pack_size = 0
+                pack_name = os.path.basename(subdir) + PACK_SUFFIX
+            elif pack and pack_size + dir_size > archive_size:
+                units.append(_pack_unit(parent, pack, pack_name))
+                pack = []
+                pack_size = 0
+                pack_name = os.path.basename(subdir) + PACK_SUFFIX
+            pack.append(subdir)
+            pack_size += dir_size
+        units.append(_pack_unit(parent, pack, pack_name))
+
+    units.sort(key=lambda u: u["key"])
+    return units
+
+
+def is_direct_upload(file_size, direct_upload_threshold):
+    return bool(direct_upload_threshold) and file_size >= direct_upload_threshold
+
+
+def single_unit(subdir):
+    return {"key": subdir, "base_dir": subdir, "name": None, "dirs": [subdir]}
+
+
+def _starts_pack(subdir, dir_size, archive_size):
+    # Whether a directory starts a new pack depends only on its own name and size, with odds that give packs of about
+    # half of `archive_size` on average
+    odds = float(dir_size) / (archive_size / 2.0)
+    return int(hashlib.sha1(subdir).hexdigest()[:8], 16) < odds * 0x100000000
+
+
+def _pack_unit(parent, dirs, name):
+    if len(dirs) == 1:
+        return single_unit(dirs[0])
+
+    return {"key": os.path.join(parent, name), "base_dir": parent, "name": name, "dirs": dirs}
@@ -0,0 +1,505 @@
+import logging
+import os, os.path
+import threading
+import multiprocessing, multiprocessing.pool
+import Queue
+import archiver
+import catalog
+import compression
+import journal
+import mongoops
+import packing
+
+
+class TempSpaceBudget():
+    """
+    Keeps track of the bytes held in the temporary directory, and makes the archiving stage wait when there's no room
+    for another archive. A limit of 0 means that the temporary directory can grow without limit.
+    """
+
+    def __init__(self, limit, is_draining):
+        """
+        :param limit: The maximum amount of bytes to hold in the temporary directory
+        :param is_draining: A callable that returns False once nothing is going to free any more space - in which
+        case, waiting would never end
+        """
+        self.limit = limit
+        self.used = 0
+        self.is_draining = is_draining
+        self._cond = threading.Condition()
+        self.logger = logging.getLogger("cupobackup{0}.TempSpaceBudget".format(os.getpid()))
+
+    def acquire(self, nbytes):
+        with self._cond:
+            # An archive that's bigger than the whole budget can still be made when the temp dir is empty
+            while self.limit and self.used and self.used + nbytes > self.limit:
+                if not self.is_draining():
+                    self.logger.warning("Temporary directory is over budget but no uploads are running - continuing")
+                    break
+                self.logger.debug("Waiting for {0} bytes of temporary space ({1}/{2} used)".format(
+                    nbytes, self.used, self.limit))
+                self._cond.wait(30)
+
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used = max(0, self.used - nbytes)
+            self._cond.notify_all()
+
+    def adjust(self, reserved_bytes, actual_bytes):
+        """
+        Swap an estimated reservation for the amount of space that is actually in use. Never waits.
+        """
+        with self._cond:
+            self.used = max(0, self.used - reserved_bytes + actual_bytes)
+            self._cond.notify_all()
+
+
+class BackupPipeline():
+    """
+    Backs up a list of subdirectories as a series of stages, so that the source disks and the uplink are kept busy at
+    the same time:
+
+    scan -> archive -> collect -> compare -> upload
+
+    The scan stage skips directories whose manifest hasn't changed, the archive stage zips (and hashes) the rest, and
+    the compare stage checks each archive against the catalog before handing it to the UploadManager. The stages are
+    joined by bounded queues, and archiving waits while the temporary directory is over its budget.
+
+    With more than one archive worker, directories are zipped in a pool of processes. The collect stage takes their
+    results in the order that the directories were scanned, so the archives reach the compare stage in the same order
+    however many workers there are.
+
+    When the sizes of the directories are known from a snapshot of the tree, small sibling directories are packed into
+    shared archives, and every archive is filled up to about `max_archive_size` - see packing.plan_archive_units().
+    Files of at least `direct_upload_threshold` bytes aren't zipped at all: each is hashed where it lives and uploaded
+    as an archive of its own, without a copy in the temporary directory.
+
+    Each directory's progress is recorded in the run's journal. When an interrupted run is resumed, directories that
+    it finished are skipped, and archives that it made are used again if the directory hasn't changed since.
+    """
+
+    def __init__(self, db, upload_mgr, vault, root_dir, temp_dir, max_files, temp_space_limit=0,
+                 dummy_upload=False, pruner=None, queue_size=2, archive_workers=1, run_journal=None,
+                 snapshot=None, compression_policy=None, max_archive_size=None, direct_upload_threshold=None):
+        self.db = db
+        self.upload_mgr = upload_mgr
+        self.vault = vault
+        self.root_dir = root_dir
+        self.temp_dir = temp_dir
+        self.max_files = max_files
+        self.dummy_upload = dummy_upload
+        # Marks the old versions of archives for deletion once the new ones are uploaded. No pruning if None.
+        self.pruner = pruner
+        self.prune = pruner is not None
+        self.journal = run_journal
+        # The treescan.TreeSnapshot of root_dir, if it has already been scanned
+        self.snapshot = snapshot
+        self.compression_policy = compression_policy or compression.DEFAULT_POLICY
+        # Archives are filled up to about this many bytes, and small directories are packed together to make them up
+        self.max_archive_size = max_archive_size
+        # Files at least this big are uploaded as they are. Never, if None.
+        self.direct_upload_threshold = direct_upload_threshold
+
+        self.logger = logging.getLogger("cupobackup{0}.BackupPipeline".format(os.getpid()))
+
+        self.temp_budget = TempSpaceBudget(temp_space_limit, self.upload_mgr.is_uploading)
+        self.archive_workers = max(1, int(archive_workers or 1))
+        self.archive_pool = None
+        self.archive_queue = Queue.Queue(maxsize=queue_size)
+        # Holds the archive jobs in flight, in the order that they were started
+        self.collect_queue = Queue.Queue(maxsize=self.archive_workers)
+        self.compare_queue = Queue.Queue(maxsize=queue_size)
+
+        # Manifests of the directories archived in this run - only saved once their archives have been uploaded
+        self.pending_manifests = []
+        # The journal keys of the directories (or packs of directories) whose archives have all been uploaded, but
+        # whose old versions haven't been pruned yet
+        self.unpruned_dirs = []
+        # The journal keys of the units that have been backed up, or that needed nothing doing
+        self.completed_units = set()
+
+        self.catalog = catalog.ArchiveCatalog(db, vault)
+
+        self.upload_mgr.completion_callbacks.append(self.catalog.update)
+        self.upload_mgr.completion_callbacks.append(self._on_upload_complete)
+
+    def run(self, subdirs):
+        """
+        Back up each of `subdirs` (relative to the root directory), and return once every upload has finished.
+        :return: True if every directory was backed up, or didn't need to be
+        """
+        self.catalog.load()
+        units = packing.plan_archive_units(subdirs, self.snapshot, self.max_archive_size,
+                                           self.direct_upload_threshold)
+
+        if self.archive_workers > 1:
+            # Start the pool before any of the stage or upload threads, so that the worker processes are forked from
+            # a single-threaded process
+            self.logger.info("Archiving with {0} worker processes".format(self.archive_workers))
+            self.archive_pool = multiprocessing.Pool(processes=self.archive_workers)
+
+        # The parts of uploads resumed from an earlier run have only been queued until now
+        self.upload_mgr.start_uploads()
+
+        scan_thread = threading.Thread(target=self._scan_worker, args=(units,))
+        archive_thread = threading.Thread(target=self._archive_worker)
+        collect_thread = threading.Thread(target=self._collect_worker)
+        scan_thread.start()
+        archive_thread.start()
+        collect_thread.start()
+
+        self._compare_worker()
+
+        scan_thread.join()
+        archive_thread.join()
+        collect_thread.join()
+
+        if self.archive_pool:
+            self.archive_pool.close()
+            self.archive_pool.join()
+            self.archive_pool = None
+
+        # Wait for uploads to complete
+        self.upload_mgr.wait_for_finish()
+
+        # Remember what was uploaded, so that unchanged directories can be skipped next time
+        self.finish_directories()
+
+        incomplete_units = [unit["key"] for unit in units if unit["key"] not in self.completed_units]
+        if incomplete_units:
+            self.logger.warning("{0} of {1} directories were not backed up".format(len(incomplete_units),
+                                                                                  len(units)))
+        return not incomplete_units
+
+    def _scan_worker(self, units):
+        try:
+            for unit in units:
+                key = unit["key"]
+                try:
+                    journal_entry = self.journal.get(key) if self.journal else None
+                    state = journal_entry["state"] if journal_entry else None
+                    if state in (journal.PRUNED, journal.UNCHANGED) or (state == journal.UPLOADED and not self.prune):
+                        self.logger.info("Skipped {0} - already backed up by the interrupted run".format(key))
+                        self.completed_units.add(key)
+                        continue
+                    if state == journal.UPLOADED:
+                        # Uploaded before the run was interrupted, but its old versions haven't been pruned
+                        self.unpruned_dirs.append(key)
+                        self.completed_units.add(key)
+                        continue
+
+                    # Check the directories' files against the manifests from the last upload before zipping anything
+                    dir_manifests = []
+                    for subdir in unit["dirs"]:
+                        if self.snapshot:
+                            dir_manifest = self.snapshot.manifest(subdir)
+                        else:
+                            dir_manifest = archiver.build_directory_manifest(self.root_dir, subdir)
+                        # Empty directories aren't archived
+                        if dir_manifest:
+                            dir_manifests.append([subdir, dir_manifest])
+
+                    if not dir_manifests:
+                        self.completed_units.add(key)
+                        continue
+
+                    if all(self.is_manifest_unchanged(subdir, dir_manifest)
+                           for subdir, dir_manifest in dir_manifests):
+                        self.logger.info("Skipped archiving {0} - directory has not changed since last upload".format(
+                            key))
+                        self._record(key, journal.UNCHANGED)
+                        self.completed_units.add(key)
+                        continue
+
+                    # The interrupted run's archives can be used again if nothing in the directories has changed since
+                    reuse_archives = None
+                    if state == journal.ARCHIVED and journal_entry.get("manifest") == dir_manifests:
+                        reuse_archives = journal_entry.get("archives")
+                    else:
+                        self._record(key, journal.SCANNED, manifest=dir_manifests)
+
+                    self.archive_queue.put((unit, dir_manifests, reuse_archives))
+
+                except Exception, e:
+                    self.logger.error("Failed to scan {0} - '{1}'".format(key, e))
+        finally:
+            self.archive_queue.put(None)
+
+    def _archive_worker(self):
+        try:
+            while True:
+                item = self.archive_queue.get()
+                if item is None:
+                    return
+
+                unit, dir_manifests, reuse_archives = item
+                reserved_size = 0
+                # A failure only loses this unit - its temporary space is given back, and the stages carry on
+                try:
+                    raw_files, unchanged_raw_files = self._find_raw_files(dir_manifests)
+                    # The archives will be about as big as the files that go into them. Raw files take no temporary
+                    # space.
+                    estimated_size = sum(f[1] for subdir, dir_manifest in dir_manifests for f in dir_manifest
+                                         if not packing.is_direct_upload(f[1], self.direct_upload_threshold))
+                    self.temp_budget.acquire(estimated_size)
+                    reserved_size = estimated_size
+
+                    # Archive each directory to its own (series of) zip file(s), or each pack of small directories to
+                    # one
+                    if unit["name"] is None:
+                        archive_fn = archiver.archive_directory
+                        archive_args = (self.root_dir, unit["base_dir"], self.temp_dir, self.max_files, reuse_archives,
+                                        dir_manifests[0][1], self.compression_policy, self.max_archive_size,
+                                        [os.path.basename(rel_path) for rel_path in raw_files],
+                                        [os.path.basename(a["rel_path"]) for a in unchanged_raw_files])
+                    else:
+                        archive_fn = archiver.archive_directories
+                        archive_args = (self.root_dir, unit["base_dir"], unit["name"], dir_manifests, self.temp_dir,
+                                        self.max_files, reuse_archives, self.compression_policy,
+                                        self.max_archive_size, raw_files, [a["rel_path"] for a in unchanged_raw_files])
+                    if self.archive_pool:
+                        result = self.archive_pool.apply_async(archive_fn, archive_args)
+                    else:
+                        result = archive_fn(*archive_args)
+                except Exception, e:
+                    self.logger.error("Failed to archive {0} - '{1}'".format(unit["key"], e))
+                    self.temp_budget.release(reserved_size)
+                    continue
+
+                self.collect_queue.put((unit, dir_manifests, estimated_size, result, unchanged_raw_files))
+        finally:
+            self.collect_queue.put(None)
+
+    def _find_raw_files(self, dir_manifests):
+        """
+        Pick out the files that are big enough to be uploaded as they are. Those whose size and mtime match the raw
+        archive already in the catalog are taken to be unchanged, so they aren't read (or hashed) again.
+        :return: A list of the paths of the raw files to hash, relative to the root directory, and a list of archive
+        dicts for the unchanged ones
+        """
+        raw_files = []
+        unchanged_raw_files = []
+        if not self.direct_upload_threshold:
+            return raw_files, unchanged_raw_files
+
+        for subdir, dir_manifest in dir_manifests:
+            for name, size, mtime, inode in dir_manifest:
+                if not packing.is_direct_upload(size, self.direct_upload_threshold):
+                    continue
+                rel_path = os.path.join(subdir, name)
+                most_recent_version = self.catalog.get_most_recent_version(rel_path)
+                if most_recent_version and most_recent_version.get("format") == archiver.RAW_FORMAT and \
+                        most_recent_version["size"] == size and most_recent_version.get("source_mtime") == mtime:
+                    self.logger.info("Skipped hashing {0} - file has not changed since last upload".format(rel_path))
+                    unchanged_raw_files.append({"path": os.path.join(self.root_dir, rel_path),
+                                                "size": size,
+                                                "treehash": most_recent_version["treehash"],
+                                                "hashes": None,
+                                                "members": None,
+                                                "format": archiver.RAW_FORMAT,
+                                                "rel_path": rel_path})
+                else:
+                    raw_files.append(rel_path)
+
+        return raw_files, unchanged_raw_files
+
+    def _collect_worker(self):
+        try:
+            while True:
+                item = self.collect_queue.get()
+                if item is None:
+                    return
+
+                unit, dir_manifests, estimated_size, result, unchanged_raw_files = item
+                tmp_archive_list = None
+                reserved_size = estimated_size
+                # A failure only loses this unit - its archives are removed, and the stages carry on
+                try:
+                    if isinstance(result, multiprocessing.pool.AsyncResult):
+                        try:
+                            tmp_archive_list = result.get()
+                        except Exception, e:
+                            self.logger.error("Archive worker failed on {0} - '{1}'".format(unit["key"], e))
+                    else:
+                        tmp_archive_list = result
+
+                    if not tmp_archive_list and not unchanged_raw_files:
+                        self.temp_budget.release(estimated_size)
+                        continue
+
+                    tmp_archive_list = tmp_archive_list or []
+                    self.temp_budget.adjust(estimated_size, sum(a["size"] for a in tmp_archive_list
+                                                                if a.get("format") != archiver.RAW_FORMAT))
+                    reserved_size = 0
+                    self._record(unit["key"], journal.ARCHIVED, manifest=dir_manifests,
+                                 archives=[dict((k, a[k]) for k in ("path", "size", "treehash", "format", "rel_path",
+                                                                    "source_mtime")
+                                                if k in a)
+                                           for a in tmp_archive_list])
+                except Exception, e:
+                    self.logger.error("Failed to collect the archives of {0} - '{1}'".format(unit["key"], e))
+                    self.temp_budget.release(reserved_size)
+                    for tmp_archive in tmp_archive_list or []:
+                        # Until the reservation has been swapped for their sizes, the archives hold none of the budget
+                        self._discard_archive(tmp_archive, release=not reserved_size)
+                    continue
+
+                self.compare_queue.put((unit, dir_manifests, tmp_archive_list + unchanged_raw_files))
+        finally:
+            self.compare_queue.put(None)
+
+    def _compare_worker(self):
+        while True:
+            item = self.compare_queue.get()
+            if item is None:
+                return
+
+            unit, dir_manifests, tmp_archive_list = item
+            dir_archives = []
+            self.pending_manifests.append((unit, dir_manifests, dir_archives))
+
+            for tmp_archive in tmp_archive_list:
+                try:
+                    self._compare_archive(unit["base_dir"], tmp_archive, dir_archives)
+                except Exception, e:
+                    self.logger.error("Failed to process archive {0} - '{1}'".format(tmp_archive["path"], e))
+                    self._discard_archive(tmp_archive)
+
+    def _compare_archive(self, base_dir, tmp_archive, dir_archives):
+        tmp_archive_fullpath = tmp_archive["path"]
+        # Raw files are catalogued under their own path
+        backup_subdir_rel_filename = tmp_archive.get("rel_path") or archive_rel_path(base_dir, tmp_archive_fullpath)
+        # The treehash of the local archive was calculated as it was written
+        archive_hash = tmp_archive["treehash"]
+        size_arch = tmp_archive["size"]
+        dir_archives.append((backup_subdir_rel_filename, archive_hash, size_arch))
+
+        # The same archive may already be on its way up, from where an interrupted run left it
+        resumed_location = self.upload_mgr.resumed_archives.get((backup_subdir_rel_filename, archive_hash))
+        if resumed_location:
+            self.logger.info("Skipped uploading {0} - its upload was resumed from the interrupted run".format(
+                backup_subdir_rel_filename))
+            if resumed_location != tmp_archive_fullpath:
+                self._discard_archive(tmp_archive)
+            return
+
+        # Find most recent version of this file in Glacier
+        most_recent_version = self.catalog.get_most_recent_version(backup_subdir_rel_filename)
+
+        if most_recent_version:
+            self.logger.info("Archive for this path exists in local database")
+            hash_remote = most_recent_version['treehash']
+            size_remote = most_recent_version['size']
+
+        else:
+            self.logger.info("No archive found for this path in local database")
+            hash_remote = size_remote = None
+
+        # If the hashes are the same - don't upload the archive; it already exists
+        if not compare_files(size_arch, archive_hash, size_remote, hash_remote):
+            self.logger.info("Uploading {0} to vault {1}".format(tmp_archive_fullpath, self.vault.name))
+            if not self.dummy_upload:
+                if not self.upload_mgr.initialize_upload(tmp_archive_fullpath, backup_subdir_rel_filename,
+                                                         archive_hash, size_arch, tmp_archive["hashes"],
+                                                         tmp_archive.get("members"), tmp_archive.get("format"),
+                                                         tmp_archive.get("source_mtime")):
+                    self._discard_archive(tmp_archive)
+            else:
+                # This is a dummy upload, for testing purposes. Create a fake
+                # AWS URI and location, but don't touch the archive.
+                self.logger.info("Dummy upload - not actually uploading archive!")
+                self._discard_archive(tmp_archive)
+
+        else:
+            self.logger.info("Skipped uploading {0} - archive has not changed".format(
+                backup_subdir_rel_filename))
+            self._discard_archive(tmp_archive)
+
+    def _discard_archive(self, tmp_archive, release=True):
+        """
+        Remove a temporary archive that won't be uploaded, and give its space back to the budget. Raw files are the
+        backup's own files, and took none of the budget, so they're left alone.
+        """
+        if tmp_archive.get("format") == archiver.RAW_FORMAT:
+            return
+        try:
+            os.remove(tmp_archive["path"])
+        except OSError:
+            pass
+        if release:
+            self.temp_budget.release(tmp_archive["size"])
+
+    def _on_upload_complete(self, archive_entry):
+        # Uploads resumed from an earlier run, and raw files, never took any of this run's budget
+        if archive_entry.get("format") != archiver.RAW_FORMAT and \
+                archive_entry["tmp_archive_location"].startswith(self.temp_dir):
+            self.temp_budget.release(archive_entry["size"])
+
+    def is_manifest_unchanged(self, subdir, manifest):
+        stored_manifest = mongoops.get_directory_manifest(self.db, self.vault, subdir)
+        if not stored_manifest:
+            return False
+        return stored_manifest["files"] == manifest
+
+    def _record(self, key, state, **fields):
+        if self.journal:
+            self.journal.record(key, state, **fields)
+
+    def finish_directories(self):
+        """
+        Once the uploads have finished, store the manifest of each directory whose archives all made it to Glacier,
+        and prune the old versions of its archives. Directories with a failed (or dummy) upload are left alone, so
+        that they are archived again on the next run.
+        """
+        for unit, dir_manifests, archives in self.pending_manifests:
+            is_uploaded = True
+            for arch_rel_path, arch_hash, arch_size in archives:
+                most_recent_version = self.catalog.get_most_recent_version(arch_rel_path)
+                if not most_recent_version or not compare_files(arch_size, arch_hash, most_recent_version["size"],
+                                                                most_recent_version["treehash"]):
+                    is_uploaded = False
+                    break
+
+            if is_uploaded:
+                # Any other archives of these directories - the old packs that they were in, or the tail of a series
+                # that has shrunk - are no longer restored for them
+                mongoops.supersede_archives(self.db, self.vault, [subdir for subdir, manifest in dir_manifests],
+                                            [arch_rel_path for arch_rel_path, arch_hash, arch_size in archives])
+                for subdir, manifest in dir_manifests:
+                    mongoops.save_directory_manifest(self.db, self.vault, subdir, manifest)
+                    self.logger.debug("Saved file manifest for {0}".format(subdir))
+                self._record(unit["key"], journal.UPLOADED)
+                self.unpruned_dirs.append(unit["key"])
+                self.completed_units.add(unit["key"])
+            else:
+                self.logger.info("Not saving file manifest for {0} - not all of its archives were uploaded".format(
+                    unit["key"]))
+
+        if self.prune:
+            self.prune_directories()
+        else:
+            self.logger.info("Not marking old versions")
+
+    def prune_directories(self):
+        # Old versions only become redundant when a new version is uploaded, so there's nothing to mark unless
+        # something was. The retention rule is applied to the whole vault in one pass, rather than path by path.
+        if not self.unpruned_dirs:
+            return
+        self.pruner.mark_redundant_archives()
+        for key in self.unpruned_dirs:
+            self._record(key, journal.PRUNED)
+        self.unpruned_dirs = []
+
+
+def archive_rel_path(base_dir, tmp_archive_path):
+    """
+    The path that an archive is catalogued under - its file name, inside the directory that it was made from (or, for
+    a pack of small directories, their parent).
+    """
+    return os.path.join(base_dir, os.path.basename(tmp_archive_path))
+
+
+def compare_files(length_a, hash_a, length_b, hash_b):
+    return (length_a == length_b) & (hash_a == hash_b)
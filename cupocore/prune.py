@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import Queue
+import botocore.exceptions
+import mongoops
+
+DEFAULT_KEEP_VERSIONS = 3
+DEFAULT_MIN_AGE_DAYS = 93  # Glacier charges for 90 days of storage, however soon an archive is deleted
+DEFAULT_DELETE_THREADS = 8
+
+
+class ArchivePruner():
+    """
+    Removes the old versions of archives from a vault. The versions that are no longer needed are found and marked
+    for the whole vault at once, then deleted from Glacier several at a time.
+    """
+
+    def __init__(self, db, client, vault, keep_versions=None, min_age_days=None, delete_threads=None):
+        """
+        :param keep_versions: The number of versions of each archive to keep, out of those older than `min_age_days`
+        :param min_age_days: No archive younger than this is deleted
+        :param delete_threads: The most archives that will be deleted from Glacier at once
+        """
+        self.db = db
+        self.client = client
+        self.vault = vault
+        self.keep_versions = DEFAULT_KEEP_VERSIONS if keep_versions is None else keep_versions
+        self.min_age_days = DEFAULT_MIN_AGE_DAYS if min_age_days is None else min_age_days
+        self.delete_threads = delete_threads or DEFAULT_DELETE_THREADS
+        self.logger = logging.getLogger("cupobackup{0}.ArchivePruner".format(os.getpid()))
+
+        self._deleted_ids = []
+        self._failed_count = 0
+        self._lock = threading.Lock()
+
+    def mark_redundant_archives(self):
+        """
+        Mark every archive in the vault that the retention rule no longer needs for deletion.
+        :return: The number of archives marked
+        """
+        redundant_ids = list(mongoops.get_redundant_archive_ids(self.db, self.vault, self.keep_versions,
+                                                                self.min_age_days))
+        marked_count = mongoops.mark_archives_for_deletion(self.db, redundant_ids)
+        self.logger.info("Marked {0} archives as redundant".format(marked_count))
+        return marked_count
+
+    def delete_marked_archives(self):
+        """
+        Delete every archive in the vault that's marked for deletion from Glacier, then remove the database entries of
+        all of those that were deleted in one bulk write. Archives whose deletion fails stay marked, and are tried
+        again next time.
+        :return: The number of archives deleted
+        """
+        self._deleted_ids = []
+        self._failed_count = 0
+
+        # Bounded, so that the cursor is only read as quickly as the archives can be deleted
+        archive_ids = Queue.Queue(maxsize=self.delete_threads * 2)
+        threads = [threading.Thread(target=self._delete_worker, args=(archive_ids,))
+                   for i in xrange(self.delete_threads)]
+        for t in threads:
+            t.start()
+
+        try:
+            for arch in mongoops.get_archives_to_delete(self.db, self.vault):
+                archive_ids.put(arch["_id"])
+        finally:
+            for t in threads:
+                archive_ids.put(None)
+            for t in threads:
+                t.join()
+
+        if self._failed_count:
+            self.logger.info("{0} archives could not be deleted from AWS - not removing their database entries".format(
+                self._failed_count))
+
+        deleted_count = mongoops.delete_archive_documents(self.db, self._deleted_ids)
+        self.logger.info("Deleted {0} archives from local database".format(deleted_count))
+        return deleted_count
+
+    def _delete_worker(self, archive_ids):
+        while True:
+            archive_id = archive_ids.get()
+            if archive_id is None:
+                return
+
+            if self.delete_aws_archive(archive_id):
+                with self._lock:
+                    self._deleted_ids.append(archive_id)
+            else:
+                with self._lock:
+                    self._failed_count += 1
+
+    def delete_aws_archive(self, archive_id):
+        """
+        :return: True if the archive is no longer in Glacier
+        """
+        self.logger.info("Deleting archive with id {0} from vault {1}".format(archive_id, self.vault.name))
+
+        try:
+            self.client.delete_archive(vaultName=self.vault.name,
+                                       archiveId=archive_id)
+
+            self.logger.info("Successfully deleted archive from AWS")
+            return True
+
+        except botocore.exceptions.ConnectionClosedError:
+            self.logger.error("AWS archive removal failed - connection to AWS server was unexpectedly closed")
+            return False
+
+        except botocore.exceptions.EndpointConnectionError:
+            self.logger.error("AWS archive removal failed - unable to connect to AWS server")
+            return False
+
+        except botocore.exceptions.ClientError, e:
+            if e.response.get("Error", {}).get("Code") == "ResourceNotFoundException":
+                # Deleted by an earlier run that stopped before it could remove the database entry
+                self.logger.info("Archive {0} was already deleted from AWS".format(archive_id))
+                return True
+            self.logger.error("AWS archive removal failed - {0}".format(e.response["Error"]["Message"]))
+            return False
+
+        except botocore.exceptions.BotoCoreError, e:
+            self.logger.error("AWS archive removal failed - {0}".format(e.message))
+            return False
+
+        except Exception, e:
+            self.logger.error("AWS archive removal failed - {0}".format(e.message))
+            return False
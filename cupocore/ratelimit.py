@@ -0,0 +1,230 @@
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+import cmdparser
+
+# Rate settings, as well as a number of bytes per second
+UNLIMITED = "unlimited"
+STABLE = "stable"
+
+# Bodies are paced in pieces this big, so that even one large read is spread out smoothly
+PACING_BLOCK_SIZE = 65536
+
+
+def parse_rate(rate):
+    """
+    Convert a rate setting from the command line or config file into a number of bytes per second, UNLIMITED or
+    STABLE.
+    :param rate: A size such as "2M" (bytes per second), "unlimited", "stable", or nothing for UNLIMITED
+    """
+    if not rate or str(rate).lower() == UNLIMITED:
+        return UNLIMITED
+    if str(rate).lower() == STABLE:
+        return STABLE
+    return cmdparser.parse_size(rate)
+
+
+def _parse_time_of_day(time_of_day):
+    hours, minutes = time_of_day.split(":")
+    return datetime.time(int(hours), int(minutes))
+
+
+class RateSchedule():
+    """
+    A list of times of day, each with its own rate. Times outside every entry use the default rate.
+    Entries look like {"start": "23:00", "end": "07:00", "rate": "stable"}, and may run over midnight.
+    """
+
+    def __init__(self, default_rate=None, entries=None):
+        self.default_rate = parse_rate(default_rate)
+        self.entries = []
+        for entry in entries or []:
+            self.entries.append((_parse_time_of_day(entry["start"]),
+                                 _parse_time_of_day(entry["end"]),
+                                 parse_rate(entry.get("rate"))))
+
+    def is_limited(self):
+        return self.default_rate != UNLIMITED or any(rate != UNLIMITED for start, end, rate in self.entries)
+
+    def rate_at(self, when):
+        now = when.time()
+        for start, end, rate in self.entries:
+            if start <= end:
+                if start <= now < end:
+                    return rate
+            elif now >= start or now < end:
+                return rate
+
+        return self.default_rate
+
+
+class TokenBucket():
+    """
+    Paces bytes out at `rate` bytes per second. Tokens build up continuously, to at most `burst_seconds` worth, and
+    a caller that takes more than are available waits for exactly as long as it takes for them to build up - so the
+    bytes leave in a steady stream instead of in bursts.
+    """
+
+    def __init__(self, rate=None, burst_seconds=0.5):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self._tokens = 0.0
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate != self.rate:
+                self._refill()
+                self.rate = rate
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self._tokens = min(self.rate * self.burst_seconds,
+                               self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def consume(self, nbytes):
+        """
+        :return: The number of seconds spent waiting for tokens
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            self._refill()
+            # Going into debt keeps callers in the order that they arrived
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class UploadRateLimiter():
+    """
+    The bandwidth limit shared by all of the upload threads, following a RateSchedule.
+
+    In STABLE mode, the limit follows the link instead of being fixed: it starts out unlimited to see what the link
+    can do, then holds the rate just under what was measured - raising it by 5% whenever the limit is reached, in
+    case the link can take more, and lowering it when the link slows down. This keeps the uplink full without the
+    rate swinging up and down.
+    """
+
+    def __init__(self, schedule, burst_seconds=0.5, stable_window_seconds=10):
+        self.schedule = schedule
+        self.bucket = TokenBucket(burst_seconds=burst_seconds)
+        self.stable_window_seconds = stable_window_seconds
+        self.logger = logging.getLogger("cupobackup{0}.UploadRateLimiter".format(os.getpid()))
+
+        self._lock = threading.Lock()
+        self._setting = None
+        self._stable_rate = None
+        self._window_start = time.time()
+        self._window_bytes = 0
+
+    def consume(self, nbytes):
+        setting = self.schedule.rate_at(datetime.datetime.now())
+
+        with self._lock:
+            if setting != self._setting:
+                self.logger.info("Upload rate limit is now {0}".format(
+                    setting if setting in (UNLIMITED, STABLE) else "{0} bytes/s".format(setting)))
+                self._setting = setting
+                self._stable_rate = None
+            self._measure(nbytes)
+            rate = self._stable_rate if setting == STABLE else setting
+
+        self.bucket.set_rate(None if rate == UNLIMITED else rate)
+        return self.bucket.consume(nbytes)
+
+    def _measure(self, nbytes):
+        self._window_bytes += nbytes
+        elapsed = time.time() - self._window_start
+        if elapsed < self.stable_window_seconds:
+            return
+
+        measured = self._window_bytes / elapsed
+        self._window_start = time.time()
+        self._window_bytes = 0
+
+        if self._setting != STABLE:
+            return
+
+        if self._stable_rate is None:
+            self._stable_rate = measured * 0.95
+        elif measured >= self._stable_rate * 0.95:
+            # Running at the limit - see if the link will take more
+            self._stable_rate *= 1.05
+        elif measured >= self._stable_rate * 0.5:
+            # The link has slowed down. (Much less than this, and there probably just wasn't much to send.)
+            self._stable_rate = max(measured, self._stable_rate * 0.9)
+
+    def wrap(self, fileobj, length):
+        """
+        Wrap a request body so that reading it is paced by this limiter.
+        """
+        return ThrottledReader(fileobj, self, length)
+
+
+class ThrottledReader():
+    """
+    A read-only file wrapper that takes tokens from an UploadRateLimiter for every byte read.
+
+    botocore normally reads a Glacier request body through once to work out its SHA-256 before sending it, which would
+    use up the tokens for bytes that never went on the wire - so the SHA-256 is worked out here instead, and handed to
+    botocore by add_content_sha256_header.
+    """
+
+    def __init__(self, fileobj, limiter, length):
+        self._f = fileobj
+        self.limiter = limiter
+        self.length = length
+        self.paced_seconds = 0.0  # Time spent held back by the limiter
+
+        sha256 = hashlib.sha256()
+        start = self._f.tell()
+        block = self._f.read(1048576)
+        while block:
+            sha256.update(block)
+            block = self._f.read(1048576)
+        self._f.seek(start)
+        self.content_sha256 = sha256.hexdigest()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.tell()
+
+        pieces = []
+        while size > 0:
+            piece = self._f.read(min(size, PACING_BLOCK_SIZE))
+            if not piece:
+                break
+            self.paced_seconds += self.limiter.consume(len(piece))
+            pieces.append(piece)
+            size -= len(piece)
+
+        return "".join(pieces)
+
+    def seek(self, offset, whence=0):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def __len__(self):
+        return self.length
+
+
+def add_content_sha256_header(params, **kwargs):
+    """
+    botocore 'before-call' handler that passes on the SHA-256 of a ThrottledReader body, so that botocore doesn't read
+    the body an extra time to work it out.
+    """
+    content_sha256 = getattr(params.get("body"), "content_sha256", None)
+    if content_sha256:
+        params["headers"]["x-amz-content-sha256"] = content_sha256
@@ -0,0 +1,154 @@
+import binascii
+import hashlib
+
+TREE_HASH_CHUNK_SIZE = 1048576  # Glacier tree hashes are built from 1 MiB chunks
+
+# The longest that a zip member's local file header can be: the fixed 30-byte header, a filename and an extra field
+# of up to 64 KiB each.
+ZIP_LOCAL_HEADER_MAX_SIZE = 30 + 65535 + 65535
+
+
+def calculate_tree_hash(digests):
+    """
+    Combine a list of binary SHA-256 digests of consecutive 1 MiB chunks into the binary root digest of their tree
+    hash, as described in the Glacier documentation.
+    :param digests: The binary digests of each chunk, in order
+    :return: The binary root digest
+    """
+    if not digests:
+        return hashlib.sha256("").digest()
+
+    hashes = list(digests)
+    while len(hashes) > 1:
+        next_level = []
+        for i in xrange(0, len(hashes), 2):
+            if i + 1 < len(hashes):
+                next_level.append(hashlib.sha256(hashes[i] + hashes[i + 1]).digest())
+            else:
+                next_level.append(hashes[i])
+        hashes = next_level
+
+    return hashes[0]
+
+
+class TreeHash():
+    """
+    The SHA-256 digests of each 1 MiB chunk of a file. The tree hash of the whole file, or of any part of it that
+    starts on a chunk boundary (as every Glacier multipart upload part does), can be worked out from these without
+    reading the file again.
+    """
+
+    def __init__(self, chunk_digests=None):
+        self.chunk_digests = chunk_digests or []
+
+    def hexdigest(self):
+        return binascii.hexlify(calculate_tree_hash(self.chunk_digests))
+
+    def part_hexdigest(self, first_byte, last_byte):
+        if first_byte % TREE_HASH_CHUNK_SIZE:
+            raise ValueError("Part must start on a {0} byte boundary".format(TREE_HASH_CHUNK_SIZE))
+
+        first_chunk = first_byte // TREE_HASH_CHUNK_SIZE
+        last_chunk = last_byte // TREE_HASH_CHUNK_SIZE
+        return binascii.hexlify(calculate_tree_hash(self.chunk_digests[first_chunk:last_chunk + 1]))
+
+    @classmethod
+    def from_file(cls, f):
+        chunk_digests = []
+        chunk = f.read(TREE_HASH_CHUNK_SIZE)
+        while chunk:
+            chunk_digests.append(hashlib.sha256(chunk).digest())
+            chunk = f.read(TREE_HASH_CHUNK_SIZE)
+
+        return cls(chunk_digests)
+
+
+class TreeHashWriter():
+    """
+    A file wrapper that works out the tree hash of everything that is written through it, so that a file doesn't
+    have to be read back from disk to be hashed.
+
+    zipfile seeks backwards to rewrite each member's local file header once the member's data has been written.
+    Call hold() before writing a member, so that the chunks holding its header are kept in memory rather than hashed,
+    and release() once the member has been written and the header is final.
+    """
+
+    def __init__(self, fileobj):
+        self._f = fileobj
+        self._pos = 0
+        self._size = 0
+        self._chunks = {}  # Chunk index -> bytearray, for chunks that haven't been hashed yet
+        self._digests = {}  # Chunk index -> binary digest
+        self._held = set()
+        self.name = getattr(fileobj, "name", None)
+
+    def _hash_chunk(self, idx):
+        self._digests[idx] = hashlib.sha256(self._chunks.pop(idx)).digest()
+
+    def write(self, data):
+        self._f.write(data)
+
+        offset = 0
+        while offset < len(data):
+            idx, chunk_offset = divmod(self._pos, TREE_HASH_CHUNK_SIZE)
+            if idx in self._digests:
+                raise IOError("Cannot rewrite byte {0} - its chunk has already been hashed".format(self._pos))
+
+            chunk = self._chunks.setdefault(idx, bytearray())
+            if chunk_offset > len(chunk):
+                raise IOError("Cannot write at byte {0} - the file would have a gap in it".format(self._pos))
+
+            n = min(TREE_HASH_CHUNK_SIZE - chunk_offset, len(data) - offset)
+            chunk[chunk_offset:chunk_offset + n] = data[offset:offset + n]
+            offset += n
+            self._pos += n
+            self._size = max(self._size, self._pos)
+
+            if len(chunk) == TREE_HASH_CHUNK_SIZE and idx not in self._held:
+                self._hash_chunk(idx)
+
+    def hold(self, length=ZIP_LOCAL_HEADER_MAX_SIZE):
+        """
+        Keep the chunks covering the next `length` bytes in memory until release() is called, so that they can be
+        rewritten.
+        """
+        first_chunk = self._pos // TREE_HASH_CHUNK_SIZE
+        last_chunk = (self._pos + length - 1) // TREE_HASH_CHUNK_SIZE
+        self._held.update(xrange(first_chunk, last_chunk + 1))
+
+    def release(self):
+        self._held.clear()
+        for idx, chunk in self._chunks.items():
+            if len(chunk) == TREE_HASH_CHUNK_SIZE:
+                self._hash_chunk(idx)
+
+    def seek(self, offset, whence=0):
+        self._f.seek(offset, whence)
+        self._pos = self._f.tell()
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        """
+        Hash whatever is left of the final chunk, and close the underlying file.
+        """
+        self.release()
+        for idx in self._chunks.keys():
+            self._hash_chunk(idx)
+        self._f.close()
+
+    @property
+    def size(self):
+        return self._size
+
+    def tree_hash(self):
+        """
+        :return: A TreeHash of everything written. Only valid once the writer has been closed.
+        """
+        if self._chunks:
+            raise IOError("Cannot get the tree hash of a file that is still being written")
+        return TreeHash([self._digests[idx] for idx in sorted(self._digests)])
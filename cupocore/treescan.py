@@ -0,0 +1,175 @@
+import logging
+import os, os.path
+import stat
+import threading
+import Queue
+
+try:
+    # Python 2's os module has no scandir - the backport from PyPI reads each entry's type along with its name, so
+    # only the files need a stat of their own
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+DEFAULT_SCAN_THREADS = 1
+
+logger = logging.getLogger("cupobackup{0}.treescan".format(os.getpid()))
+
+
+class TreeSnapshot():
+    """
+    The directories under a root directory, and the files that would be archived from each of them, as they were when
+    the tree was scanned. Built in a single walk of the tree, so that nothing needs to list or stat the files again.
+    """
+
+    def __init__(self, top_dir):
+        self.top_dir = top_dir
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def add_directory(self, subdir, manifest):
+        manifest.sort()
+        with self._lock:
+            self._manifests[subdir] = manifest
+
+    def subdirs(self):
+        """
+        :return: The paths of all of the directories below the root, relative to it, in order
+        """
+        return sorted(d for d in self._manifests if d)
+
+    def manifest(self, subdir):
+        """
+        :return: A sorted list of [name, size, mtime, inode] entries - one for each file that would be archived from
+        `subdir` - as built by archiver.build_directory_manifest
+        """
+        return self._manifests.get(subdir, [])
+
+    def file_count(self):
+        return sum(len(m) for m in self._manifests.itervalues())
+
+
+def scan_tree(top_dir, scan_threads=None):
+    """
+    Walk the tree under `top_dir` once, recording every directory and the size, mtime and inode of the files in each.
+    Like os.walk, symlinks to directories are listed but not followed.
+    :param scan_threads: The number of directories to read at once. More than one helps on mounts where each request
+    has a long round trip, such as NFS.
+    :return: A TreeSnapshot
+    """
+    scan_threads = max(1, int(scan_threads or DEFAULT_SCAN_THREADS))
+    snapshot = TreeSnapshot(top_dir)
+    logger.info("Scanning {0} with {1} threads".format(top_dir, scan_threads))
+
+    if scan_threads == 1:
+        pending = [("", True)]
+        while pending:
+            subdir, recurse = pending.pop()
+            pending.extend(_scan_into_snapshot(snapshot, subdir, recurse))
+    else:
+        dirs = Queue.Queue()
+        dirs.put(("", True))
+        threads = [threading.Thread(target=_scan_worker, args=(snapshot, dirs)) for i in xrange(scan_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        # Every directory is marked as done only after its subdirectories have been queued, so once they all are,
+        # the whole tree has been scanned
+        dirs.join()
+        for t in threads:
+            dirs.put(None)
+        for t in threads:
+            t.join()
+
+    logger.info("Found {0} directories and {1} files".format(len(snapshot.subdirs()) + 1, snapshot.file_count()))
+    return snapshot
+
+
+def _scan_worker(snapshot, dirs):
+    while True:
+        item = dirs.get()
+        if item is None:
+            return
+
+        subdir, recurse = item
+        try:
+            for item in _scan_into_snapshot(snapshot, subdir, recurse):
+                dirs.put(item)
+        except Exception, e:
+            logger.error("Failed to scan {0} - '{1}'".format(subdir, e))
+        finally:
+            dirs.task_done()
+
+
+def scan_directory(top_dir, subdir):
+    """
+    Scan a single directory, without walking the ones below it.
+    :return: A sorted list of [name, size, mtime, inode] entries, as in a TreeSnapshot
+    """
+    manifest, child_dirs = _scan_directory(top_dir, subdir)
+    manifest.sort()
+    return manifest
+
+
+def _scan_into_snapshot(snapshot, subdir, recurse):
+    """
+    Record the files in one directory.
+    :return: (subdir, recurse) tuples for the directories in it, to scan next
+    """
+    manifest, child_dirs = _scan_directory(snapshot.top_dir, subdir)
+    snapshot.add_directory(subdir, manifest)
+    if not recurse:
+        return []
+    return [(child_dir, not is_link) for child_dir, is_link in child_dirs]
+
+
+def _scan_directory(top_dir, subdir):
+    """
+    :return: The manifest of a directory, and a list of (subdir, is_link) tuples for the directories in it
+    """
+    full_path = os.path.join(top_dir, subdir)
+    manifest = []
+    child_dirs = []
+
+    try:
+        for name, is_file, is_dir, is_link, get_stat in _list_entries(full_path):
+            if is_dir:
+                rel_path = os.path.join(subdir, name)
+                logger.debug("Found subdirectory {0}".format(rel_path))
+                child_dirs.append((rel_path, is_link))
+            elif is_file and not name.endswith(".ini"):
+                try:
+                    f_stat = get_stat()
+                except OSError:
+                    # Removed since the directory was listed
+                    continue
+                manifest.append([name, f_stat.st_size, f_stat.st_mtime, f_stat.st_ino])
+    except OSError, e:
+        logger.error("Failed to scan {0} - '{1}'".format(full_path, e))
+
+    return manifest, child_dirs
+
+
+def _list_entries(dir_path):
+    """
+    :return: A generator of (name, is_file, is_dir, is_link, get_stat) tuples, one for each entry in `dir_path`. Like
+    os.path.isfile and os.path.isdir, is_file and is_dir follow symlinks. get_stat() stats the entry, following
+    symlinks.
+    """
+    if scandir:
+        for entry in scandir(dir_path):
+            yield entry.name, entry.is_file(), entry.is_dir(), entry.is_symlink(), entry.stat
+        return
+
+    for name in os.listdir(dir_path):
+        path = os.path.join(dir_path, name)
+        try:
+            st = os.lstat(path)
+            is_link = stat.S_ISLNK(st.st_mode)
+            if is_link:
+                st = os.stat(path)
+        except OSError:
+            # A dangling symlink, or an entry removed since the directory was listed
+            continue
+        yield name, stat.S_ISREG(st.st_mode), stat.S_ISDIR(st.st_mode), is_link, (lambda st=st: st)
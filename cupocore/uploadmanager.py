@@ -1,123 +1,702 @@
 import logging
+import calendar
 import mongoops
 import threading
 import os, os.path
+import random
 import time
+import Queue
+import mmap
+import botocore.exceptions
+import treehash
+import archiver
+import ratelimit
+
+
+# Glacier accepts any power of two between 1 MiB and 4 GiB as a multipart upload's part size, and at most 10,000 parts
+MIN_PART_SIZE = 1048576
+MAX_PART_SIZE = 4294967296
+MAX_PARTS_PER_UPLOAD = 10000
+
+# Archives smaller than this are sent with a single upload_archive call, skipping the multipart initiate/complete
+# round trips
+DEFAULT_SINGLE_UPLOAD_THRESHOLD = 104857600  # 100 MiB
+
+DEFAULT_UPLOAD_THREADS = 5
+
+# Error codes that mean AWS wants us to slow down
+THROTTLING_ERROR_CODES = ("ThrottlingException", "RequestLimitExceeded", "RequestTimeoutException",
+                          "ServiceUnavailableException", "SlowDown")
+
+
+class UploadConcurrency():
+    """
+    Limits how many upload requests are in flight at once.
+
+    In adaptive mode the limit starts low and is raised by one after each round of parts that go through as fast as
+    any seen so far. It's lowered by one when parts start taking twice as long per byte as the fastest part (the link
+    is full, so more requests only queue up behind each other), and halved when AWS throttles a request. The fastest
+    time drifts up a little with each part, so that one unusually quick part can't hold the limit down for good.
+    """
+
+    def __init__(self, max_limit, adaptive=False):
+        self.max_limit = max(1, max_limit)
+        self.adaptive = adaptive
+        self.limit = min(2, self.max_limit) if adaptive else self.max_limit
+        self.in_flight = 0
+
+        self._cond = threading.Condition()
+        self._fastest = None  # Lowest seconds-per-byte seen
+        self._fast_parts = 0  # Parts at a good speed since the limit last changed
+        self.logger = logging.getLogger("cupobackup{0}.UploadConcurrency".format(os.getpid()))
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes=0, seconds=0, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if self.adaptive:
+                self._adjust(nbytes, seconds, throttled)
+            self._cond.notify_all()
+
+    def _adjust(self, nbytes, seconds, throttled):
+        old_limit = self.limit
+
+        if throttled:
+            self.limit = max(1, self.limit // 2)
+            self._fast_parts = 0
+        elif nbytes and seconds > 0:
+            seconds_per_byte = float(seconds) / nbytes
+            if self._fastest is None:
+                self._fastest = seconds_per_byte
+            else:
+                self._fastest = min(seconds_per_byte, self._fastest * 1.02)
+
+            if seconds_per_byte > self._fastest * 2:
+                self.limit = max(1, self.limit - 1)
+                self._fast_parts = 0
+            else:
+                self._fast_parts += 1
+                if self._fast_parts >= self.limit:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self._fast_parts = 0
+
+        if self.limit != old_limit:
+            self.logger.debug("Upload concurrency changed from {0} to {1}".format(old_limit, self.limit))
 
 
 class UploadManager():
-    def __init__(self, db, client, vault_name):
-        self._concurrent_upload_limit = 5
-        self.chunk_size = 16777216  # Multipart size in bytes
+    def __init__(self, db, client, vault, single_upload_threshold=None, upload_threads=None,
+                 adaptive_concurrency=False, rate_limiter=None):
+        self._concurrent_upload_limit = upload_threads or DEFAULT_UPLOAD_THREADS
+        self.concurrency = UploadConcurrency(self._concurrent_upload_limit, adaptive_concurrency)
+        self.chunk_size = 16777216  # Multipart size in bytes, until the throughput of the link has been measured
+        self.target_part_seconds = 30  # Parts are sized to take about this long to send
+        self.single_upload_threshold = single_upload_threshold or DEFAULT_SINGLE_UPLOAD_THRESHOLD
+        self.part_lease_seconds = 1800  # How long a claimed part is reserved for before others may take it over
+        self.lease_renew_seconds = 300  # How often the leases of the parts being sent are extended
+        self.leased_retry_seconds = 60  # How long to wait before trying again for a part that's leased elsewhere
+        self.max_part_attempts = 5
+        self.retry_base_seconds = 2  # The first wait before sending a failed part again, doubled for each attempt
+        self.retry_max_seconds = 120
         self.db = db
         self.client = client
-        self.vault_name = vault_name
+        self.vault = vault
+        self.vault_name = vault.name
+        self.vault_arn = vault.arn
+
+        # Shared by every upload thread, so that the limit applies to the backup as a whole
+        self.rate_limiter = rate_limiter
+        if rate_limiter:
+            for operation in ("UploadMultipartPart", "UploadArchive"):
+                self.client.meta.events.register_first("before-call.glacier.{0}".format(operation),
+                                                       ratelimit.add_content_sha256_header)
 
         self.logger = logging.getLogger("cupobackup{0}.UploadManager".format(os.getpid()))
 
         self.upload_threads = []
+        self._threads_lock = threading.Lock()
+
+        # Parts waiting to be uploaded by this process. MongoDB is only the durable record of them - the threads take
+        # their work from here.
+        self.part_queue = Queue.Queue()
+        self._parts_lock = threading.Lock()
+        self._remaining_parts = {}  # uploadId -> number of parts still to upload
+        self._part_attempts = {}  # mpart _id (or archive location, for single uploads) -> number of failed attempts
+        self._throughput = None  # Bytes per second that each thread achieves, averaged over recent parts
+        self._leased_parts = set()  # mpart _ids that this process holds the lease on
+        self._lease_keeper = None
+
+        # Called with a dict of the archive's "_id", "path", "treehash", "size", "uploaded_time", "format",
+        # "source_mtime" and "tmp_archive_location" once each archive has been uploaded and its temporary file removed
+        self.completion_callbacks = []
+
+        # Member index of each archive being uploaded, by temporary archive location
+        self._archive_members = {}
+
+        # The uploads that were carried on from an earlier run: (archive path, tree hash) -> temporary archive location
+        self.resumed_archives = {}
+
+    def choose_part_size(self, archive_size):
+        """
+        Pick a multipart part size for an archive: big enough to stay within the part limit, and otherwise whichever
+        power of two would take each thread about `target_part_seconds` to send at the throughput seen so far.
+        """
+        part_size = MIN_PART_SIZE
+        while part_size * MAX_PARTS_PER_UPLOAD < archive_size and part_size < MAX_PART_SIZE:
+            part_size *= 2
+
+        with self._parts_lock:
+            throughput = self._throughput
+        target_size = throughput * self.target_part_seconds if throughput else self.chunk_size
+
+        # Grow to the largest power of two that doesn't overshoot the target, but no bigger than the archive needs
+        while part_size * 2 <= target_size and part_size < archive_size and part_size < MAX_PART_SIZE:
+            part_size *= 2
+
+        return part_size
+
+    def _record_throughput(self, nbytes, seconds):
+        if seconds <= 0:
+            return
+        with self._parts_lock:
+            rate = nbytes / seconds
+            self._throughput = rate if self._throughput is None else 0.7 * self._throughput + 0.3 * rate
+
+    def initialize_upload(self, tmp_archive_location, subdir_rel_path, archive_checksum, archive_size,
+                          archive_hashes=None, archive_members=None, archive_format=None, source_mtime=None):
+        """
+        Start uploading an archive: small archives are queued to be sent whole, and bigger ones are split into the
+        parts of a multipart upload. The parts are read straight from the file by their byte ranges, so a large file
+        can be uploaded as it is, from where it lives.
+        :param archive_hashes: The archive's TreeHash, if it's known. Used to give each part its checksum up front;
+        otherwise each part is hashed just before it's sent.
+        :param archive_members: The index of the archive's members, to be stored with its catalog entry. If it isn't
+        given, it's read from the archive once the upload has finished.
+        :param archive_format: archiver.RAW_FORMAT if `tmp_archive_location` is a file being uploaded as it is, rather
+        than a temporary zip archive - it's left in place once it's uploaded
+        :param source_mtime: The mtime of a raw file when it was hashed. An interrupted upload of the file is only
+        resumed if it still has this mtime.
+        :return: True if the upload was started
+        """
+        if archive_members is not None:
+            with self._parts_lock:
+                self._archive_members[tmp_archive_location] = archive_members
 
-    def initialize_upload(self, tmp_archive_location, subdir_rel_path, archive_checksum, archive_size):
+        if archive_size < self.single_upload_threshold:
+            self.logger.info("Queueing single request upload of archive {0}".format(subdir_rel_path))
+            self.part_queue.put({"is_single_upload": True,
+                                 "tmp_archive_location": tmp_archive_location,
+                                 "subdir_rel_path": subdir_rel_path,
+                                 "full_size": archive_size,
+                                 "full_hash": archive_checksum,
+                                 "archive_format": archive_format,
+                                 "source_mtime": source_mtime})
+            self._start_threads()
+            return True
+
+        part_size = self.choose_part_size(archive_size)
         try:
             response = self.client.initiate_multipart_upload(vaultName=self.vault_name,
                                                              archiveDescription=subdir_rel_path,
-                                                             partSize=str(self.chunk_size))
-            self.logger.info("Successfully created upload job for archive {0}".format(subdir_rel_path))
+                                                             partSize=str(part_size))
+            self.logger.info("Successfully created upload job for archive {0} with {1} byte parts".format(
+                subdir_rel_path, part_size))
 
         except Exception, e:
             self.logger.error("Failed to init multipart upload!")
             self.logger.debug("Error msg:\n{0}n\Error args:\n{1}".format(e.message, e.args))
             return False
 
-        for i in xrange(0, archive_size + 1, self.chunk_size):
-            if i + self.chunk_size >= archive_size - 1:
-                last_byte = archive_size - 1
-            else:
-                last_byte = i + self.chunk_size - 1
+        part_ranges = [(i, min(i + part_size, archive_size) - 1)
+                       for i in xrange(0, archive_size, part_size)]
+        part_checksums = None
+        if archive_hashes:
+            part_checksums = [archive_hashes.part_hexdigest(first_byte, last_byte)
+                              for first_byte, last_byte in part_ranges]
+        mpart_entries = mongoops.create_mpart_part_entries(self.db, self.vault, response["uploadId"], part_ranges,
+                                                           tmp_archive_location, archive_size, archive_checksum,
+                                                           subdir_rel_path, part_checksums, part_size,
+                                                           archive_format, source_mtime)
+
+        with self._parts_lock:
+            self._remaining_parts[response["uploadId"]] = len(mpart_entries)
+        for mpart_entry in mpart_entries:
+            self.part_queue.put(mpart_entry)
+
+        self._start_threads()
+        return True
+
+    def _start_threads(self):
+        with self._threads_lock:
+            # Remove dead threads
+            self.upload_threads = [t for t in self.upload_threads if t.is_alive()]
+
+            # And start new ones in their place! UploadConcurrency decides how many of them send at once.
+            while len(self.upload_threads) < self._concurrent_upload_limit:
+                t = threading.Thread(target=self.thread_worker)
+
+                self.upload_threads.append(t)
+                t.start()
 
-            mongoops.create_mpart_part_entry(self.db, mongoops.get_vault_by_name(self.db, self.vault_name)["arn"],
-                                             response["uploadId"], i, last_byte, tmp_archive_location, archive_size,
-                                             archive_checksum, subdir_rel_path)
+    def _part_done(self, uploadId):
+        """
+        Count off an uploaded part.
+        :return: True if that was the last part of the upload
+        """
+        with self._parts_lock:
+            self._remaining_parts[uploadId] -= 1
+            if self._remaining_parts[uploadId] == 0:
+                del self._remaining_parts[uploadId]
+                return True
+            return False
 
-        # Remove dead threads
-        for t in self.upload_threads:
-            if not t.is_alive(): self.upload_threads.remove(t)
+    def _part_failed(self, mpart_entry):
+        attempts_key = mpart_entry.get("_id", mpart_entry["tmp_archive_location"])
+        with self._parts_lock:
+            attempts = self._part_attempts.get(attempts_key, 0) + 1
+            self._part_attempts[attempts_key] = attempts
 
-        # And start new ones in their place!
-        while len(self.upload_threads) < self._concurrent_upload_limit:
-            t = threading.Thread(target=self.thread_worker)
+        if not mpart_entry.get("is_single_upload"):
+            mongoops.set_mpart_inactive(self.db, mpart_entry["_id"])
 
-            self.upload_threads.append(t)
-            t.start()
-            time.sleep(2)
+        if attempts < self.max_part_attempts:
+            # Back off exponentially, with jitter so that the threads that failed together don't all retry together.
+            # The thread waits rather than moving on, so the part is still counted as in hand until it's queued again.
+            delay = random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempts))
+            self.logger.info("Trying {0} again in {1:.1f} seconds".format(mpart_entry["tmp_archive_location"], delay))
+            time.sleep(delay)
+            self.part_queue.put(mpart_entry)
+        elif mpart_entry.get("is_single_upload"):
+            # Nothing records a single upload, so it can't be resumed - its directory is archived again next run
+            self.logger.error("Giving up on {0} after {1} attempts".format(mpart_entry["tmp_archive_location"],
+                                                                           attempts))
+            if mpart_entry.get("archive_format") != archiver.RAW_FORMAT:
+                try:
+                    os.remove(mpart_entry["tmp_archive_location"])
+                except OSError:
+                    pass
+        else:
+            self.logger.error("Giving up on bytes {0} to {1} of {2} after {3} attempts".format(
+                mpart_entry["first_byte"], mpart_entry["last_byte"], mpart_entry["tmp_archive_location"], attempts))
 
     def thread_worker(self, *args, **kwargs):
         while True:
-            mpart_entry = mongoops.get_oldest_inactive_mpart_entry(self.db, self.vault_name)
-            if not mpart_entry:
-                self.logger.info("Thread exiting, no more mparts available")
-                return None
-            mongoops.set_mpart_active(self.db, mpart_entry["_id"])
+            try:
+                mpart_entry = self.part_queue.get_nowait()
+            except Queue.Empty:
+                # Parts are queued before _start_threads() is called, so checking again with the thread list locked
+                # means a part can't be queued just as this thread leaves while still being counted as running
+                with self._threads_lock:
+                    if self.part_queue.empty():
+                        self.upload_threads.remove(threading.current_thread())
+                        self.logger.info("Thread exiting, no more mparts available")
+                        return None
+                continue
+
+            if mpart_entry.get("is_single_upload"):
+                self._upload_single(mpart_entry)
+                continue
 
+            # Claiming is atomic, so a part that's leased to another uploader is never sent twice
+            if not mongoops.claim_mpart(self.db, mpart_entry["_id"], self.part_lease_seconds):
+                self._part_unclaimed(mpart_entry)
+                continue
+
+            self._hold_lease(mpart_entry["_id"])
             try:
-                with open(mpart_entry["tmp_archive_location"], "rb") as mpart_f:
-                    mpart_f.seek(mpart_entry["first_byte"], 0)
-                    upload_response = self.client.upload_multipart_part(vaultName=self.vault_name,
-                                                                        uploadId=mpart_entry["uploadId"],
-                                                                        range="bytes {0}-{1}/*".format(
-                                                                            mpart_entry["first_byte"],
-                                                                            mpart_entry["last_byte"]),
-                                                                        body=mpart_f.read(self.chunk_size))
-                    if upload_response:
-                        mongoops.delete_mpart_entry(self.db, mpart_entry["_id"])
-                        self.logger.info("Uploaded bytes {0} to {1} of {2}".format(mpart_entry["first_byte"],
-                                                                                   mpart_entry["last_byte"],
-                                                                                   mpart_entry["tmp_archive_location"]))
+                is_uploaded = self._upload_part(mpart_entry)
+            finally:
+                self._drop_lease(mpart_entry["_id"])
 
-            except Exception, e:
-                self.logger.error("Failed to upload mpart!")
-                self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
-                self.logger.debug(e.__repr__)
-                mongoops.set_mpart_inactive(self.db, mpart_entry["_id"])
+            if not is_uploaded:
+                self._part_failed(mpart_entry)
                 continue
 
             # At end, check if there are any more parts with this uploadId - if not, complete the mpart upload
-            is_more = mongoops.is_existing_mparts_remaining(self.db, self.vault_name, mpart_entry["uploadId"])
-            if not is_more:
+            is_last = self._part_done(mpart_entry["uploadId"])
+            if is_last:
+                self._complete_upload(mpart_entry)
+
+    def _part_unclaimed(self, mpart_entry):
+        """
+        Deal with a part that couldn't be claimed. If its document has gone, another uploader has sent it, so it's
+        counted off like any other; if it's leased elsewhere, it's queued again once the other uploader has had a while
+        to finish it or let its lease run out.
+        """
+        if mongoops.get_mpart_entry(self.db, mpart_entry["_id"]) is None:
+            self.logger.info("Bytes {0} to {1} of {2} were uploaded elsewhere".format(
+                mpart_entry["first_byte"], mpart_entry["last_byte"], mpart_entry["tmp_archive_location"]))
+            if self._part_done(mpart_entry["uploadId"]):
+                self._complete_upload(mpart_entry)
+            return
+
+        self.logger.info("Bytes {0} to {1} of {2} are being uploaded elsewhere - trying again later".format(
+            mpart_entry["first_byte"], mpart_entry["last_byte"], mpart_entry["tmp_archive_location"]))
+        time.sleep(self.leased_retry_seconds)
+        self.part_queue.put(mpart_entry)
+
+    def _hold_lease(self, mpart_id):
+        with self._parts_lock:
+            self._leased_parts.add(mpart_id)
+            if self._lease_keeper is None:
+                self._lease_keeper = threading.Thread(target=self._keep_leases)
+                self._lease_keeper.daemon = True
+                self._lease_keeper.start()
+
+    def _drop_lease(self, mpart_id):
+        with self._parts_lock:
+            self._leased_parts.discard(mpart_id)
+
+    def _keep_leases(self):
+        """
+        Extend the leases of the parts being sent every `lease_renew_seconds`, until none are left, so that a part
+        that's slow to go out - behind the rate limit, say - isn't taken over by another uploader and sent twice.
+        """
+        while True:
+            time.sleep(self.lease_renew_seconds)
+            with self._parts_lock:
+                leased_ids = list(self._leased_parts)
+                if not leased_ids:
+                    self._lease_keeper = None
+                    return
+
+            try:
+                mongoops.renew_mpart_leases(self.db, leased_ids, self.part_lease_seconds)
+            except Exception, e:
+                self.logger.error("Failed to renew the leases of {0} parts - '{1}'".format(len(leased_ids), e))
+
+    def _complete_upload(self, upload_entry):
+        """
+        Complete a multipart upload once all of its parts have been sent.
+        """
+        try:
+            final_response = self.client.complete_multipart_upload(vaultName=self.vault_name,
+                                                                   uploadId=upload_entry["uploadId"],
+                                                                   archiveSize=str(upload_entry["full_size"]),
+                                                                   checksum=upload_entry["full_hash"])
+        except Exception, e:
+            self.logger.error("Failed to complete mpart upload at AWS!")
+            self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
+            return
+
+        self._finish_archive(upload_entry, final_response)
+
+    def resume_pending_uploads(self, abort_unknown=False):
+        """
+        Pick up the multipart uploads that an earlier run left unfinished. The parts that AWS already has are crossed
+        off and the rest are queued, so only the missing ranges are sent. No upload threads are started here - the
+        queued parts are sent once start_uploads() is called. Uploads that can't be resumed - because their
+        temporary archive has gone, or AWS no longer knows about them - are aborted.
+        :param abort_unknown: Also abort the uploads left open at AWS that the database has no record of. Nothing marks
+        an upload as ours at AWS, so this is only safe if nothing else uploads to the vault.
+        :return: The number of uploads resumed
+        """
+        resumed = 0
+        pending_uploads = mongoops.get_pending_uploads(self.db, self.vault)
+
+        for upload in pending_uploads:
+            upload_id = upload["_id"]
+            tmp_archive_location = upload["tmp_archive_location"]
+
+            if upload["leased_parts"]:
+                self.logger.info("Upload of {0} is in progress elsewhere - not resuming it".format(
+                    upload["subdir_rel_path"]))
+                continue
+
+            if not os.path.isfile(tmp_archive_location) or \
+                    os.path.getsize(tmp_archive_location) != upload["full_size"]:
+                self.logger.warning("Temporary archive {0} is missing - abandoning its upload".format(
+                    tmp_archive_location))
+                self._abort_upload(upload_id)
+                continue
+
+            # A raw file that has been rewritten since its upload began no longer matches the parts' checksums
+            if upload.get("archive_format") == archiver.RAW_FORMAT and \
+                    os.path.getmtime(tmp_archive_location) != upload.get("source_mtime"):
+                self.logger.warning("{0} has changed since its upload began - abandoning its upload".format(
+                    tmp_archive_location))
+                self._abort_upload(upload_id)
+                continue
+
+            try:
+                uploaded_parts = self._list_uploaded_parts(upload_id)
+            except botocore.exceptions.ClientError, e:
+                self.logger.warning("Cannot resume the upload of {0} - '{1}'".format(upload["subdir_rel_path"], e))
+                self._abort_upload(upload_id)
+                continue
+
+            remaining_parts = []
+            uploaded_part_ids = []
+            for mpart_entry in mongoops.get_mpart_entries(self.db, self.vault, upload_id):
+                uploaded_hash = uploaded_parts.get((mpart_entry["first_byte"], mpart_entry["last_byte"]))
+                if uploaded_hash and uploaded_hash == self._part_checksum(mpart_entry):
+                    uploaded_part_ids.append(mpart_entry["_id"])
+                else:
+                    remaining_parts.append(mpart_entry)
+            mongoops.delete_mpart_entries(self.db, uploaded_part_ids)
+
+            self.logger.info("Resuming upload of {0} - {1} parts already uploaded, {2} to go".format(
+                upload["subdir_rel_path"], len(uploaded_part_ids), len(remaining_parts)))
+            resumed += 1
+            self.resumed_archives[(upload["subdir_rel_path"], upload["full_hash"])] = tmp_archive_location
+
+            upload_entry = dict(upload, uploadId=upload_id)
+            del upload_entry["_id"]
+            if not remaining_parts:
+                self._complete_upload(upload_entry)
+                continue
+
+            with self._parts_lock:
+                self._remaining_parts[upload_id] = len(remaining_parts)
+            for mpart_entry in remaining_parts:
+                self.part_queue.put(mpart_entry)
+
+        if abort_unknown:
+            self._abort_unknown_uploads(set(upload["_id"] for upload in pending_uploads))
+        return resumed
+
+    def start_uploads(self):
+        """
+        Start sending any parts that are waiting in the queue, such as those of the uploads resumed by
+        resume_pending_uploads().
+        """
+        if not self.part_queue.empty():
+            self._start_threads()
+
+    def _list_uploaded_parts(self, upload_id):
+        """
+        :return: A dict of (first_byte, last_byte) -> tree hash, for each part that AWS has for an upload
+        """
+        uploaded_parts = {}
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(vaultName=self.vault_name, uploadId=upload_id):
+            for part in page.get("Parts", []):
+                first_byte, last_byte = part["RangeInBytes"].split("-")
+                uploaded_parts[(int(first_byte), int(last_byte))] = part["SHA256TreeHash"]
+        return uploaded_parts
+
+    def _abort_upload(self, upload_id):
+        try:
+            self.client.abort_multipart_upload(vaultName=self.vault_name, uploadId=upload_id)
+        except botocore.exceptions.ClientError, e:
+            if e.response.get("Error", {}).get("Code") != "ResourceNotFoundException":
+                self.logger.error("Failed to abort multipart upload {0} - '{1}'".format(upload_id, e))
+                return
+        mongoops.delete_upload_mpart_entries(self.db, self.vault, upload_id)
+
+    def _abort_unknown_uploads(self, known_upload_ids):
+        """
+        Abort the multipart uploads that are open at AWS, but that the database has no parts for. Uploads younger
+        than a part lease are left alone, as another uploader may be just about to register their parts.
+        """
+        cutoff = time.time() - self.part_lease_seconds
+        try:
+            paginator = self.client.get_paginator("list_multipart_uploads")
+            for page in paginator.paginate(vaultName=self.vault_name):
+                for upload in page.get("UploadsList", []):
+                    created = calendar.timegm(time.strptime(upload["CreationDate"][:19], "%Y-%m-%dT%H:%M:%S"))
+                    if upload["MultipartUploadId"] in known_upload_ids or created > cutoff:
+                        continue
+                    self.logger.info("Aborting abandoned multipart upload of {0}".format(
+                        upload.get("ArchiveDescription")))
+                    self._abort_upload(upload["MultipartUploadId"])
+        except botocore.exceptions.ClientError, e:
+            self.logger.error("Failed to list multipart uploads - '{0}'".format(e))
+
+    def _send(self, request, nbytes, is_part, **kwargs):
+        """
+        Make an upload request once there's a free slot for it, and report how it went to the concurrency limiter.
+        Only multipart parts are timed for the limiter - a small archive's round trips make it look slow for its size,
+        and a part that the rate limiter held back says nothing about how busy the link is.
+        """
+        self.concurrency.acquire()
+        started = time.time()
+        try:
+            response = request(**kwargs)
+        except botocore.exceptions.ClientError, e:
+            self.concurrency.release(throttled=e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES)
+            raise
+        except Exception:
+            self.concurrency.release()
+            raise
+
+        elapsed = time.time() - started
+        if is_part and not getattr(kwargs.get("body"), "paced_seconds", 0):
+            self.concurrency.release(nbytes, elapsed)
+        else:
+            self.concurrency.release()
+        self._record_throughput(nbytes, elapsed)
+        return response
+
+    def _request_body(self, buf):
+        """
+        Pace the request body through the rate limiter, if there is one, so that it goes out as a steady stream.
+        """
+        if self.rate_limiter:
+            return self.rate_limiter.wrap(buf, len(buf))
+        return buf
+
+    def _part_checksum(self, mpart_entry):
+        """
+        The tree hash of a part - from its document, or by reading it from the temporary archive.
+        """
+        if mpart_entry.get("checksum"):
+            return mpart_entry["checksum"]
+
+        with open(mpart_entry["tmp_archive_location"], "rb") as mpart_f:
+            part_buffer = mmap.mmap(mpart_f.fileno(), mpart_entry["last_byte"] - mpart_entry["first_byte"] + 1,
+                                    offset=mpart_entry["first_byte"], access=mmap.ACCESS_READ)
+            try:
+                return treehash.TreeHash.from_file(part_buffer).hexdigest()
+            finally:
+                part_buffer.close()
+
+    def _upload_part(self, mpart_entry):
+        """
+        Send one part of a multipart upload.
+        :return: True if the part was uploaded
+        """
+        try:
+            with open(mpart_entry["tmp_archive_location"], "rb") as mpart_f:
+                # Send the part straight out of the page cache, rather than copying it into memory first
+                part_buffer = mmap.mmap(mpart_f.fileno(), mpart_entry["last_byte"] - mpart_entry["first_byte"] + 1,
+                                        offset=mpart_entry["first_byte"], access=mmap.ACCESS_READ)
                 try:
-                    final_response = self.client.complete_multipart_upload(vaultName=self.vault_name,
-                                                                           uploadId=mpart_entry["uploadId"],
-                                                                           archiveSize=str(mpart_entry["full_size"]),
-                                                                           checksum=mpart_entry["full_hash"])
-                except Exception, e:
-                    self.logger.error("Failed to complete mpart upload at AWS!")
-                    self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
-                    continue
+                    # With the part's own checksum, AWS rejects a corrupt part straight away, instead of failing
+                    # the whole archive when the upload is completed
+                    part_checksum = mpart_entry.get("checksum")
+                    if not part_checksum:
+                        part_checksum = treehash.TreeHash.from_file(part_buffer).hexdigest()
+                        part_buffer.seek(0)
+
+                    upload_response = self._send(self.client.upload_multipart_part, len(part_buffer), True,
+                                                 vaultName=self.vault_name,
+                                                 uploadId=mpart_entry["uploadId"],
+                                                 range="bytes {0}-{1}/*".format(mpart_entry["first_byte"],
+                                                                                mpart_entry["last_byte"]),
+                                                 checksum=part_checksum,
+                                                 body=self._request_body(part_buffer))
+                finally:
+                    part_buffer.close()
+
+                if upload_response:
+                    mongoops.delete_mpart_entry(self.db, mpart_entry["_id"])
+                    self.logger.info("Uploaded bytes {0} to {1} of {2}".format(mpart_entry["first_byte"],
+                                                                               mpart_entry["last_byte"],
+                                                                               mpart_entry["tmp_archive_location"]))
+                return bool(upload_response)
 
+        except Exception, e:
+            self.logger.error("Failed to upload mpart!")
+            self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
+            self.logger.debug(e.__repr__)
+            return False
+
+    def _upload_single(self, upload_entry):
+        """
+        Send a small archive in one upload_archive request.
+        """
+        try:
+            with open(upload_entry["tmp_archive_location"], "rb") as arch_f:
+                arch_buffer = mmap.mmap(arch_f.fileno(), upload_entry["full_size"], access=mmap.ACCESS_READ)
                 try:
+                    final_response = self._send(self.client.upload_archive, upload_entry["full_size"], False,
+                                                vaultName=self.vault_name,
+                                                archiveDescription=upload_entry["subdir_rel_path"],
+                                                checksum=upload_entry["full_hash"],
+                                                body=self._request_body(arch_buffer))
+                finally:
+                    arch_buffer.close()
 
-                    mongoops.create_archive_entry(self.db, os.path.join(os.path.dirname(mpart_entry["subdir_rel_path"]),
-                                                                        os.path.basename(
-                                                                            mpart_entry["tmp_archive_location"])),
-                                                  mongoops.get_vault_by_name(self.db, self.vault_name)["arn"],
-                                                  final_response["archiveId"], final_response["checksum"],
-                                                  mpart_entry["full_size"], final_response["location"])
+        except Exception, e:
+            self.logger.error("Failed to upload archive!")
+            self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
+            self._part_failed(upload_entry)
+            return
 
-                except Exception, e:
-                    self.logger.error("Failed to complete mpart upload - could not create DB archive entry")
-                    self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
-                    continue
+        self._finish_archive(upload_entry, final_response)
 
+    def _finish_archive(self, upload_entry, final_response):
+        """
+        Record a completed upload in the database, remove its temporary archive and let anyone who's interested know.
+        """
+        is_raw = upload_entry.get("archive_format") == archiver.RAW_FORMAT
+        source_mtime = None
+        with self._parts_lock:
+            archive_members = self._archive_members.pop(upload_entry["tmp_archive_location"], None)
+        if is_raw:
+            # A raw file has no members, and is left where it is - but its mtime is kept, so that it's only hashed
+            # again once it has changed
+            source_mtime = upload_entry.get("source_mtime")
+            if source_mtime is None:
                 try:
-                    os.remove(mpart_entry["tmp_archive_location"])
-                    self.logger.info("Completed upload of {0}".format(mpart_entry["tmp_archive_location"]))
+                    source_mtime = os.stat(upload_entry["tmp_archive_location"]).st_mtime
+                except OSError:
+                    pass
+        elif archive_members is None:
+            try:
+                archive_members = archiver.read_member_index(upload_entry["tmp_archive_location"])
+            except Exception, e:
+                self.logger.warning("Could not index the members of {0} - '{1}'".format(
+                    upload_entry["tmp_archive_location"], e))
+
+        try:
+            archive_rel_path = os.path.join(os.path.dirname(upload_entry["subdir_rel_path"]),
+                                            os.path.basename(upload_entry["tmp_archive_location"]))
+            # A pack of small directories is catalogued under their parent, so keep a map of the directories in it
+            archive_dirs = archiver.member_dirs(archive_rel_path, archive_members) if archive_members else None
+            mongoops.create_archive_entry(self.db, archive_rel_path, self.vault_arn,
+                                          final_response["archiveId"], final_response["checksum"],
+                                          upload_entry["full_size"], final_response["location"], archive_members,
+                                          archive_dirs, upload_entry.get("archive_format"), source_mtime)
+
+        except Exception, e:
+            self.logger.error("Failed to complete mpart upload - could not create DB archive entry")
+            self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
+            return
+
+        try:
+            if not is_raw:
+                os.remove(upload_entry["tmp_archive_location"])
+            self.logger.info("Completed upload of {0}".format(upload_entry["tmp_archive_location"]))
 
-                except Exception, e:
-                    self.logger.error("Failed to complete mpart upload - could not remove temp archive")
-                    self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
-                    continue
+        except Exception, e:
+            self.logger.error("Failed to complete mpart upload - could not remove temp archive")
+            self.logger.debug("Error msg:\n{0}\nError args:\n{1}".format(e.message, e.args))
+            return
+
+        self._notify_completion({"_id": final_response["archiveId"],
+                                 "path": archive_rel_path,
+                                 "treehash": final_response["checksum"],
+                                 "size": upload_entry["full_size"],
+                                 "uploaded_time": time.time(),
+                                 "format": upload_entry.get("archive_format"),
+                                 "source_mtime": source_mtime,
+                                 "tmp_archive_location": upload_entry["tmp_archive_location"]})
+
+    def _notify_completion(self, archive_entry):
+        for callback in self.completion_callbacks:
+            try:
+                callback(archive_entry)
+            except Exception, e:
+                self.logger.error("Upload completion callback failed - '{0}'".format(e))
+
+    def is_uploading(self):
+        with self._threads_lock:
+            return any(t.is_alive() for t in self.upload_threads)
 
     def wait_for_finish(self):
-        for t in self.upload_threads:
-            if t.is_alive:
+        # Threads may be started while others are being waited for, so keep going until none are left
+        while True:
+            with self._threads_lock:
+                self.upload_threads = [t for t in self.upload_threads if t.is_alive()]
+                threads = list(self.upload_threads)
+            if not threads:
+                return
+            for t in threads:
                 t.join()
@@ -0,0 +1,105 @@
+import fcntl
+import logging
+import os, os.path
+import tempfile
+
+DEFAULT_WORK_DIR = "~/.cupo/work"
+
+
+class WorkDir():
+    """
+    The directory that archives wait in until they have been uploaded. Unlike the system's temporary directory, it
+    survives a restart, so the uploads of an interrupted run can be resumed from the same archives.
+
+    Each run creates its archives in a directory of its own, so that archives left over from an earlier run (which may
+    still be resumed) never collide with new ones of the same name.
+    """
+
+    def __init__(self, root, vault_name):
+        self.path = os.path.abspath(os.path.join(os.path.expanduser(root), vault_name))
+        self.run_dir = None
+        self._lock_f = None
+        self.logger = logging.getLogger("cupobackup{0}.WorkDir".format(os.getpid()))
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def lock(self):
+        """
+        Take the work directory for this process, so that no other backup to the same vault cleans up from under it.
+        :return: False if another process already has it
+        """
+        self._lock_f = open(os.path.join(self.path, ".lock"), "w")
+        try:
+            fcntl.flock(self._lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_f.close()
+            self._lock_f = None
+            return False
+        return True
+
+    def unlock(self):
+        if self._lock_f:
+            fcntl.flock(self._lock_f, fcntl.LOCK_UN)
+            self._lock_f.close()
+            self._lock_f = None
+
+    def start_run(self):
+        """
+        :return: The path to a new, empty directory for this run's archives
+        """
+        self.run_dir = tempfile.mkdtemp(prefix="run-", dir=self.path)
+        self.logger.info("Created working directory at {0}".format(self.run_dir))
+        return self.run_dir
+
+    def resume_run(self, run_dir):
+        """
+        Carry on using the directory of an interrupted run, so that the archives in it can be used again.
+        """
+        self.run_dir = os.path.abspath(run_dir)
+        self.logger.info("Resuming in working directory {0}".format(self.run_dir))
+        return self.run_dir
+
+    def list_runs(self):
+        return sorted(os.path.join(self.path, d) for d in os.listdir(self.path)
+                      if d.startswith("run-") and os.path.isdir(os.path.join(self.path, d)))
+
+    def clean_up(self, keep_paths):
+        """
+        Remove everything left behind by earlier runs, apart from `keep_paths` - the archives that still have uploads
+        to resume. Only call this while holding the lock.
+        """
+        keep_paths = set(os.path.abspath(p) for p in keep_paths)
+        for run_dir in self.list_runs():
+            if run_dir == self.run_dir:
+                continue
+
+            for dirpath, dirnames, filenames in os.walk(run_dir, topdown=False):
+                for filename in filenames:
+                    fpath = os.path.abspath(os.path.join(dirpath, filename))
+                    if fpath not in keep_paths:
+                        self.logger.info("Removing leftover archive {0}".format(fpath))
+                        os.remove(fpath)
+                _remove_if_empty(dirpath)
+
+    def finish_run(self):
+        """
+        Remove this run's directory, unless it still holds archives whose uploads didn't finish - those are kept to
+        be resumed next time.
+        :return: The number of archives kept
+        """
+        kept = 0
+        for dirpath, dirnames, filenames in os.walk(self.run_dir, topdown=False):
+            kept += len(filenames)
+            _remove_if_empty(dirpath)
+
+        if kept:
+            self.logger.info("Keeping {0} unfinished archives in {1} to resume next run".format(kept, self.run_dir))
+        return kept
+
+
+def _remove_if_empty(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
@@ -0,0 +1,222 @@
+import logging
+import os, os.path
+import struct
+import time
+import zipfile
+import zlib
+
+logger = logging.getLogger("cupobackup{0}.zipstream".format(os.getpid()))
+
+# Where each field of a local file header is, in the tuple that zipfile.structFileHeader unpacks to
+_FH_SIGNATURE = 0
+_FH_GENERAL_PURPOSE_FLAG_BITS = 3
+_FH_COMPRESSION_METHOD = 4
+_FH_LAST_MOD_TIME = 5
+_FH_LAST_MOD_DATE = 6
+_FH_CRC = 7
+_FH_COMPRESSED_SIZE = 8
+_FH_UNCOMPRESSED_SIZE = 9
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+_ZIP64_EXTRA_ID = 0x0001
+
+# Parser states
+_HEADER = 0
+_NAME = 1
+_DATA = 2
+_DONE = 3
+
+
+class ZipStreamExtractor():
+    """
+    Extracts the members of a zip archive as its bytes arrive, from the start of the archive to the end - so the
+    archive itself never needs to be stored, or read a second time.
+
+    This works from the local header in front of each member, rather than the central directory at the end of the
+    archive, so it relies on every local header holding its member's sizes. zipfile always writes them when the file
+    that it's writing is seekable, as ours are.
+    """
+
+    def __init__(self, dest_dir, max_members=None, skip_dirs=None):
+        """
+        :param dest_dir: The directory to extract the members into
+        :param max_members: If given, stop after extracting this many members - for when only part of an archive is
+        being read
+        :param skip_dirs: The directories (relative to `dest_dir`) whose members are read past rather than extracted
+        """
+        self.dest_dir = dest_dir
+        self.max_members = max_members
+        self.skip_dirs = set(skip_dirs or [])
+        self.extracted = []
+
+        self._buf = ""
+        self._state = _HEADER
+        self._header = None
+        self._member = None
+
+    def feed(self, data):
+        """
+        Pass on the next bytes of the archive, extracting whatever can be extracted from them.
+        """
+        if self._state == _DONE:
+            return
+
+        self._buf += data
+        while self._step():
+            pass
+
+    @property
+    def done(self):
+        return self._state == _DONE
+
+    def close(self):
+        """
+        :raise IOError: if the archive ended part way through a member
+        """
+        if self._state in (_NAME, _DATA):
+            raise IOError("Archive ended part way through a member")
+
+    def _step(self):
+        if self._state == _HEADER:
+            if len(self._buf) < 4:
+                return False
+            if self._buf[:4] != zipfile.stringFileHeader:
+                # The central directory follows the last member - there's nothing else to extract
+                if self._buf[:4] not in (zipfile.stringCentralDir, zipfile.stringEndArchive, zipfile.stringEndArchive64):
+                    raise IOError("Expected a zip member header, found {0!r}".format(self._buf[:4]))
+                self._state = _DONE
+                self._buf = ""
+                return False
+            if len(self._buf) < zipfile.sizeFileHeader:
+                return False
+
+            self._header = struct.unpack(zipfile.structFileHeader, self._buf[:zipfile.sizeFileHeader])
+            self._buf = self._buf[zipfile.sizeFileHeader:]
+            self._state = _NAME
+            return True
+
+        if self._state == _NAME:
+            name_length = self._header[_FH_FILENAME_LENGTH]
+            extra_length = self._header[_FH_EXTRA_FIELD_LENGTH]
+            if len(self._buf) < name_length + extra_length:
+                return False
+
+            name = self._buf[:name_length]
+            extra = self._buf[name_length:name_length + extra_length]
+            self._buf = self._buf[name_length + extra_length:]
+            self._start_member(name, extra)
+            self._state = _DATA
+            return True
+
+        if self._state == _DATA:
+            member = self._member
+            if member["remaining"] and not self._buf:
+                return False
+
+            n = min(member["remaining"], len(self._buf))
+            if n:
+                data = self._buf[:n]
+                self._buf = self._buf[n:]
+                member["remaining"] -= n
+                if member["decompressor"]:
+                    data = member["decompressor"].decompress(data)
+                self._write(data)
+
+            if member["remaining"]:
+                return False
+
+            if member["decompressor"]:
+                self._write(member["decompressor"].flush())
+            self._finish_member()
+            if self.max_members and len(self.extracted) >= self.max_members:
+                self._state = _DONE
+                self._buf = ""
+                return False
+            self._state = _HEADER
+            return True
+
+        return False
+
+    def _start_member(self, name, extra):
+        flags = self._header[_FH_GENERAL_PURPOSE_FLAG_BITS]
+        method = self._header[_FH_COMPRESSION_METHOD]
+        if flags & 0x1:
+            raise IOError("Member {0} is encrypted".format(name))
+        if flags & 0x8:
+            raise IOError("Member {0} has no sizes in its local header - it can't be streamed".format(name))
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise IOError("Member {0} uses unsupported compression method {1}".format(name, method))
+
+        compressed_size = self._header[_FH_COMPRESSED_SIZE]
+        file_size = self._header[_FH_UNCOMPRESSED_SIZE]
+        if 0xFFFFFFFF in (compressed_size, file_size):
+            file_size, compressed_size = _zip64_sizes(extra, file_size, compressed_size)
+
+        # Members are stored under their file names, or their path from the pack's directory for a pack of small
+        # directories - never let one escape the destination directory
+        rel_path = os.path.normpath(name.replace("\\", "/"))
+        if os.path.isabs(rel_path) or rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            raise IOError("Member {0} would be extracted outside of {1}".format(name, self.dest_dir))
+        if os.path.dirname(rel_path) in self.skip_dirs:
+            logger.info("Skipping {0} - a newer archive holds its directory".format(rel_path))
+            self._member = {"path": None, "f": None, "remaining": compressed_size, "decompressor": None}
+            return
+
+        path = os.path.join(self.dest_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        logger.info("Extracting {0}".format(path))
+        d = self._header
+        date_time = ((d[_FH_LAST_MOD_DATE] >> 9) + 1980, (d[_FH_LAST_MOD_DATE] >> 5) & 0xF, d[_FH_LAST_MOD_DATE] & 0x1F,
+                     d[_FH_LAST_MOD_TIME] >> 11, (d[_FH_LAST_MOD_TIME] >> 5) & 0x3F, (d[_FH_LAST_MOD_TIME] & 0x1F) * 2)
+        self._member = {"path": path,
+                        "f": open(path, "wb"),
+                        "remaining": compressed_size,
+                        "file_size": file_size,
+                        "written": 0,
+                        "crc": 0,
+                        "date_time": date_time,
+                        "decompressor": zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None}
+
+    def _write(self, data):
+        member = self._member
+        if not data or not member["f"]:
+            return
+        member["f"].write(data)
+        member["written"] += len(data)
+        member["crc"] = zlib.crc32(data, member["crc"])
+
+    def _finish_member(self):
+        member = self._member
+        self._member = None
+        if not member["f"]:
+            return
+        member["f"].close()
+
+        if member["written"] != member["file_size"] or \
+                (member["crc"] & 0xFFFFFFFF) != self._header[_FH_CRC]:
+            raise IOError("Extracted file {0} is corrupt".format(member["path"]))
+
+        mtime = time.mktime(member["date_time"] + (0, 0, -1))
+        os.utime(member["path"], (mtime, mtime))
+        self.extracted.append(member["path"])
+
+
+def _zip64_sizes(extra, file_size, compressed_size):
+    """
+    Read the real sizes of a large member from the Zip64 field of its local header's extra data.
+    """
+    while len(extra) >= 4:
+        field_id, field_length = struct.unpack("<HH", extra[:4])
+        if field_id == _ZIP64_EXTRA_ID:
+            values = list(struct.unpack("<{0}Q".format(field_length // 8), extra[4:4 + field_length - field_length % 8]))
+            if file_size == 0xFFFFFFFF:
+                file_size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = values.pop(0)
+            return file_size, compressed_size
+        extra = extra[4 + field_length:]
+
+    raise IOError("Member is too large for its header, but has no Zip64 sizes")